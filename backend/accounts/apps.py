@@ -4,3 +4,19 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+        from .middleware import invalidate_user
+        from .models import CustomUser
+
+        def drop_cached_user(sender, instance, **kwargs):
+            invalidate_user(instance.pk)
+
+        # Saves cover tier, credit and token version changes
+        post_save.connect(drop_cached_user, sender=CustomUser, weak=False)
+        post_delete.connect(drop_cached_user, sender=CustomUser, weak=False)
+
+        from django.db.backends.signals import connection_created
+        from .profiling import install
+        connection_created.connect(install, weak=False)
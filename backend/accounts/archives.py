@@ -0,0 +1,330 @@
+import struct
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+from . import tree
+from .downloads import content_type_for
+from .models import File, Folder
+
+
+# Folder and multi-selection downloads
+#
+# select() resolves folder and file ids to the archive's members: every live
+# file and folder in the selected subtrees (kept in their folders) and the
+# selected files (at the root). stream() writes them as a ZIP64 archive one
+# block at a time, so memory use does not depend on the size of the files.
+# Members are stored as they are; with `compress`, text-like files are
+# deflated. Every member uses ZIP64 records and a data descriptor (its CRC
+# is only known once streamed), which keeps the layout independent of the
+# content: without compression the archive's length is known up front and
+# sent as Content-Length.
+#
+# The download URL from the `downloadArchive` query is signed like the ones
+# for single files, and the selection is resolved again (for the signing
+# user) when it is fetched.
+
+
+SIGNED_URL_SALT = "accounts.archives"
+ARCHIVE_NAME = "download.zip"
+
+VERSION = 45  # ZIP64
+FLAGS = 0x0808  # data descriptor, UTF-8 names
+STORED, DEFLATED = 0, 8
+FILE_ATTRIBUTES = 0o100644 << 16
+DIRECTORY_ATTRIBUTES = (0o040755 << 16) | 0x10
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+LOCAL_EXTRA = struct.Struct("<HHQQ")
+DATA_DESCRIPTOR = struct.Struct("<IIQQ")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+CENTRAL_EXTRA = struct.Struct("<HHQQQ")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END = struct.Struct("<IHHHHIIH")
+
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/xml", "application/javascript",
+    "application/msword", "application/rtf", "application/x-sh", "image/svg+xml",
+}
+
+
+class ArchiveError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class Member:
+    __slots__ = ("name", "size", "dos_time", "dos_date", "stored_name", "compress")
+
+    def __init__(self, name, size, modified, stored_name=None, compress=False):
+        self.name = name.encode()
+        self.size = size
+        self.dos_time, self.dos_date = _dos_datetime(modified)
+        self.stored_name = stored_name  # None for directories
+        self.compress = compress
+
+    @property
+    def is_directory(self):
+        return self.stored_name is None
+
+    def entry_length(self, compressed_size):
+        """
+        Bytes the member takes up: local header, data, descriptor and its
+        central directory record.
+        """
+        name = len(self.name)
+        return (LOCAL_HEADER.size + name + LOCAL_EXTRA.size + compressed_size
+                + DATA_DESCRIPTOR.size + CENTRAL_HEADER.size + name + CENTRAL_EXTRA.size)
+
+
+class Selection:
+    def __init__(self, name, members):
+        self.name = name
+        self.members = members
+
+    @property
+    def files(self):
+        return sum(not member.is_directory for member in self.members)
+
+    @property
+    def size(self):
+        return sum(member.size for member in self.members)
+
+    def content_length(self):
+        """
+        The archive's length in bytes, or None if a member is compressed.
+        """
+        if any(member.compress for member in self.members):
+            return None
+        return (sum(member.entry_length(member.size) for member in self.members)
+                + ZIP64_END.size + ZIP64_LOCATOR.size + END.size)
+
+
+def _dos_datetime(moment):
+    moment = timezone.localtime(moment) if timezone.is_aware(moment) else moment
+    if moment.year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01, the earliest DOS date
+    return ((moment.hour << 11) | (moment.minute << 5) | (moment.second // 2),
+            ((moment.year - 1980) << 9) | (moment.month << 5) | moment.day)
+
+
+def _safe_name(name):
+    name = name.replace("/", "_").replace("\\", "_").strip()
+    return name if name not in ("", ".", "..") else "_"
+
+
+def _unique(path, taken):
+    """
+    `path`, or `path` with " (2)", " (3)"... before the extension if taken.
+    """
+    directory = path.endswith("/")
+    head, dot, extension = path.rstrip("/").rpartition(".")
+    if not head or "/" in extension:
+        head, dot, extension = path.rstrip("/"), "", ""
+    candidate, n = path, 1
+    while candidate in taken:
+        n += 1
+        candidate = f"{head} ({n}){dot}{extension}" + ("/" if directory else "")
+    taken.add(candidate)
+    return candidate
+
+
+def compressible(name):
+    content_type = content_type_for(name)
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def max_bytes(user):
+    config = settings.ARCHIVES
+    return config["MAX_BYTES"].get(user.tier, config["DEFAULT_MAX_BYTES"])
+
+
+def select(user, file_ids=(), folder_ids=(), compress=False):
+    """
+    The Selection for `user`'s live files and folders among the given ids.
+    Raises ArchiveError if there is nothing to download or the archive
+    would be over the user's limits.
+    """
+    # Selected folders inside another selected folder come with it
+    top = []
+    for folder in sorted(Folder.objects.filter(
+            owner=user, is_deleted=False, id__in=folder_ids), key=lambda f: f.path):
+        if not any(tree.is_within(folder, kept) for kept in top):
+            top.append(folder)
+    top_ids = {folder.id for folder in top}
+
+    taken, directories, members = set(), {}, []
+    # Path order lists every folder after its parent
+    rows = (tree.subtrees_folders(user.id, top).filter(is_deleted=False)
+            .order_by("path").values_list("id", "parent_id", "name", "created_at"))
+    for pk, parent_id, name, created_at in rows.iterator():
+        prefix = "" if pk in top_ids else directories.get(parent_id)
+        if prefix is None:
+            continue  # below a folder in the bin
+        directories[pk] = _unique(f"{prefix}{_safe_name(name)}/", taken)
+        members.append(Member(directories[pk], 0, created_at))
+
+    limit, config = max_bytes(user), settings.ARCHIVES
+    files = File.objects.filter(owner=user, is_deleted=False).filter(
+        Q(id__in=file_ids)
+        | Q(folder_id__in=tree.subtrees_folders(user.id, top).values("id")))
+    rows = (files.exclude(Q(file="") | Q(file__isnull=True))
+            .order_by("folder_id", "name", "id")
+            .values_list("id", "name", "folder_id", "size", "created_at", "file"))
+    file_ids = set(file_ids)
+    size = count = loose = 0
+    for pk, name, folder_id, file_size, created_at, stored_name in rows.iterator():
+        if folder_id not in directories:
+            if pk not in file_ids:
+                continue  # in a folder in the bin
+            loose += 1
+        path = directories.get(folder_id, "") + _safe_name(name)
+        size += file_size
+        count += 1
+        if size > limit:
+            raise ArchiveError(f"Archives are limited to {limit} bytes", status=413)
+        if count > config["MAX_FILES"]:
+            raise ArchiveError(
+                f"Archives are limited to {config['MAX_FILES']} files", status=413)
+        members.append(Member(
+            _unique(path, taken), file_size, created_at, stored_name,
+            compress and compressible(name)))
+
+    if not members:
+        raise ArchiveError("Nothing to download", status=404)
+    if len(top) == 1 and not loose:
+        name = f"{directories[top[0].id].rstrip('/')}.zip"
+    else:
+        name = ARCHIVE_NAME
+    return Selection(name, members)
+
+
+def _read(member, block_size):
+    storage = File._meta.get_field("file").storage
+    with storage.open(member.stored_name, "rb") as content:
+        remaining = member.size
+        while remaining:
+            block = content.read(min(block_size, remaining))
+            if not block:
+                # The stream's length was promised; abort the response
+                raise ArchiveError(f"{member.stored_name} is shorter than recorded")
+            remaining -= len(block)
+            yield block
+
+
+def stream(selection, block_size=None):
+    """
+    Yield the ZIP64 archive of `selection` block by block.
+    """
+    block_size = block_size or settings.ARCHIVES["BLOCK_SIZE"]
+    offset = 0
+    written = []  # (member, crc, compressed size, offset)
+    for member in selection.members:
+        method = DEFLATED if member.compress else STORED
+        header = LOCAL_HEADER.pack(
+            0x04034B50, VERSION, FLAGS, method, member.dos_time, member.dos_date,
+            0, 0xFFFFFFFF, 0xFFFFFFFF, len(member.name), LOCAL_EXTRA.size
+        ) + member.name + LOCAL_EXTRA.pack(0x0001, 16, 0, 0)
+        yield header
+
+        crc, compressed_size = 0, 0
+        if not member.is_directory:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if member.compress else None
+            for block in _read(member, block_size):
+                crc = zlib.crc32(block, crc)
+                if compressor is not None:
+                    block = compressor.compress(block)
+                compressed_size += len(block)
+                if block:
+                    yield block
+            if compressor is not None:
+                block = compressor.flush()
+                compressed_size += len(block)
+                yield block
+        yield DATA_DESCRIPTOR.pack(0x08074B50, crc, compressed_size, member.size)
+        written.append((member, crc, compressed_size, offset))
+        offset += len(header) + compressed_size + DATA_DESCRIPTOR.size
+
+    directory_offset = offset
+    for member, crc, compressed_size, member_offset in written:
+        record = CENTRAL_HEADER.pack(
+            0x02014B50, (3 << 8) | VERSION, VERSION, FLAGS,
+            DEFLATED if member.compress else STORED, member.dos_time, member.dos_date,
+            crc, 0xFFFFFFFF, 0xFFFFFFFF, len(member.name), CENTRAL_EXTRA.size, 0, 0, 0,
+            DIRECTORY_ATTRIBUTES if member.is_directory else FILE_ATTRIBUTES, 0xFFFFFFFF,
+        ) + member.name + CENTRAL_EXTRA.pack(
+            0x0001, 24, member.size, compressed_size, member_offset)
+        offset += len(record)
+        yield record
+
+    entries = len(written)
+    yield (ZIP64_END.pack(
+        0x06064B50, ZIP64_END.size - 12, (3 << 8) | VERSION, VERSION, 0, 0,
+        entries, entries, offset - directory_offset, directory_offset)
+        + ZIP64_LOCATOR.pack(0x07064B50, 0, offset, 1)
+        + END.pack(0x06054B50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0))
+
+
+async def _stream_async(blocks):
+    # Read and compress in worker threads, one block at a time; a sync
+    # iterator would be read into memory whole under ASGI
+    next_block = sync_to_async(next, thread_sensitive=False)
+    try:
+        while True:
+            block = await next_block(blocks, None)
+            if block is None:
+                return
+            yield block
+    finally:
+        blocks.close()
+
+
+def signed_url(user, file_ids, folder_ids, compress=False):
+    """
+    A URL that downloads the archive without an Authorization header.
+    Valid for DOWNLOADS["SIGNED_URL_TTL"] seconds and until the user's
+    tokens are revoked.
+    """
+    token = signing.dumps(
+        {"u": user.pk, "v": user.token_version, "f": list(file_ids), "d": list(folder_ids),
+         "c": bool(compress)},
+        salt=SIGNED_URL_SALT, compress=True)
+    return f"{reverse('archive_download')}?sig={token}"
+
+
+def unsign(token):
+    """
+    (user id, token version, file ids, folder ids, compress) from a signed
+    URL's token, or None if it is invalid or expired.
+    """
+    try:
+        value = signing.loads(
+            token, salt=SIGNED_URL_SALT, max_age=settings.DOWNLOADS["SIGNED_URL_TTL"])
+    except signing.BadSignature:
+        return None
+    return value["u"], value.get("v"), value["f"], value["d"], value["c"]
+
+
+def serve(request, selection):
+    blocks = stream(selection)
+    if isinstance(request, ASGIRequest):
+        blocks = _stream_async(blocks)
+    response = StreamingHttpResponse(blocks, content_type="application/zip")
+    length = selection.content_length()
+    if length is not None:
+        response["Content-Length"] = length
+    response["Content-Disposition"] = content_disposition_header(True, selection.name)
+    response["Cache-Control"] = "private, no-store"
+    # Let nginx pass blocks on as they come
+    response["X-Accel-Buffering"] = "no"
+    return response
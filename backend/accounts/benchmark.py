@@ -0,0 +1,406 @@
+import gc
+import platform
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import django
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Length
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from . import usage
+from .models import CustomUser, File, Folder
+
+
+# GraphQL benchmarks
+#
+# seed() builds a reproducible dataset (everything drawn from one
+# random.Random(seed)): users with folder trees of a given size and depth,
+# and files spread over them, a few of each in the bin. run() executes
+# every operation in OPERATIONS against cryogenum_backend.schema.schema and
+# records latency percentiles, SQL queries per call and peak Python memory
+# (tracemalloc, measured in a separate pass so it doesn't skew timings).
+# Everything runs in a transaction that is rolled back and uploads go to a
+# temporary MEDIA_ROOT, so the database and media are left as they were.
+# See `manage.py bench_graphql`.
+
+
+PASSWORD = "benchmark-password"
+FILE_TYPES = ["image", "pdf", "doc", "mp3", "video", "other"]
+EXTENSIONS = {"image": "jpg", "pdf": "pdf", "doc": "docx", "mp3": "mp3", "video": "mp4", "other": "bin"}
+WORDS = [
+    "report", "invoice", "holiday", "draft", "budget", "photo", "scan", "notes",
+    "contract", "summary", "backup", "design", "meeting", "recording", "final",
+]
+BIN_RATIO = 0.05
+
+
+class Dataset:
+    """
+    The seeded rows of the benchmark user, plus helpers that make fresh
+    rows for operations that consume them.
+    """
+
+    def __init__(self, rng, user, folders, files):
+        self.rng = rng
+        self.user = user
+        self.folders = folders  # live, shallowest first
+        self.files = files  # live
+        self.counter = 0
+
+    def name(self, suffix=""):
+        self.counter += 1
+        return f"{self.rng.choice(WORDS)} {self.counter}{suffix}"
+
+    def folder(self):
+        return self.rng.choice(self.folders)
+
+    def deepest_folder(self):
+        return self.folders[-1]
+
+    def file(self):
+        return self.rng.choice(self.files)
+
+    def new_file(self, is_deleted=False, folder=None):
+        return File.objects.create(
+            name=self.name(".pdf"), owner=self.user, folder=folder, size=1024,
+            file_type="pdf", is_deleted=is_deleted,
+            deleted_at=timezone.now() if is_deleted else None)
+
+    def new_folder(self, is_deleted=False, files=2):
+        folder = Folder.objects.create(name=self.name(), owner=self.user)
+        child = Folder.objects.create(name=self.name(), owner=self.user, parent=folder)
+        for parent in (folder, child):
+            for _ in range(files):
+                self.new_file(folder=parent)
+        if is_deleted:
+            Folder.objects.filter(path__startswith=folder.path).update(
+                is_deleted=True, deleted_at=timezone.now())
+            File.objects.filter(folder__path__startswith=folder.path).update(
+                is_deleted=True, deleted_at=timezone.now())
+        return folder
+
+
+def _seed_user(rng, index, folders, files, depth):
+    user = CustomUser.objects.create_user(
+        username=f"bench user {index}", email=f"bench{index}@example.com",
+        # Free tier: the pro storage limit (50 GB) overflows the 32-bit
+        # DashboardStatsType.storageLimit, as do totals past 2 GB
+        password=PASSWORD, tier="free")
+
+    # Folder trees level by level: bulk_create skips Folder.save(), which
+    # would set the paths one row at a time
+    levels = [[] for _ in range(max(depth, 1))]
+    for i in range(folders):
+        levels[i * len(levels) // folders].append(i)
+    parents, all_folders = [], []
+    for members in levels:
+        if not members:
+            continue
+        rows = Folder.objects.bulk_create([
+            Folder(name=f"{rng.choice(WORDS)} {i}", owner=user,
+                   parent=rng.choice(parents) if parents else None)
+            for i in members
+        ])
+        for folder in rows:
+            folder.path = (folder.parent.path if folder.parent else "") + f"{folder.pk}/"
+        Folder.objects.bulk_update(rows, ["path"])
+        all_folders += rows
+        parents = rows
+
+    rows = []
+    for i in range(files):
+        file_type = rng.choice(FILE_TYPES)
+        is_deleted = rng.random() < BIN_RATIO
+        rows.append(File(
+            name=f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}.{EXTENSIONS[file_type]}",
+            owner=user, folder=rng.choice(all_folders) if all_folders and rng.random() > 0.2 else None,
+            size=rng.randint(1024, 1024 * 1024), file_type=file_type,
+            is_deleted=is_deleted, deleted_at=timezone.now() if is_deleted else None))
+    File.objects.bulk_create(rows, batch_size=1000)
+
+    # Some subtrees in the bin, the way deleteFolder leaves them
+    trashed = Q(pk__in=[])
+    for folder in all_folders:
+        if rng.random() < BIN_RATIO:
+            trashed |= Q(path__startswith=folder.path)
+    bin_folders = Folder.objects.filter(trashed, owner=user)
+    File.objects.filter(folder__in=bin_folders).update(
+        is_deleted=True, deleted_at=timezone.now())
+    bin_folders.update(is_deleted=True, deleted_at=timezone.now())
+
+    usage.rebuild_usage(user)
+    live_folders = list(Folder.objects.filter(owner=user, is_deleted=False)
+                        .order_by(Length("path"), "pk"))
+    live_files = list(File.objects.filter(owner=user, is_deleted=False).order_by("pk"))
+    return user, live_folders, live_files
+
+
+def seed(seed=0, users=3, folders=200, files=2000, depth=5):
+    """
+    Create `users` users with the given tree. Returns the Dataset of the
+    first, which the operations run as; the others just add rows.
+    """
+    rng = random.Random(seed)
+    seeded = [_seed_user(rng, i, folders, files, depth) for i in range(users)]
+    user, live_folders, live_files = seeded[0]
+    if not live_folders or not live_files:
+        raise ValueError("The benchmark needs at least one live folder and file")
+    return Dataset(rng, user, live_folders, live_files)
+
+
+class Operation:
+    def __init__(self, name, query, variables=None, max_iterations=None, anonymous=False):
+        self.name = name
+        self.query = query
+        self.variables = variables or (lambda data: {})
+        self.max_iterations = max_iterations
+        self.anonymous = anonymous
+
+
+def _ids(*rows):
+    return [row.pk for row in rows]
+
+
+OPERATIONS = [
+    # Queries
+    Operation("me", "{ me { id username email credits avatarInitials } }"),
+    Operation("dashboardStats", """
+        { dashboardStats { fileTypes { fileType count bytes }
+                           foldersCount totalStorageUsed storageLimit } }"""),
+    Operation("userFiles", "{ userFiles { id name size fileType createdAt ownerAvatar thumbnailUrl } }"),
+    Operation("userFolders", "{ userFolders { id name createdAt parent { id name } } }"),
+    Operation("userFilesConnection", """
+        { userFilesConnection(first: 50) {
+            edges { node { id name size fileType createdAt thumbnailUrl } }
+            pageInfo { hasNextPage endCursor } } }"""),
+    Operation("userFoldersConnection", """
+        { userFoldersConnection(first: 50) {
+            edges { node { id name createdAt } } pageInfo { hasNextPage endCursor } } }"""),
+    Operation("folderContents", """
+        query($folderId: ID!) { folderContents(folderId: $folderId) {
+            filesConnection(first: 50) { edges { node { id name size fileType thumbnailUrl } } }
+            foldersConnection(first: 50) { edges { node { id name } } } } }""",
+              lambda data: {"folderId": data.folder().pk}),
+    Operation("folderInfo", """
+        query($folderId: ID!) { folderInfo(folderId: $folderId) {
+            id name parentId breadcrumbs { id name } } }""",
+              lambda data: {"folderId": data.deepest_folder().pk}),
+    Operation("binContents", "{ binContents { files { id name } folders { id name } } }"),
+    Operation("searchFiles", """
+        query($query: String!) { searchFiles(query: $query, first: 20) {
+            edges { node { id name fileType } } } }""",
+              lambda data: {"query": data.rng.choice(WORDS)[:4]}),
+    Operation("searchFolders", """
+        query($query: String!) { searchFolders(query: $query, first: 20) {
+            edges { node { id name } } } }""",
+              lambda data: {"query": data.rng.choice(WORDS)}),
+    Operation("downloadArchive", """
+        query($folderIds: [ID]) { downloadArchive(folderIds: $folderIds) {
+            url name filesCount size contentLength } }""",
+              lambda data: {"folderIds": [data.folder().pk]}),
+    Operation("changes", """
+        { changes(limit: 200) { cursor hasMore resync
+            changes { kind id action deleted parentId file { name size } folder { name } } } }"""),
+
+    # Mutations. Password hashing dominates register and login, so they
+    # run fewer times; googleLogin needs Google and is not covered.
+    Operation("register", """
+        mutation($username: String!, $email: String!, $password: String!) {
+            register(username: $username, email: $email, password: $password) { token } }""",
+              lambda data: {"username": data.name(), "email": f"new{data.counter}@example.com",
+                            "password": PASSWORD}, max_iterations=5, anonymous=True),
+    Operation("login", """
+        mutation($email: String!, $password: String!) {
+            login(email: $email, password: $password) { token } }""",
+              lambda data: {"email": data.user.email, "password": PASSWORD},
+              max_iterations=5, anonymous=True),
+    Operation("uploadFile", """
+        mutation($files: [Upload]!, $folderId: ID) {
+            uploadFile(files: $files, folderId: $folderId) { success } }""",
+              lambda data: {"folderId": data.folder().pk, "files": [
+                  SimpleUploadedFile(data.name(".pdf"), data.rng.randbytes(64 * 1024))]}),
+    Operation("createFolder", """
+        mutation($name: String!, $parentId: ID) {
+            createFolder(name: $name, parentId: $parentId) { folder { id } } }""",
+              lambda data: {"name": data.name(), "parentId": data.folder().pk}),
+    Operation("renameFile", """
+        mutation($id: ID!, $name: String!) { renameFile(fileId: $id, newName: $name) { success } }""",
+              lambda data: {"id": data.file().pk, "name": data.name(".pdf")}),
+    Operation("renameFolder", """
+        mutation($id: ID!, $name: String!) { renameFolder(folderId: $id, newName: $name) { success } }""",
+              lambda data: {"id": data.folder().pk, "name": data.name()}),
+    Operation("moveFile", """
+        mutation($id: ID!, $folderId: ID) { moveFile(fileId: $id, folderId: $folderId) { success } }""",
+              lambda data: {"id": data.new_file().pk, "folderId": data.folder().pk}),
+    Operation("moveFolder", """
+        mutation($id: ID!, $parentId: ID) { moveFolder(folderId: $id, parentId: $parentId) { success } }""",
+              lambda data: {"id": data.new_folder().pk, "parentId": data.folder().pk}),
+    Operation("moveItems", """
+        mutation($files: [ID], $folders: [ID], $target: ID) {
+            moveItems(fileIds: $files, folderIds: $folders, targetFolderId: $target) { success } }""",
+              lambda data: {"files": _ids(data.new_file(), data.new_file()),
+                            "folders": _ids(data.new_folder()), "target": data.folder().pk}),
+    Operation("deleteFile", """
+        mutation($id: ID!) { deleteFile(fileId: $id) { success } }""",
+              lambda data: {"id": data.new_file().pk}),
+    Operation("deleteFolder", """
+        mutation($id: ID!) { deleteFolder(folderId: $id) { success } }""",
+              lambda data: {"id": data.new_folder().pk}),
+    Operation("restoreFile", """
+        mutation($id: ID!) { restoreFile(fileId: $id) { success } }""",
+              lambda data: {"id": data.new_file(is_deleted=True).pk}),
+    Operation("restoreFolder", """
+        mutation($id: ID!) { restoreFolder(folderId: $id) { success } }""",
+              lambda data: {"id": data.new_folder(is_deleted=True).pk}),
+    Operation("deleteFileForever", """
+        mutation($id: ID!) { deleteFileForever(fileId: $id) { success } }""",
+              lambda data: {"id": data.new_file(is_deleted=True).pk}),
+    Operation("deleteFolderForever", """
+        mutation($id: ID!) { deleteFolderForever(folderId: $id) { success } }""",
+              lambda data: {"id": data.new_folder(is_deleted=True).pk}),
+    Operation("deleteItems", """
+        mutation($files: [ID], $folders: [ID]) {
+            deleteItems(fileIds: $files, folderIds: $folders) { success } }""",
+              lambda data: {"files": _ids(data.new_file(), data.new_file()),
+                            "folders": _ids(data.new_folder())}),
+    Operation("restoreItems", """
+        mutation($files: [ID], $folders: [ID]) {
+            restoreItems(fileIds: $files, folderIds: $folders) { success } }""",
+              lambda data: {"files": _ids(data.new_file(True), data.new_file(True)),
+                            "folders": _ids(data.new_folder(True))}),
+    Operation("purgeItems", """
+        mutation($files: [ID], $folders: [ID]) {
+            purgeItems(fileIds: $files, folderIds: $folders) { success } }""",
+              lambda data: {"files": _ids(data.new_file(True), data.new_file(True)),
+                            "folders": _ids(data.new_folder(True))}),
+]
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _execute(schema, operation, data, variables):
+    request = RequestFactory().post("/graphql/")
+    request.user = AnonymousUser() if operation.anonymous else data.user
+    start = time.perf_counter()
+    result = schema.execute(operation.query, context_value=request, variable_values=variables)
+    elapsed = time.perf_counter() - start
+    if result.errors:
+        raise BenchmarkError(f"{operation.name}: {result.errors[0]}")
+    return elapsed
+
+
+def measure(schema, operation, data, iterations, warmup=2):
+    """
+    Time `iterations` calls of `operation`. Returns its result dict.
+    """
+    iterations = min(iterations, operation.max_iterations or iterations)
+    # Rows the operation consumes are made before the clock starts
+    for _ in range(min(warmup, iterations)):
+        _execute(schema, operation, data, operation.variables(data))
+
+    gc.collect()  # not the previous operation's garbage
+    latencies, queries = [], []
+    for _ in range(iterations):
+        variables = operation.variables(data)
+        with CaptureQueriesContext(connection) as captured:
+            latencies.append(_execute(schema, operation, data, variables))
+        queries.append(len(captured))
+
+    variables = operation.variables(data)
+    tracemalloc.start()
+    try:
+        _execute(schema, operation, data, variables)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "min_ms": min(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "queries": statistics.median(queries),
+        "peak_kb": peak / 1024,
+    }
+
+
+def run(iterations=50, seed_value=0, users=3, folders=200, files=2000, depth=5,
+        only=None, progress=None):
+    """
+    Seed, benchmark every operation (or those named in `only`) and roll
+    everything back. Returns the results as a JSON-ready dict.
+    """
+    from cryogenum_backend.schema import schema
+
+    operations = [op for op in OPERATIONS if not only or op.name in only]
+    unknown = set(only or ()) - {op.name for op in OPERATIONS}
+    if unknown:
+        raise BenchmarkError(f"Unknown operations: {', '.join(sorted(unknown))}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+        with transaction.atomic():
+            start = time.perf_counter()
+            data = seed(seed_value, users, folders, files, depth)
+            seed_seconds = time.perf_counter() - start
+            for operation in operations:
+                results[operation.name] = measure(schema, operation, data, iterations)
+                if progress:
+                    progress(operation.name, results[operation.name])
+            transaction.set_rollback(True)
+
+    return {
+        "meta": {
+            "created_at": timezone.now().isoformat(),
+            "seed": seed_value,
+            "users": users,
+            "folders": folders,
+            "files": files,
+            "depth": depth,
+            "iterations": iterations,
+            "seed_seconds": seed_seconds,
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "machine": platform.platform(),
+        },
+        "operations": results,
+    }
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Regressions of `current` against `baseline`: operations whose p95
+    grew by more than `threshold` (a fraction) or that run more queries.
+    """
+    regressions = []
+    for name, result in current["operations"].items():
+        before = baseline.get("operations", {}).get(name)
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append(
+                f"{name}: p95 {before['p95_ms']:.2f}ms -> {result['p95_ms']:.2f}ms")
+        if result["queries"] > before["queries"]:
+            regressions.append(
+                f"{name}: {before['queries']:g} -> {result['queries']:g} queries")
+    return regressions
@@ -0,0 +1,213 @@
+import hashlib
+
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler, TemporaryFileUploadHandler)
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Exists, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from . import filetypes, thumbnails
+from .models import Blob, File
+
+
+# Content-addressed blob store
+#
+# Uploaded bytes are stored once per SHA-256 digest under blobs/. A File row
+# points at its Blob (and shares its storage name in File.file), and the
+# blob's ref_count tracks how many File rows use it. Permanently deleting
+# files goes through delete_files(), which releases references and removes
+# blobs nobody uses any more.
+
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class HashingUploadHandlerMixin:
+    """
+    Hash multipart file uploads as the chunks arrive, so storing them
+    needs no extra pass over the bytes. The digest is set as `.sha256`,
+    and the first bytes, for accounts.filetypes, as `.head`.
+    """
+
+    def new_file(self, *args, **kwargs):
+        # Before super(): MemoryFileUploadHandler raises StopFutureHandlers
+        self.sha256 = hashlib.sha256()
+        self.head = b''
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        if len(self.head) < filetypes.SNIFF_SIZE:
+            self.head += raw_data[:filetypes.SNIFF_SIZE - len(self.head)]
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+            file.head = self.head
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
+
+
+def digest_of(content):
+    """
+    The SHA-256 of a Django File, reusing the upload handler's if present.
+    """
+    digest = getattr(content, 'sha256', None)
+    if digest:
+        return digest
+    sha256 = hashlib.sha256()
+    content.seek(0)
+    for block in content.chunks(HASH_BLOCK_SIZE):
+        sha256.update(block)
+    content.seek(0)
+    return sha256.hexdigest()
+
+
+def blob_name(digest):
+    return f'blobs/{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+def _take_reference(blob):
+    Blob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+    blob.ref_count += 1
+    return blob
+
+
+def store(content, size=None):
+    """
+    Return the Blob for `content` with one more reference, writing the
+    bytes to storage only if this digest has not been seen before.
+    """
+    digest = digest_of(content)
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(digest=digest).first()
+        if blob is not None:
+            return _take_reference(blob)
+
+        storage = Blob._meta.get_field('file').storage
+        name = storage.save(blob_name(digest), content)
+        try:
+            with transaction.atomic():
+                return Blob.objects.create(
+                    digest=digest,
+                    size=content.size if size is None else size,
+                    file=name,
+                    ref_count=1,
+                )
+        except IntegrityError:
+            # Another upload stored the same bytes first
+            storage.delete(name)
+            return _take_reference(Blob.objects.select_for_update().get(digest=digest))
+
+
+def adopt(digest, name, size):
+    """
+    Like store() for bytes already in storage at `name` (a direct upload,
+    see accounts.object_storage) whose digest has been checked. `name`
+    becomes the new Blob's, or is deleted once the transaction commits if
+    the content was already stored under another name.
+    """
+    storage = Blob._meta.get_field('file').storage
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(digest=digest).first()
+        if blob is None:
+            try:
+                with transaction.atomic():
+                    return Blob.objects.create(
+                        digest=digest, size=size, file=name, ref_count=1)
+            except IntegrityError:
+                blob = Blob.objects.select_for_update().get(digest=digest)
+        if name != blob.file.name:
+            transaction.on_commit(lambda: storage.delete(name))
+        return _take_reference(blob)
+
+
+def remove_stored(storage, names, executor=None):
+    """
+    Delete storage objects, concurrently if given a concurrent.futures
+    executor (storage deletes are mostly waiting on disk or network).
+    """
+    if executor is None:
+        for name in names:
+            storage.delete(name)
+    else:
+        list(executor.map(storage.delete, names))
+
+
+def collect(blob_ids=None, executor=None):
+    """
+    Delete unreferenced blobs (all of them, or only among `blob_ids`).
+    Storage objects are removed once the transaction commits.
+    """
+    blobs = Blob.objects.filter(ref_count__lte=0).exclude(
+        Exists(File.objects.filter(blob=OuterRef('pk'))))
+    if blob_ids is not None:
+        blobs = blobs.filter(pk__in=blob_ids)
+    garbage = list(blobs.select_for_update().values_list('pk', 'file'))
+    if not garbage:
+        return 0
+    Blob.objects.filter(pk__in=[pk for pk, _ in garbage]).delete()
+    storage = Blob._meta.get_field('file').storage
+
+    transaction.on_commit(lambda: remove_stored(
+        storage, [name for _, name in garbage], executor))
+    return len(garbage)
+
+
+def delete_files(files, executor=None):
+    """
+    Permanently delete a File queryset, releasing its blob references.
+    """
+    with transaction.atomic():
+        references = list(files.filter(blob__isnull=False).order_by()
+                          .values('blob').annotate(count=Count('id')))
+        thumbnails.discard(files, executor)
+        deleted, _ = files.delete()
+        for row in references:
+            Blob.objects.filter(pk=row['blob']).update(
+                ref_count=F('ref_count') - row['count'])
+        collect([row['blob'] for row in references], executor)
+    return deleted
+
+
+def reconcile():
+    """
+    Reset every ref_count from the File table (e.g. after users were
+    deleted, which cascades to files without releasing blobs), then
+    collect garbage. Returns (recounted, collected).
+    """
+    with transaction.atomic():
+        actual = (File.objects.filter(blob=OuterRef('pk')).order_by()
+                  .values('blob').annotate(count=Count('id')).values('count'))
+        stale = Blob.objects.annotate(
+            actual=Coalesce(Subquery(actual), 0)).exclude(ref_count=F('actual'))
+        recounted = 0
+        for blob in stale.select_for_update():
+            blob.ref_count = blob.actual
+            blob.save(update_fields=['ref_count'])
+            recounted += 1
+        return recounted, collect()
+
+
+def dedupe_stats():
+    """
+    Logical bytes referenced by files against physical bytes stored.
+    """
+    logical = File.objects.filter(blob__isnull=False).aggregate(
+        total=Sum('size'))['total'] or 0
+    physical = Blob.objects.aggregate(total=Sum('size'))['total'] or 0
+    return {
+        'blobs': Blob.objects.count(),
+        'logical_bytes': logical,
+        'physical_bytes': physical,
+        'dedupe_ratio': logical / physical if physical else 1.0,
+    }
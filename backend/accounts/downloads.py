@@ -0,0 +1,273 @@
+import io
+import mimetypes
+import re
+import uuid
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core import signing
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+
+
+# File downloads
+#
+# Files are served by an authenticated view instead of MEDIA_URL. Responses
+# carry an ETag (the blob's SHA-256 where known) and Last-Modified, answer
+# conditional requests with 304, and honour single and multiple byte ranges
+# so media players can seek. Single ranges and whole files go out as a
+# FileResponse, which gunicorn sends with os.sendfile(); with
+# DOWNLOADS["SENDFILE"] set, the front proxy serves the bytes instead
+# (X-Accel-Redirect for nginx, X-Sendfile for Apache/lighttpd).
+
+
+BLOCK_SIZE = 64 * 1024
+MAX_RANGES = 16  # more than this is served as the whole file
+SIGNED_URL_SALT = "accounts.downloads"
+
+RANGE_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def content_type_for(name):
+    content_type, _ = mimetypes.guess_type(name)
+    return content_type or "application/octet-stream"
+
+
+def etag_for(file):
+    if file.blob_id:
+        return quote_etag(file.blob.digest)
+    return quote_etag(f"{file.pk}-{file.size}")
+
+
+def last_modified_for(file):
+    # Stored content never changes, so the upload time is its mtime
+    return int(file.created_at.timestamp())
+
+
+def parse_ranges(header, size):
+    """
+    Parse a `Range: bytes=...` header into sorted, merged (start, end)
+    pairs with inclusive ends. Returns None when the whole file should be
+    served (no header, bad syntax or too many ranges) and raises
+    RangeNotSatisfiable when no range overlaps the file.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    ranges = []
+    specs = header[len("bytes="):].split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+    for spec in specs:
+        match = RANGE_RE.match(spec)
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if first == "":
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+        ranges.append((start, end))
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(request, etag, last_modified):
+    """
+    True if Range should be honoured given the request's If-Range.
+    """
+    value = request.headers.get("If-Range")
+    if not value:
+        return True
+    if value.startswith(('"', 'W/')):
+        return value == etag  # weak tags never match
+    date = parse_http_date_safe(value)
+    return date is not None and date >= last_modified
+
+
+class RangeFile:
+    """
+    A read-only view of bytes [start, end] of an open file. Positions are
+    relative to `start`; fileno() is passed through so servers can still
+    os.sendfile() the range (gunicorn bounds it by Content-Length).
+    """
+
+    def __init__(self, file, start, end):
+        self.file = file
+        self.start = start
+        self.length = end - start + 1
+        self.position = 0
+        self.name = getattr(file, "name", "")
+        file.seek(start)
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.file.read(size) if size else b""
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = min(max(offset, 0), self.length)
+        self.file.seek(self.start + self.position)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def signed_url(file):
+    """
+    A URL that downloads `file` without an Authorization header, e.g. for
+    <video src>. Valid for DOWNLOADS["SIGNED_URL_TTL"] seconds.
+    """
+    token = signing.TimestampSigner(salt=SIGNED_URL_SALT).sign(str(file.pk))
+    return f"{reverse('file_download', args=[file.pk])}?sig={token}"
+
+
+def signature_allows(request, file_id):
+    token = request.GET.get("sig")
+    if not token:
+        return False
+    try:
+        value = signing.TimestampSigner(salt=SIGNED_URL_SALT).unsign(
+            token, max_age=settings.DOWNLOADS["SIGNED_URL_TTL"])
+    except signing.BadSignature:
+        return False
+    return value == str(file_id)
+
+
+def _multipart(file, ranges, size, content_type):
+    boundary = uuid.uuid4().hex
+    heads = [
+        (f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+         f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+        for start, end in ranges
+    ]
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    length = sum(len(head) + end - start + 1 for head, (start, end) in zip(heads, ranges))
+    length += 2 * (len(ranges) - 1) + len(tail)
+
+    def stream():
+        try:
+            for i, (head, (start, end)) in enumerate(zip(heads, ranges)):
+                if i:
+                    yield b"\r\n"
+                yield head
+                file.seek(start)
+                remaining = end - start + 1
+                while remaining:
+                    block = file.read(min(BLOCK_SIZE, remaining))
+                    if not block:
+                        return
+                    remaining -= len(block)
+                    yield block
+            yield tail
+        finally:
+            file.close()
+
+    response = StreamingHttpResponse(
+        stream(), status=206,
+        content_type=f"multipart/byteranges; boundary={boundary}")
+    response["Content-Length"] = length
+    return response
+
+
+def _offload(file, mode):
+    response = HttpResponse(content_type=content_type_for(file.name))
+    if mode == "x-accel-redirect":
+        prefix = settings.DOWNLOADS["ACCEL_PREFIX"].rstrip("/")
+        # nginx decodes the URI, and header values must be ASCII
+        response["X-Accel-Redirect"] = quote(f"{prefix}/{file.file.name}")
+    else:
+        response["X-Sendfile"] = file.file.path
+    return response
+
+
+def serve(request, file, as_attachment=False):
+    """
+    Build the download response for `file`, whose access has been checked.
+    """
+    etag = etag_for(file)
+    last_modified = last_modified_for(file)
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _serve_content(request, file, etag, last_modified)
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+    response["Cache-Control"] = "private, no-cache"
+    if response.status_code in (200, 206):
+        response["Content-Disposition"] = content_disposition_header(
+            as_attachment, file.name)
+    return response
+
+
+def _serve_content(request, file, etag, last_modified):
+    mode = settings.DOWNLOADS["SENDFILE"]
+    if mode:
+        # The proxy handles Range itself
+        return _offload(file, mode)
+
+    size = file.file.size
+    content_type = content_type_for(file.name)
+    ranges = None
+    if if_range_matches(request, etag, last_modified):
+        try:
+            ranges = parse_ranges(request.headers.get("Range"), size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    content = file.file.open("rb")
+    if ranges is None:
+        return FileResponse(content, content_type=content_type)
+    if len(ranges) > 1:
+        return _multipart(content, ranges, size, content_type)
+
+    start, end = ranges[0]
+    response = FileResponse(
+        RangeFile(content, start, end), status=206, content_type=content_type)
+    response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return response
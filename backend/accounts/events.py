@@ -0,0 +1,301 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.urls import reverse
+
+
+# Change push
+#
+# The /events/ endpoint is a Server-Sent Events stream (ASGI only) that
+# tells a user's open sessions when their files and folders change, so
+# they can fetch the delta with the `changes` query (accounts.journal)
+# instead of polling folderContents and dashboardStats. Every journal
+# record publishes, once its transaction commits, one message:
+#
+#   id: <journal cursor>
+#   event: changes
+#   data: {"cursor": "...", "changes": [{"kind", "id", "action"}], "more": false}
+#
+# listing up to EVENTS["MAX_ITEMS"] items ("more" when there were others).
+# Messages are hints: the journal stays the source of truth, which is what
+# keeps every connection's buffer bounded. A connection holds at most
+# EVENTS["BUFFER_SIZE"] messages; when a slow client falls behind they are
+# coalesced into one with the newest cursor and "more", and the client
+# catches up through `changes`. The ASGI server's own flow control stops
+# us from writing faster than the socket drains.
+#
+# Brokers, chosen by EVENTS["BACKEND"]:
+#
+#   "local"  fan-out to the connections of this process; one node only.
+#   "redis"  publish to a Redis (or compatible) channel per user; every
+#            process subscribes to the channels of the users it serves.
+
+
+logger = logging.getLogger(__name__)
+
+SIGNED_URL_SALT = "accounts.events"
+CHANNEL_PREFIX = "cryogena:events:"
+
+
+class EventError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def message_for(cursor, changes):
+    """
+    The message for journal entries up to `cursor`, changes being
+    (kind, id, action) tuples.
+    """
+    limit = settings.EVENTS["MAX_ITEMS"]
+    return {
+        "cursor": cursor,
+        "changes": [{"kind": kind, "id": str(pk), "action": action}
+                    for kind, pk, action in changes[:limit]],
+        "more": len(changes) > limit,
+    }
+
+
+class Subscription:
+    """
+    One connection's bounded queue. put() may be called from any thread;
+    get() runs on the connection's event loop.
+    """
+
+    def __init__(self, user_id, size):
+        self.user_id = user_id
+        self.size = size
+        self.loop = asyncio.get_running_loop()
+        self.messages = deque()
+        self.ready = asyncio.Event()
+        self.coalesced = 0
+
+    def _put(self, message):
+        if len(self.messages) >= self.size:
+            # Too far behind: the newest cursor covers everything dropped
+            self.coalesced += len(self.messages)
+            self.messages.clear()
+            message = {**message, "changes": [], "more": True}
+        self.messages.append(message)
+        self.ready.set()
+
+    def put(self, message):
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            pass  # the loop is gone, and with it the connection
+
+    async def get(self, timeout):
+        """
+        The next message, or None after `timeout` seconds without one.
+        """
+        if not self.messages:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.messages.popleft()
+
+
+class LocalBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}  # user id -> set of Subscription
+
+    def connections(self, user_id):
+        with self.lock:
+            return len(self.subscriptions.get(user_id, ()))
+
+    async def subscribe(self, user_id):
+        config = settings.EVENTS
+        subscription = Subscription(user_id, config["BUFFER_SIZE"])
+        with self.lock:
+            current = self.subscriptions.setdefault(user_id, set())
+            if len(current) >= config["MAX_CONNECTIONS"]:
+                raise EventError("Too many open event streams", status=429)
+            current.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Forget `subscription`. Returns True if it was the user's last one.
+        """
+        with self.lock:
+            current = self.subscriptions.get(subscription.user_id, set())
+            current.discard(subscription)
+            if current:
+                return False
+            self.subscriptions.pop(subscription.user_id, None)
+            return True
+
+    def deliver(self, user_id, message):
+        with self.lock:
+            targets = list(self.subscriptions.get(user_id, ()))
+        for subscription in targets:
+            subscription.put(message)
+
+    def publish(self, user_id, message):
+        self.deliver(user_id, message)
+
+
+class RedisBroker(LocalBroker):
+    """
+    LocalBroker whose messages go through Redis pub/sub, so they reach the
+    user's connections on every node.
+    """
+
+    def __init__(self, url, client=None, async_client=None):
+        super().__init__()
+        if client is None or async_client is None:
+            import redis
+            import redis.asyncio
+
+            client = client or redis.Redis.from_url(url)
+            async_client = async_client or redis.asyncio.Redis.from_url(url)
+        self.client = client
+        self.async_client = async_client
+        self.pubsub = None
+        self.listener = None
+        self.channels = set()  # user ids subscribed to in Redis
+        self.channels_lock = None
+
+    def publish(self, user_id, message):
+        self.client.publish(f"{CHANNEL_PREFIX}{user_id}", json.dumps(message))
+
+    async def subscribe(self, user_id):
+        subscription = await super().subscribe(user_id)
+        if self.pubsub is None:
+            self.pubsub = self.async_client.pubsub(ignore_subscribe_messages=True)
+            self.channels_lock = asyncio.Lock()
+        try:
+            async with self.channels_lock:
+                if user_id not in self.channels:
+                    await self.pubsub.subscribe(f"{CHANNEL_PREFIX}{user_id}")
+                    self.channels.add(user_id)
+        except BaseException:
+            super().unsubscribe(subscription)
+            raise
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.get_running_loop().create_task(self.listen())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        last = super().unsubscribe(subscription)
+        if last and self.pubsub is not None:
+            subscription.loop.create_task(self.drop_channel(subscription.user_id))
+        return last
+
+    async def drop_channel(self, user_id):
+        async with self.channels_lock:
+            # Unless a new connection came in meanwhile
+            if user_id in self.channels and not self.connections(user_id):
+                await self.pubsub.unsubscribe(f"{CHANNEL_PREFIX}{user_id}")
+                self.channels.discard(user_id)
+
+    async def listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except Exception:
+                logger.exception("Event subscription failed")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                if not self.pubsub.subscribed:
+                    await asyncio.sleep(0.1)  # nothing to read until a subscribe
+                continue
+            channel = message["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            self.deliver(int(channel[len(CHANNEL_PREFIX):]), json.loads(message["data"]))
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker():
+    config = settings.EVENTS
+    key = (config["BACKEND"], config["REDIS_URL"] if config["BACKEND"] == "redis" else None)
+    with _brokers_lock:
+        if key not in _brokers:
+            if config["BACKEND"] == "redis":
+                _brokers[key] = RedisBroker(config["REDIS_URL"])
+            else:
+                _brokers[key] = LocalBroker()
+        return _brokers[key]
+
+
+def publish_on_commit(user_id, cursor, changes):
+    """
+    Publish the message for new journal entries once the transaction
+    commits. A broker failure is logged, never raised into the request.
+    """
+    message = message_for(cursor, changes)
+    transaction.on_commit(lambda: get_broker().publish(user_id, message), robust=True)
+
+
+def signed_url(user):
+    """
+    A URL that opens the user's stream without an Authorization header
+    (EventSource cannot send one). Valid for EVENTS["SIGNED_URL_TTL"] seconds
+    and until the user's tokens are revoked.
+    """
+    token = signing.dumps({"u": user.pk, "v": user.token_version}, salt=SIGNED_URL_SALT)
+    return f"{reverse('event_stream')}?sig={token}"
+
+
+def unsign(token):
+    """
+    (user id, token version) from a signed URL's token, or None if it is
+    invalid or expired.
+    """
+    try:
+        value = signing.loads(
+            token, salt=SIGNED_URL_SALT, max_age=settings.EVENTS["SIGNED_URL_TTL"])
+    except signing.BadSignature:
+        return None
+    return value["u"], value.get("v")
+
+
+def _format(message):
+    return (f"id: {message['cursor']}\nevent: changes\n"
+            f"data: {json.dumps(message, separators=(',', ':'))}\n\n").encode()
+
+
+async def stream(broker, subscription, first=None):
+    """
+    Yield the SSE stream of `subscription` until the client goes away or
+    EVENTS["MAX_AGE"] runs out (clients reconnect on their own).
+    """
+    config = settings.EVENTS
+    deadline = time.monotonic() + config["MAX_AGE"]
+    try:
+        yield f"retry: {config['RETRY_MS']}\n\n".encode()
+        if first is not None:
+            yield _format(first)
+        while time.monotonic() < deadline:
+            message = await subscription.get(
+                min(config["HEARTBEAT"], max(deadline - time.monotonic(), 0)))
+            # A comment line keeps proxies from closing an idle stream
+            yield b": keepalive\n\n" if message is None else _format(message)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def response(broker, subscription, first=None):
+    response = StreamingHttpResponse(
+        stream(broker, subscription, first), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache, no-store"
+    response["X-Accel-Buffering"] = "no"
+    return response
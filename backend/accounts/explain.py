@@ -0,0 +1,120 @@
+import json
+import re
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import connections, transaction
+
+
+# Query plan checks
+#
+# capture() records the SQL run inside a block and explain() asks the
+# database how it would run each statement, so tests can assert that the
+# hot resolvers stay on their indexes: no sequential scan of our tables and
+# no sort the index order should have provided. SQLite and PostgreSQL are
+# supported. PostgreSQL plans are taken with enable_seqscan off, since on
+# small test tables a scan is cheaper and would hide a missing index; a
+# sequential scan that still shows up means no index applies.
+
+
+SQLITE_SCAN_RE = re.compile(r"^SCAN (\w+)")
+
+
+class Plan:
+    def __init__(self, sql, lines, scans, sorts):
+        self.sql = sql
+        self.lines = lines
+        self.scans = scans  # tables read in full
+        self.sorts = sorts  # sorts done outside an index
+
+    def __str__(self):
+        return "\n".join([self.sql, *self.lines])
+
+
+def app_tables():
+    return {model._meta.db_table for model in apps.get_app_config("accounts").get_models()}
+
+
+@contextmanager
+def capture(using="default"):
+    """
+    Collect the (sql, params) of every statement run in the block.
+    """
+    statements = []
+
+    def record(execute, sql, params, many, context):
+        if not many:
+            statements.append((sql, params))
+        return execute(sql, params, many, context)
+
+    with connections[using].execute_wrapper(record):
+        yield statements
+
+
+def _sqlite_plan(cursor, sql, params):
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    lines = [row[-1] for row in cursor.fetchall()]
+    scans = set()
+    for line in lines:
+        match = SQLITE_SCAN_RE.match(line)
+        if match:
+            scans.add(match.group(1))
+    sorts = sum("USE TEMP B-TREE FOR ORDER BY" in line for line in lines)
+    return lines, scans, sorts
+
+
+def _walk(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _walk(child)
+
+
+def _postgresql_plan(cursor, sql, params):
+    with transaction.atomic(using=cursor.db.alias):
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes = list(_walk(plan[0]["Plan"]))
+    lines = [
+        f'{node["Node Type"]} {node.get("Relation Name", "")}'.strip() for node in nodes]
+    scans = {node["Relation Name"] for node in nodes if node["Node Type"] == "Seq Scan"}
+    sorts = sum(node["Node Type"] in ("Sort", "Incremental Sort") for node in nodes)
+    return lines, scans, sorts
+
+
+PLANNERS = {
+    "sqlite": _sqlite_plan,
+    "postgresql": _postgresql_plan,
+}
+
+
+def supported(using="default"):
+    return connections[using].vendor in PLANNERS
+
+
+def explain(sql, params, using="default"):
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        lines, scans, sorts = PLANNERS[connection.vendor](cursor, sql, params)
+    return Plan(sql, lines, scans, sorts)
+
+
+def problems(statements, tables=None, allow_sort=False, using="default"):
+    """
+    Explain `statements` from capture() and describe every full scan of
+    `tables` (default: this app's) and, unless allowed, every extra sort.
+    """
+    tables = app_tables() if tables is None else tables
+    found = []
+    for sql, params in statements:
+        if not sql.lstrip().upper().startswith("SELECT"):
+            continue
+        plan = explain(sql, params, using)
+        scanned = plan.scans & tables
+        if scanned:
+            found.append(f"Full scan of {', '.join(sorted(scanned))}:\n{plan}")
+        if plan.sorts and not allow_sort:
+            found.append(f"Sort outside an index:\n{plan}")
+    return found
@@ -0,0 +1,316 @@
+import mimetypes
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from . import journal, object_storage, thumbnails, usage
+from .models import CustomUser, File
+
+
+# File classification
+#
+# classify() decides a file's MIME type from its first bytes (the "head",
+# SNIFF_SIZE bytes captured from the first chunk of the upload stream, see
+# accounts.blobs) and falls back to the name's extension only when the
+# content says nothing. The extension still refines what the bytes cannot
+# tell apart: which kind of ZIP or OLE2 container, which kind of text.
+# The MIME type then maps to the category stored as File.file_type, first
+# match wins: FILE_TYPE_CATEGORIES from settings, then CATEGORIES below.
+# Patterns are exact types or "type/*".
+#
+# Files stored before sniffing have an empty mime_type; backfill() (the
+# classify_files command) reads their first bytes back from storage and
+# reclassifies them, moving the usage counters along.
+
+
+SNIFF_SIZE = 8 * 1024
+DEFAULT_MIME_TYPE = "application/octet-stream"
+OTHER = "other"
+
+CATEGORIES = [
+    ("application/pdf", "pdf"),
+    ("audio/mpeg", "mp3"),
+    ("image/*", "image"),
+    ("video/*", "video"),
+    ("audio/*", "audio"),
+    ("application/msword", "doc"),
+    ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "doc"),
+    ("application/vnd.oasis.opendocument.text", "doc"),
+    ("application/rtf", "doc"),
+    ("application/vnd.ms-excel", "spreadsheet"),
+    ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "spreadsheet"),
+    ("application/vnd.oasis.opendocument.spreadsheet", "spreadsheet"),
+    ("text/csv", "spreadsheet"),
+    ("application/vnd.ms-powerpoint", "presentation"),
+    ("application/vnd.openxmlformats-officedocument.presentationml.presentation",
+     "presentation"),
+    ("application/vnd.oasis.opendocument.presentation", "presentation"),
+    ("application/epub+zip", "ebook"),
+    ("application/zip", "archive"),
+    ("application/gzip", "archive"),
+    ("application/x-tar", "archive"),
+    ("application/x-bzip2", "archive"),
+    ("application/x-7z-compressed", "archive"),
+    ("application/vnd.rar", "archive"),
+    ("text/*", "text"),
+    ("application/json", "text"),
+    ("application/xml", "text"),
+    ("application/javascript", "text"),
+]
+
+# Containers whose content alone does not say what they hold
+ZIP = "application/zip"
+OLE2 = "application/x-ole-storage"
+CONTAINED = {
+    ZIP: {
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+        "application/vnd.oasis.opendocument.text",
+        "application/vnd.oasis.opendocument.spreadsheet",
+        "application/vnd.oasis.opendocument.presentation",
+        "application/epub+zip",
+    },
+    OLE2: {"application/msword", "application/vnd.ms-excel", "application/vnd.ms-powerpoint"},
+}
+
+# Extensions the mimetypes module may not know
+EXTENSIONS = {
+    ".heic": "image/heic",
+    ".heif": "image/heif",
+    ".avif": "image/avif",
+    ".webp": "image/webp",
+    ".md": "text/markdown",
+    ".flac": "audio/flac",
+    ".m4a": "audio/mp4",
+    ".mkv": "video/x-matroska",
+    ".7z": "application/x-7z-compressed",
+    ".rar": "application/vnd.rar",
+    ".epub": "application/epub+zip",
+}
+
+# (offset, magic, MIME type), checked in order
+SIGNATURES = [
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (0, b"\x00\x00\x01\x00", "image/vnd.microsoft.icon"),
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"FLV\x01", "video/x-flv"),
+    (0, b"\x00\x00\x01\xba", "video/mpeg"),
+    (0, b"\x00\x00\x01\xb3", "video/mpeg"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", OLE2),
+    (0, b"{\\rtf", "application/rtf"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (0, b"Rar!\x1a\x07", "application/vnd.rar"),
+    (257, b"ustar", "application/x-tar"),
+]
+
+RIFF_TYPES = {b"WEBP": "image/webp", b"WAVE": "audio/wav", b"AVI ": "video/x-msvideo"}
+FTYP_BRANDS = {
+    b"heic": "image/heic", b"heix": "image/heic", b"mif1": "image/heif",
+    b"avif": "image/avif", b"M4A ": "audio/mp4", b"qt  ": "video/quicktime",
+    b"3gp4": "video/3gpp", b"3gp5": "video/3gpp",
+}
+
+# Types that sniff() recognizes when the bytes are right
+SIGNED_TYPES = {
+    *(mime for _, _, mime in SIGNATURES), *RIFF_TYPES.values(), *FTYP_BRANDS.values(),
+    *CONTAINED[ZIP], *CONTAINED[OLE2], ZIP, "video/mp4", "video/webm", "video/x-matroska",
+    "image/bmp", "application/x-bzip2",
+}
+
+
+def _sniff_zip(head):
+    # ODF and EPUB start with an uncompressed "mimetype" entry
+    if head[30:38] == b"mimetype":
+        end = head.find(b"PK", 38)
+        mime = head[38:end if end > 0 else 38 + 100].decode("ascii", "ignore").strip()
+        return mime or ZIP
+    # OOXML entries are named after the document kind
+    for marker, mime in (
+            (b"word/", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+            (b"xl/", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+            (b"ppt/",
+             "application/vnd.openxmlformats-officedocument.presentationml.presentation")):
+        if marker in head:
+            return mime
+    return ZIP
+
+
+def _sniff_text(head):
+    if b"\x00" in head:
+        return None
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # Unless a multi-byte character was cut off at the end of the head
+        if e.start < len(head) - 3:
+            return None
+    start = head.lstrip()[:256].lower()
+    if start.startswith(b"<?xml"):
+        return "image/svg+xml" if b"<svg" in head[:1024].lower() else "application/xml"
+    if start.startswith(b"<svg"):
+        return "image/svg+xml"
+    if start.startswith((b"<!doctype html", b"<html")):
+        return "text/html"
+    return "text/plain"
+
+
+def sniff(head):
+    """
+    The MIME type the file's first bytes show, or None.
+    """
+    if not head:
+        return None
+    if head[4:8] == b"ftyp":
+        return FTYP_BRANDS.get(head[8:12], "video/mp4")
+    for offset, magic, mime in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return mime
+    if head[:4] == b"RIFF":
+        return RIFF_TYPES.get(head[8:12])
+    if head[:4] == b"\x1aE\xdf\xa3":
+        return "video/webm" if b"webm" in head[:64] else "video/x-matroska"
+    if head[:4] == b"PK\x03\x04":
+        return _sniff_zip(head)
+    if head[:2] == b"BM" and head[6:10] == b"\x00\x00\x00\x00" and len(head) > 26:
+        return "image/bmp"
+    if head[:3] == b"BZh" and head[3:4].isdigit():
+        return "application/x-bzip2"
+    if head[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return "text/plain"  # UTF-16, whose BOM looks like an MPEG frame sync
+    if len(head) > 1 and head[0] == 0xFF:
+        if head[1] in (0xF1, 0xF9):
+            return "audio/aac"
+        if head[1] & 0xE0 == 0xE0:
+            return "audio/mpeg"
+    return _sniff_text(head)
+
+
+def guess_from_name(name):
+    extension = "." + name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    if extension in EXTENSIONS:
+        return EXTENSIONS[extension]
+    mime, _ = mimetypes.guess_type(name, strict=False)
+    return mime
+
+
+def _table():
+    return [*settings.FILE_TYPE_CATEGORIES.items(), *CATEGORIES]
+
+
+def category_for(mime):
+    for pattern, category in _table():
+        if pattern == mime or (pattern.endswith("/*") and mime.startswith(pattern[:-1])):
+            return category
+    return OTHER
+
+
+def categories():
+    """
+    Every category, in table order, then "other".
+    """
+    return list(dict.fromkeys([*(category for _, category in _table()), OTHER]))
+
+
+def classify(name, head=None):
+    """
+    (MIME type, category) for a file called `name` starting with `head`.
+    """
+    sniffed = sniff(head)
+    named = guess_from_name(name)
+    if sniffed in CONTAINED and named in CONTAINED[sniffed]:
+        mime = named
+    elif sniffed == "text/plain" and named and named not in SIGNED_TYPES:
+        # Text is told apart by the name, unless it names a type whose
+        # signature is missing
+        mime = named
+    else:
+        mime = sniffed or named
+    if mime in (None, OLE2):
+        mime = "application/msword" if mime == OLE2 else DEFAULT_MIME_TYPE
+    return mime, category_for(mime)
+
+
+def head_of(content):
+    """
+    The first SNIFF_SIZE bytes of a Django File, reusing the upload
+    handler's if present.
+    """
+    head = getattr(content, "head", None)
+    if head is not None:
+        return head
+    content.seek(0)
+    head = content.read(SNIFF_SIZE)
+    content.seek(0)
+    return head
+
+
+def file_type_for(filename):
+    """
+    The category for a name alone, when the content is not at hand.
+    """
+    return classify(filename)[1]
+
+
+def _reclassify(batch):
+    changed = []
+    for file in batch:
+        head = None
+        if file.file:
+            head = object_storage.get_store().read_head(
+                file.file.name, min(SNIFF_SIZE, file.size))
+        mime_type, file_type = classify(file.name, head)
+        if (mime_type, file_type) != (file.mime_type, file.file_type):
+            changed.append((file, file.file_type))
+            file.mime_type, file.file_type = mime_type, file_type
+    return changed
+
+
+def backfill(batch_size=500, everything=False):
+    """
+    Classify stored files by content: those never sniffed, or with
+    `everything` all of them. Returns the number of files updated.
+    """
+    files = File.objects.only(
+        "id", "owner_id", "name", "size", "file", "file_type", "mime_type", "is_deleted"
+    ).order_by("id")
+    if not everything:
+        files = files.filter(mime_type="")
+    updated = 0
+    last_id = 0
+    while True:
+        batch = list(files.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return updated
+        last_id = batch[-1].id
+        changed = _reclassify(batch)
+        if not changed:
+            continue
+        # Live files move between categories in the counters
+        removed, added = defaultdict(list), defaultdict(list)
+        for file, old_type in changed:
+            if not file.is_deleted and file.file_type != old_type:
+                removed[file.owner_id].append({old_type: (1, file.size)})
+                added[file.owner_id].append({file.file_type: (1, file.size)})
+        with transaction.atomic():
+            File.objects.bulk_update(
+                [file for file, _ in changed], ["mime_type", "file_type"])
+            for owner in CustomUser.objects.filter(id__in=list(added)):
+                usage.apply_file_totals(owner, usage.merge_totals(*removed[owner.pk]), -1)
+                usage.apply_file_totals(owner, usage.merge_totals(*added[owner.pk]))
+            for owner_id in {file.owner_id for file, _ in changed}:
+                journal.record(owner_id, "update",
+                               files=[file.pk for file, _ in changed if file.owner_id == owner_id])
+            thumbnails.enqueue([file for file, old_type in changed
+                                if file.file_type != old_type])
+        updated += len(changed)
@@ -0,0 +1,312 @@
+from inspect import isawaitable
+
+from asgiref.sync import sync_to_async
+from django.db import connection, transaction
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.http.response import HttpResponseBadRequest
+from graphene.types.resolver import attr_resolver, dict_or_attr_resolver, dict_resolver
+from graphene_django import DjangoObjectType
+from graphene_django.constants import MUTATION_ERRORS_FLAG
+from graphene_django.settings import graphene_settings
+from graphene_django.views import HttpError
+from graphene_file_upload.django import FileUploadGraphQLView
+from graphql import (
+    ExecutionResult, GraphQLError, OperationType, execute, get_operation_ast, parse)
+from graphql.validation import validate
+
+from . import limits, persisted, profiling, result_cache
+
+
+class PreparedOperation:
+    """
+    A validated operation within the limits, ready to execute.
+    """
+
+    def __init__(self, document, operation_ast, variables, operation_name, cost, cache_key):
+        self.document = document
+        self.operation_ast = operation_ast
+        self.variables = variables
+        self.operation_name = operation_name
+        self.cost = cost
+        self.cache_key = cache_key
+
+
+class GraphQLView(FileUploadGraphQLView):
+    """
+    The /graphql/ endpoint: FileUploadGraphQLView with persisted, cached
+    documents (accounts.persisted), query cost, depth and rate limits
+    (accounts.limits) and the result cache (accounts.result_cache). The
+    computed cost is returned in the response's `extensions`.
+    """
+
+    def get_document(self, query, sent_hash=None):
+        """
+        The validated document for `query` or a persisted query hash.
+        Returns (key, document, errors), `key` being the query's hash.
+        """
+        key, query = persisted.lookup(query, sent_hash)
+        document = persisted.documents.get(key)
+        if document is not None:
+            return key, document, []
+        if query is None:
+            raise persisted.PersistedQueryNotFound()
+
+        try:
+            document = parse(query)
+        except Exception as e:
+            return key, None, [e]
+        errors = validate(
+            self.schema.graphql_schema, document, self.validation_rules,
+            graphene_settings.MAX_VALIDATION_ERRORS)
+        if not errors:
+            persisted.documents.set(key, document)
+        return key, document, errors
+
+    @staticmethod
+    def get_extensions(request, data):
+        return request.GET.get("extensions") or data.get("extensions")
+
+    def dispatch(self, request, *args, **kwargs):
+        with profiling.profile_request():
+            return self.add_headers(request, super().dispatch(request, *args, **kwargs))
+
+    @staticmethod
+    def add_headers(request, response):
+        retry_after = getattr(request, "graphql_retry_after", None)
+        if retry_after is not None:
+            response["Retry-After"] = str(retry_after)
+        profiling.finish(request, response)
+        return response
+
+    def prepare(self, request, data, query, variables, operation_name, show_graphiql=False):
+        """
+        Everything before execution. Returns a PreparedOperation, or the
+        ExecutionResult (None for GraphiQL) to answer with instead.
+        """
+        try:
+            sent_hash = persisted.persisted_hash(self.get_extensions(request, data))
+            if not query and not sent_hash:
+                if show_graphiql:
+                    return None
+                raise HttpError(HttpResponseBadRequest("Must provide query string."))
+            key, document, errors = self.get_document(query, sent_hash)
+        except persisted.PersistedQueryNotFound as e:
+            # Clients retry with the query text on a normal 200 response
+            request.graphql_status = 200
+            return ExecutionResult(data=None, errors=[e])
+        except GraphQLError as e:
+            return ExecutionResult(data=None, errors=[e])
+        if errors:
+            return ExecutionResult(data=None, errors=errors)
+
+        operation_ast = get_operation_ast(document, operation_name)
+        if operation_ast is None:
+            return ExecutionResult(data=None, errors=[
+                GraphQLError("Unknown or ambiguous operation")])
+        if (request.method.lower() == "get"
+                and operation_ast.operation != OperationType.QUERY):
+            if show_graphiql:
+                return None
+            raise HttpError(HttpResponseNotAllowed(
+                ["POST"],
+                f"Can only perform a {operation_ast.operation.value} operation "
+                "from a POST request."))
+
+        try:
+            cost = limits.check(
+                request, self.schema.graphql_schema, document, operation_ast, variables)
+        except limits.LimitExceeded as e:
+            request.graphql_status = e.status
+            if e.status == 429:
+                request.graphql_retry_after = e.extensions["retryAfter"]
+            return ExecutionResult(data=None, errors=[e])
+
+        cache_key = result_cache.key_for(
+            request, operation_ast, key, variables, operation_name)
+        if cache_key is not None:
+            data = result_cache.load(cache_key)
+            if data is not None:
+                return ExecutionResult(data=data, extensions={"cost": cost, "cache": "hit"})
+        return PreparedOperation(
+            document, operation_ast, variables, operation_name, cost, cache_key)
+
+    def finish(self, request, operation, result):
+        """
+        Cache or invalidate after execution and add the extensions.
+        """
+        extensions = {"cost": operation.cost}
+        if operation.cache_key is not None:
+            extensions["cache"] = "miss"
+            if not result.errors:
+                result_cache.store(operation.cache_key, result.data)
+        if (operation.operation_ast.operation == OperationType.MUTATION
+                and request.user.is_authenticated):
+            result_cache.invalidate(request.user.pk)
+        result.extensions = {**(result.extensions or {}), **extensions}
+        return result
+
+    def execute_graphql_request(
+        self, request, data, query, variables, operation_name, show_graphiql=False
+    ):
+        # Set when AsyncGraphQLView has executed already and only encodes here
+        result = getattr(request, "graphql_result", None)
+        if result is None:
+            result = self.prepare(
+                request, data, query, variables, operation_name, show_graphiql)
+            if isinstance(result, PreparedOperation):
+                result = self.finish(request, result, self.execute_document(request, result))
+        request.graphql_extensions = getattr(result, "extensions", None) or {}
+        return result
+
+    def execute_options(self, request, operation):
+        options = {
+            "root_value": self.get_root_value(request),
+            "context_value": self.get_context(request),
+            "variable_values": operation.variables,
+            "operation_name": operation.operation_name,
+            "middleware": self.get_middleware(request),
+        }
+        if self.execution_context_class:
+            options["execution_context_class"] = self.execution_context_class
+        return options
+
+    def execute_document(self, request, operation):
+        schema = self.schema.graphql_schema
+        options = self.execute_options(request, operation)
+        try:
+            if (operation.operation_ast.operation == OperationType.MUTATION
+                    and (graphene_settings.ATOMIC_MUTATIONS is True
+                         or connection.settings_dict.get("ATOMIC_MUTATIONS", False) is True)):
+                with transaction.atomic():
+                    result = execute(schema, operation.document, **options)
+                    if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+                        transaction.set_rollback(True)
+                return result
+            return execute(schema, operation.document, **options)
+        except Exception as e:
+            return ExecutionResult(errors=[e])
+
+    def get_response(self, request, data, show_graphiql=False):
+        body, status_code = super().get_response(request, data, show_graphiql)
+        if status_code == 400:
+            # Persisted query misses (200) and limits (413, 429)
+            status_code = getattr(request, "graphql_status", 400)
+        return body, status_code
+
+    def json_encode(self, request, d, pretty=False):
+        # Only the result's errors and data are encoded by get_response()
+        extensions = getattr(request, "graphql_extensions", None)
+        if extensions is not None:
+            extensions = dict(extensions)
+            profile = profiling.extension()
+            if profile is not None:
+                extensions["profile"] = profile
+            if extensions:
+                d = {**d, "extensions": extensions}
+        return super().json_encode(request, d, pretty)
+
+
+# Async execution
+#
+# Under ASGI the same pipeline runs without holding a thread per request:
+# token auth, multipart parsing (which reads and hashes uploads) and the
+# pre/post steps above go to a thread through sync_to_async, execution runs
+# on the event loop. Hot Query fields have native resolvers using the async
+# ORM (accounts.schema.ASYNC_RESOLVERS); other resolvers that may touch the
+# database run through sync_to_async, plain attribute resolvers inline.
+
+
+INLINE_RESOLVERS = {
+    dict_or_attr_resolver, attr_resolver, dict_resolver, DjangoObjectType.resolve_id,
+}
+
+
+def runs_inline(field):
+    resolve = field.resolve
+    if resolve is None:
+        return True
+    # Default resolvers are partials of the functions above
+    return getattr(resolve, "func", resolve) in INLINE_RESOLVERS
+
+
+class AsyncResolverMiddleware:
+    """
+    Graphene middleware making every field safe to resolve on the event loop.
+    """
+
+    def __init__(self, async_resolvers):
+        self.async_resolvers = async_resolvers
+
+    def resolve(self, next, root, info, **args):
+        resolver = self.async_resolvers.get((info.parent_type.name, info.field_name))
+        if resolver is not None:
+            return resolver(root, info, **args)
+        # __typename and introspection are not in `fields` and never touch
+        # the database
+        field = info.parent_type.fields.get(info.field_name)
+        if field is None or runs_inline(field):
+            return next(root, info, **args)
+        return sync_to_async(next)(root, info, **args)
+
+
+class AsyncGraphQLView(GraphQLView):
+    """
+    GraphQLView as a native async view for ASGI deployments. Batching and
+    ATOMIC_MUTATIONS are not supported.
+    """
+
+    # Makes as_view() return a coroutine function
+    view_is_async = True
+
+    def get_middleware(self, request):
+        from .schema import ASYNC_RESOLVERS
+
+        # Innermost, so the other middleware still sees every field
+        middleware = list(super().get_middleware(request) or [])
+        return [AsyncResolverMiddleware(ASYNC_RESOLVERS), *middleware]
+
+    async def dispatch(self, request, *args, **kwargs):
+        with profiling.profile_request():
+            return await self.dispatch_async(request, *args, **kwargs)
+
+    async def dispatch_async(self, request, *args, **kwargs):
+        try:
+            if request.method.lower() not in ("get", "post"):
+                raise HttpError(HttpResponseNotAllowed(
+                    ["GET", "POST"], "GraphQL only supports GET and POST requests."))
+            data = await sync_to_async(self.parse_body)(request)
+            if self.graphiql and self.can_display_graphiql(request, data):
+                return await sync_to_async(GraphQLView.dispatch)(
+                    self, request, *args, **kwargs)
+            result, status_code = await self.get_response_async(request, data)
+            response = HttpResponse(
+                status=status_code, content=result, content_type="application/json")
+        except HttpError as e:
+            response = e.response
+            response["Content-Type"] = "application/json"
+            response.content = self.json_encode(
+                request, {"errors": [self.format_error(e)]})
+        return self.add_headers(request, response)
+
+    async def get_response_async(self, request, data):
+        query, variables, operation_name, _ = self.get_graphql_params(request, data)
+        # Also resolves the lazy request.user (a query) off the event loop
+        result = await sync_to_async(self.prepare)(
+            request, data, query, variables, operation_name)
+        if isinstance(result, PreparedOperation):
+            operation = result
+            result = await self.execute_document_async(request, operation)
+            result = await sync_to_async(self.finish)(request, operation, result)
+        request.graphql_result = result
+        return self.get_response(request, data)
+
+    async def execute_document_async(self, request, operation):
+        try:
+            result = execute(
+                self.schema.graphql_schema, operation.document,
+                **self.execute_options(request, operation))
+            if isawaitable(result):
+                result = await result
+            return result
+        except Exception as e:
+            return ExecutionResult(errors=[e])
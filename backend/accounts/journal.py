@@ -0,0 +1,204 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from . import events, result_cache
+from .models import Change, ChangeSequence, File, Folder
+
+
+# Change journal
+#
+# Every create, rename, move, delete (to the bin), restore and purge of a
+# File or Folder adds a Change (and reclassification by accounts.filetypes
+# an "update"), so sync clients can ask what changed since their cursor
+# (the `changes` query) instead of listing everything again. Subtree
+# operations add one entry per item they touch.
+#
+# Entries are numbered per owner: record() bumps the owner's ChangeSequence,
+# which keeps its row locked until the transaction commits, so an owner's
+# entries commit in `seq` order and a cursor never skips one still in
+# flight. Callers record last in their transaction, after the usage
+# counters, so the locks are always taken in the same order.
+#
+# An entry only names the item and the feed returns the item's current
+# row, so only the latest entry per item is needed. compact() deletes the
+# superseded ones, then everything older than JOURNAL["RETENTION_DAYS"],
+# raising the owner's floor: a cursor below it gets `resync` and the
+# client lists everything again.
+#
+# Each record() is also pushed to the owner's open event streams once it
+# commits, see accounts.events.
+
+
+class Delta:
+    """
+    The latest change to one item within a page, with its current row
+    (None once purged).
+    """
+
+    __slots__ = ("seq", "kind", "id", "action", "item")
+
+    def __init__(self, seq, kind, id, action, item=None):
+        self.seq = seq
+        self.kind = kind
+        self.id = id
+        self.action = action
+        self.item = item
+
+    @property
+    def deleted(self):
+        return self.item is None or self.item.is_deleted
+
+    @property
+    def parent_id(self):
+        if self.item is None:
+            return None
+        return self.item.folder_id if self.kind == "file" else self.item.parent_id
+
+
+class Feed:
+    def __init__(self, deltas, cursor, has_more=False, resync=False):
+        self.deltas = deltas
+        self.cursor = cursor
+        self.has_more = has_more
+        self.resync = resync
+
+
+def encode_cursor(seq):
+    return str(seq)
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return 0
+    try:
+        seq = int(cursor)
+    except ValueError:
+        raise Exception("Invalid cursor")
+    if seq < 0:
+        raise Exception("Invalid cursor")
+    return seq
+
+
+def _allocate(owner_id, count):
+    """
+    Reserve `count` sequence numbers for the owner. Returns the last one.
+    """
+    sequences = ChangeSequence.objects.filter(owner_id=owner_id)
+    if not sequences.update(last_seq=F("last_seq") + count):
+        # New accounts start with the whole history in the journal
+        ChangeSequence.objects.bulk_create(
+            [ChangeSequence(owner_id=owner_id)], ignore_conflicts=True)
+        sequences.update(last_seq=F("last_seq") + count)
+    return sequences.values_list("last_seq", flat=True).get()
+
+
+def head(owner_id):
+    """
+    The cursor of the owner's latest change.
+    """
+    return encode_cursor(ChangeSequence.objects.filter(owner_id=owner_id)
+                         .values_list("last_seq", flat=True).first() or 0)
+
+
+def record(owner_id, action, files=(), folders=()):
+    """
+    Journal `action` for the given File and Folder ids of one owner.
+    """
+    items = [("file", pk) for pk in files] + [("folder", pk) for pk in folders]
+    if not items:
+        return
+    with transaction.atomic():
+        last = _allocate(owner_id, len(items))
+        first = last - len(items) + 1
+        Change.objects.bulk_create([
+            Change(owner_id=owner_id, seq=first + i, kind=kind, item_id=pk, action=action)
+            for i, (kind, pk) in enumerate(items)
+        ])
+        # Registered first, so on commit cached results go stale before
+        # clients are told to refetch them
+        result_cache.invalidate(owner_id)
+        events.publish_on_commit(
+            owner_id, encode_cursor(last), [(kind, pk, action) for kind, pk in items])
+
+
+def changes(user, since=None, limit=None):
+    """
+    The Feed of `user`'s changes after the cursor `since`: at most `limit`
+    entries, reduced to the latest per item.
+    """
+    config = settings.JOURNAL
+    if limit is None:
+        limit = config["DEFAULT_LIMIT"]
+    if limit < 1:
+        raise Exception("limit must be a positive number")
+    limit = min(limit, config["MAX_LIMIT"])
+    after = decode_cursor(since)
+
+    rows = list(Change.objects.filter(owner=user, seq__gt=after).order_by("seq")
+                .values_list("seq", "kind", "item_id", "action")[:limit + 1])
+    # Read after the rows: compaction that could have removed any of them
+    # has raised the floor by now
+    last_seq, floor = (ChangeSequence.objects.filter(owner=user)
+                       .values_list("last_seq", "floor").first() or (0, 0))
+    if after < floor or after > last_seq:
+        return Feed([], encode_cursor(last_seq), resync=True)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    latest = {}
+    for seq, kind, item_id, action in rows:
+        latest.pop((kind, item_id), None)
+        latest[kind, item_id] = Delta(seq, kind, item_id, action)
+    deltas = list(latest.values())
+
+    found = {
+        "file": File.objects.filter(owner=user).in_bulk(
+            [d.id for d in deltas if d.kind == "file"]),
+        "folder": Folder.objects.filter(owner=user).in_bulk(
+            [d.id for d in deltas if d.kind == "folder"]),
+    }
+    for delta in deltas:
+        delta.item = found[delta.kind].get(delta.id)
+    cursor = rows[-1][0] if rows else after
+    return Feed(deltas, encode_cursor(cursor), has_more)
+
+
+def compact(batch_size=None, now=None):
+    """
+    Delete superseded entries, then entries past the retention, in batches.
+    Returns (superseded, expired).
+    """
+    config = settings.JOURNAL
+    batch_size = batch_size or config["BATCH_SIZE"]
+    later = Change.objects.filter(
+        owner_id=OuterRef("owner_id"), kind=OuterRef("kind"),
+        item_id=OuterRef("item_id"), seq__gt=OuterRef("seq"))
+    superseded = 0
+    last_id = 0
+    while True:
+        ids = list(Change.objects.filter(id__gt=last_id).order_by("id")
+                   .values_list("id", flat=True)[:batch_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        superseded += Change.objects.filter(id__in=ids).filter(Exists(later)).delete()[0]
+
+    cutoff = (now or timezone.now()) - timedelta(days=config["RETENTION_DAYS"])
+    expired = 0
+    while True:
+        with transaction.atomic():
+            batch = list(Change.objects.filter(created_at__lt=cutoff).order_by("id")
+                         .values_list("id", "owner_id", "seq")[:batch_size])
+            if not batch:
+                break
+            floors = {}
+            for _, owner_id, seq in batch:
+                floors[owner_id] = max(seq, floors.get(owner_id, 0))
+            for owner_id, seq in floors.items():
+                ChangeSequence.objects.filter(owner_id=owner_id, floor__lt=seq).update(floor=seq)
+            expired += Change.objects.filter(id__in=[pk for pk, _, _ in batch]).delete()[0]
+    return superseded, expired
@@ -0,0 +1,129 @@
+import uuid
+
+from django.db import transaction
+from django.db.models import F
+
+from . import usage
+from .middleware import invalidate_user
+from .models import CustomUser, LedgerEntry, StorageUsage
+
+
+# Credit and quota reservations
+#
+# reserve() takes credits and quota in one short transaction using
+# conditional UPDATEs (`... WHERE credits >= cost`), so concurrent uploads
+# cannot both pass a check that only one of them fits. The caller then
+# either commits the reservation in the same transaction that writes its
+# File rows, or releases it to give the credits and bytes back.
+# Each step is recorded in the append-only LedgerEntry table.
+
+
+class ReservationError(Exception):
+    pass
+
+
+class Reservation:
+    def __init__(self, user, credits, bytes, reference, id=None):
+        self.id = id or uuid.uuid4()
+        self.user = user
+        self.credits = credits
+        self.bytes = bytes
+        self.reference = reference
+        self.settled = False
+
+    def _record(self, action):
+        LedgerEntry.objects.create(
+            owner=self.user,
+            reservation=self.id,
+            action=action,
+            credits=self.credits,
+            bytes=self.bytes,
+            reference=self.reference,
+        )
+
+    def commit(self):
+        """
+        Keep the credits and turn the reserved bytes into used bytes. Call
+        inside the transaction that records the usage (see accounts.usage).
+        """
+        if self.settled:
+            return
+        with transaction.atomic():
+            _unreserve_bytes(self.user, self.bytes)
+            self._record('commit')
+        # Only settled once the caller's transaction commits; if it rolls
+        # back, leaving the `with` block releases the reservation instead
+        transaction.on_commit(self._settle)
+
+    def _settle(self):
+        self.settled = True
+
+    def release(self):
+        """
+        Return the credits and reserved bytes.
+        """
+        if self.settled:
+            return
+        with transaction.atomic():
+            if self.credits:
+                CustomUser.objects.filter(pk=self.user.pk).update(
+                    credits=F('credits') + self.credits)
+                self.user.credits += self.credits
+                invalidate_user(self.user.pk)
+            _unreserve_bytes(self.user, self.bytes)
+            self._record('release')
+        self._settle()
+
+    # Release automatically if the block fails before commit()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.release()
+        return False
+
+
+def _unreserve_bytes(user, bytes):
+    if bytes:
+        StorageUsage.objects.filter(owner=user).update(
+            reserved_bytes=F('reserved_bytes') - bytes)
+
+
+def reserve(user, credits=0, bytes=0, reference=''):
+    """
+    Atomically take `credits` and `bytes` of quota from `user`.
+    Raises ReservationError (and takes nothing) if either does not fit.
+    """
+    usage.get_usage(user)  # make sure the counters row exists
+    with transaction.atomic():
+        if credits:
+            taken = CustomUser.objects.filter(
+                pk=user.pk, credits__gte=credits,
+            ).update(credits=F('credits') - credits)
+            if not taken:
+                raise ReservationError("Not enough credits to upload files")
+        if bytes:
+            # bytes_used + reserved_bytes + bytes <= storage_limit
+            taken = StorageUsage.objects.filter(
+                owner=user,
+                bytes_used__lte=user.storage_limit - bytes - F('reserved_bytes'),
+            ).update(reserved_bytes=F('reserved_bytes') + bytes)
+            if not taken:
+                # Rolls back the credit update above
+                raise ReservationError("Storage limit exceeded. Upgrade your plan.")
+        reservation = Reservation(user, credits, bytes, reference)
+        reservation._record('reserve')
+
+    if credits:
+        user.credits -= credits
+        invalidate_user(user.pk)
+    return reservation
+
+
+def resume(user, reservation_id, credits, bytes, reference=''):
+    """
+    Rebuild a Reservation made in an earlier request, e.g. by an upload
+    session, so it can be committed or released.
+    """
+    return Reservation(user, credits, bytes, reference, id=reservation_id)
@@ -0,0 +1,208 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from graphql import GraphQLError, get_named_type, is_list_type
+from graphql.execution.values import get_variable_values
+from graphql.language import (
+    FieldNode, FragmentDefinitionNode, FragmentSpreadNode, InlineFragmentNode, IntValueNode,
+    VariableNode)
+from graphql.type import GraphQLNonNull, GraphQLObjectType, GraphQLInterfaceType
+
+from .pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+
+# Query cost and rate limits
+#
+# Before executing, every operation is walked once to compute its depth and
+# static cost: each object field costs 1 (or its GRAPHQL_LIMITS["FIELD_COSTS"]
+# entry) times the number of rows its parent may return, lists count as
+# `first` rows (or LIST_SIZE when unbounded), and scalars are free.
+# Operations over MAX_DEPTH or MAX_COST are rejected, and the cost is then
+# taken from a per-user token bucket that refills at RATE per second.
+
+
+LIST_SIZE = 100  # assumed length of lists without a `first` argument
+
+
+class LimitExceeded(GraphQLError):
+    def __init__(self, message, status=400, **extensions):
+        super().__init__(message, extensions=extensions)
+        self.status = status
+
+
+def _unwrap(type_):
+    while isinstance(type_, GraphQLNonNull):
+        type_ = type_.of_type
+    return type_
+
+
+def _argument(node, name, variables):
+    for argument in node.arguments:
+        if argument.name.value != name:
+            continue
+        value = argument.value
+        if isinstance(value, VariableNode):
+            value = variables.get(value.name.value)
+            return value if isinstance(value, int) else None
+        if isinstance(value, IntValueNode):
+            return int(value.value)
+    return None
+
+
+class CostAnalysis:
+    def __init__(self, fragments, variables):
+        self.fragments = fragments
+        self.variables = variables
+        self.field_costs = settings.GRAPHQL_LIMITS["FIELD_COSTS"]
+        self.depth = 0
+
+    def fields(self, selection_set):
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                yield selection
+            elif isinstance(selection, InlineFragmentNode):
+                yield from self.fields(selection.selection_set)
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = self.fragments.get(selection.name.value)
+                if fragment is not None:
+                    yield from self.fields(fragment.selection_set)
+
+    def multiplier(self, parent_type, field, node):
+        first = _argument(node, 'first', self.variables)
+        if 'first' in field.args:
+            if first is None:
+                first = DEFAULT_PAGE_SIZE
+            return max(min(first, MAX_PAGE_SIZE), 0)
+        if is_list_type(_unwrap(field.type)):
+            # A connection's edges were already counted by its `first`
+            if parent_type.name.endswith('Connection'):
+                return 1
+            return LIST_SIZE
+        return 1
+
+    def cost(self, parent_type, selection_set, depth=1):
+        total = 0
+        for node in self.fields(selection_set):
+            name = node.name.value
+            if name.startswith('__'):
+                continue  # introspection is static and cheap
+            if not isinstance(parent_type, (GraphQLObjectType, GraphQLInterfaceType)):
+                continue
+            field = parent_type.fields.get(name)
+            if field is None:
+                continue
+            self.depth = max(self.depth, depth)
+            child_type = get_named_type(field.type)
+            field_cost = self.field_costs.get(f'{parent_type.name}.{name}')
+            if field_cost is None:
+                field_cost = 1 if node.selection_set is not None else 0
+            children = 0
+            if node.selection_set is not None:
+                children = self.cost(child_type, node.selection_set, depth + 1)
+            total += field_cost + self.multiplier(parent_type, field, node) * children
+        return total
+
+
+def analyze(schema, document, operation, variables=None):
+    """
+    The (cost, depth) of `operation`, an OperationDefinitionNode of
+    `document`, against a graphql-core schema.
+    """
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if isinstance(definition, FragmentDefinitionNode)
+    }
+    # As execution will see them
+    variables = get_variable_values(
+        schema, operation.variable_definitions or [], variables or {})
+    if isinstance(variables, list):
+        return 0, 0  # execution rejects the operation before resolving anything
+    root = schema.get_root_type(operation.operation)
+    analysis = CostAnalysis(fragments, variables)
+    cost = analysis.cost(root, operation.selection_set)
+    return cost, analysis.depth
+
+
+class TokenBuckets:
+    """
+    Per-process token buckets keyed by client, refilled at `rate` tokens a
+    second up to `capacity`. The least recently used buckets are dropped
+    beyond `size`; a dropped bucket starts full again.
+    """
+
+    def __init__(self, rate, capacity, size):
+        self.rate = rate
+        self.capacity = capacity
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, amount):
+        """
+        Take `amount` tokens. Returns (allowed, remaining, retry_after).
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= amount
+            if allowed:
+                tokens -= amount
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        retry_after = 0 if allowed else math.ceil((amount - tokens) / self.rate)
+        return allowed, int(tokens), retry_after
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+buckets = TokenBuckets(
+    settings.GRAPHQL_LIMITS["RATE"],
+    settings.GRAPHQL_LIMITS["BURST"],
+    settings.GRAPHQL_LIMITS["CLIENTS"],
+)
+
+
+def client_key(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return f'ip:{request.META.get("REMOTE_ADDR", "")}'
+
+
+def check(request, schema, document, operation, variables=None):
+    """
+    Enforce the depth, cost and rate limits for one operation. Returns the
+    cost extensions for the response or raises LimitExceeded.
+    """
+    limits = settings.GRAPHQL_LIMITS
+    cost, depth = analyze(schema, document, operation, variables)
+    if depth > limits["MAX_DEPTH"]:
+        raise LimitExceeded(
+            f"Query depth {depth} exceeds the limit of {limits['MAX_DEPTH']}",
+            code="DEPTH_LIMIT_EXCEEDED", depth=depth)
+    if cost > limits["MAX_COST"]:
+        raise LimitExceeded(
+            f"Query cost {cost} exceeds the limit of {limits['MAX_COST']}",
+            code="COST_LIMIT_EXCEEDED", cost=cost)
+
+    allowed, remaining, retry_after = buckets.take(client_key(request), cost)
+    extensions = {
+        "requested": cost,
+        "depth": depth,
+        "remaining": remaining,
+        "limit": limits["BURST"],
+    }
+    if not allowed:
+        raise LimitExceeded(
+            "Rate limit exceeded, retry later", status=429,
+            code="RATE_LIMITED", retryAfter=retry_after, cost=extensions)
+    return extensions
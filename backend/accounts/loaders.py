@@ -0,0 +1,181 @@
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+
+from .models import CustomUser, File, Folder, Thumbnail
+
+
+# Request-scoped loaders
+#
+# Resolvers for related objects (FileType.ownerAvatar, FolderType.parent)
+# go through a loader instead of touching the ForeignKey directly. When a
+# list is resolved its rows are primed into the loaders, so the first miss
+# fetches every queued id in one `pk__in` query and the rest are cache hits.
+
+
+class Loader:
+    def __init__(self, model):
+        self.model = model
+        self.cache = {}
+        self.pending = set()
+        self.on_fetch = None
+
+    def prime(self, obj):
+        self.cache[obj.pk] = obj
+        self.pending.discard(obj.pk)
+
+    def queue(self, pk):
+        if pk is not None and pk not in self.cache:
+            self.pending.add(pk)
+
+    def load(self, pk):
+        if pk is None:
+            return None
+        if pk not in self.cache:
+            self.queue(pk)
+            self.fetch()
+        return self.cache.get(pk)
+
+    def load_many(self, pks):
+        for pk in pks:
+            self.queue(pk)
+        if self.pending:
+            self.fetch()
+        return [self.cache.get(pk) for pk in pks]
+
+    def fetch(self):
+        batch, self.pending = self.pending, set()
+        found = self.model.objects.in_bulk(batch)
+        for pk in batch:
+            # Remember misses too, so they are not fetched again
+            self.cache[pk] = found.get(pk)
+        if self.on_fetch is not None:
+            self.on_fetch(found.values())
+        return found
+
+
+class ThumbnailLoader:
+    """
+    Ready thumbnails by (file id, size). A miss fetches that size for every
+    file in the files loader, i.e. the whole list being resolved.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.cache = {}
+
+    def load(self, file_id, size):
+        key = (file_id, size)
+        if key not in self.cache:
+            batch = {file_id} | {
+                pk for pk, file in self.files.cache.items()
+                if file is not None and (pk, size) not in self.cache
+            }
+            found = {
+                thumbnail.file_id: thumbnail
+                for thumbnail in Thumbnail.objects.filter(
+                    file_id__in=batch, size=size, status='ready')
+            }
+            for pk in batch:
+                self.cache[(pk, size)] = found.get(pk)
+        return self.cache[key]
+
+
+class Loaders:
+    def __init__(self, user=None):
+        self.users = Loader(CustomUser)
+        self.folders = Loader(Folder)
+        self.files = Loader(File)
+        self.by_model = {
+            CustomUser: self.users,
+            Folder: self.folders,
+            File: self.files,
+        }
+        self.thumbnails = ThumbnailLoader(self.files)
+        for loader in self.by_model.values():
+            # Queue the relations of fetched rows too, e.g. a parent's parent
+            loader.on_fetch = self.prime_rows
+        if user is not None and user.is_authenticated:
+            # Nearly every row a user lists is their own
+            self.users.prime(user)
+
+    def prime_rows(self, rows):
+        """
+        Cache `rows` and queue the ids of their loaded foreign keys.
+        """
+        for row in rows:
+            loader = self.by_model.get(type(row))
+            if loader is not None:
+                loader.prime(row)
+            for field in row._meta.concrete_fields:
+                if not field.is_relation or field.attname not in row.__dict__:
+                    continue
+                related = self.by_model.get(field.related_model)
+                if related is not None:
+                    related.queue(row.__dict__[field.attname])
+        return rows
+
+
+def get_loaders(info):
+    context = info.context
+    loaders = getattr(context, 'loaders', None)
+    if loaders is None:
+        loaders = Loaders(getattr(context, 'user', None))
+        context.loaders = loaders
+    return loaders
+
+
+# Field projection
+
+
+def _selections(info, node):
+    if node.selection_set is None:
+        return
+    for selection in node.selection_set.selections:
+        if isinstance(selection, FieldNode):
+            yield selection
+        elif isinstance(selection, InlineFragmentNode):
+            yield from _selections(info, selection)
+        elif isinstance(selection, FragmentSpreadNode):
+            yield from _selections(info, info.fragments[selection.name.value])
+
+
+def selected_fields(info, *path):
+    """
+    Names of the GraphQL fields selected below the current field, optionally
+    following `path` (e.g. 'edges', 'node') first.
+    """
+    nodes = list(info.field_nodes)
+    for name in path:
+        nodes = [
+            selection for node in nodes
+            for selection in _selections(info, node)
+            if selection.name.value == name
+        ]
+    return {
+        selection.name.value
+        for node in nodes
+        for selection in _selections(info, node)
+    }
+
+
+def project(info, queryset, projection, *path):
+    """
+    Restrict `queryset` with only() to the columns the selected fields need.
+    `projection` maps GraphQL field names to model attributes. If a field is
+    selected that the projection does not know, the queryset is returned
+    untouched rather than risk a deferred load per row.
+    """
+    fields = selected_fields(info, *path) - {'__typename'}
+    columns = {'id', 'created_at'}
+    for name in fields:
+        if name not in projection:
+            return queryset
+        columns.update(projection[name])
+    return queryset.only(*columns)
+
+
+def load_rows(info, queryset, projection, *path):
+    """
+    Evaluate a projected list queryset and prime the request loaders with it.
+    """
+    rows = list(project(info, queryset, projection, *path))
+    return get_loaders(info).prime_rows(rows)
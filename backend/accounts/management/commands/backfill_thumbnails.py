@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from accounts.thumbnails import backfill
+
+
+class Command(BaseCommand):
+    help = "Queue thumbnails for existing images, PDFs and videos that have none."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=500)
+
+    def handle(self, *args, **options):
+        created = backfill(options["batch"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Queued {created} thumbnails. Run run_thumbnail_worker to render them."))
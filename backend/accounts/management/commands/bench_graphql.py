@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a reproducible dataset, run every GraphQL query and mutation "
+        "against the schema and record latency, query counts and peak memory. "
+        "Nothing is kept in the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=50)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--users", type=int, default=3)
+        parser.add_argument("--folders", type=int, default=200, help="Folders per user")
+        parser.add_argument("--files", type=int, default=2000, help="Files per user")
+        parser.add_argument("--depth", type=int, default=5, help="Folder tree depth")
+        parser.add_argument(
+            "--operation", action="append", dest="operations",
+            help="Only run this operation (repeatable)")
+        parser.add_argument("--output", help="Write the results to this JSON file")
+        parser.add_argument("--compare", help="A previous --output to compare against")
+        parser.add_argument(
+            "--threshold", type=float, default=0.2,
+            help="p95 growth counted as a regression by --compare (0.2 = 20%%)")
+
+    def progress(self, name, result):
+        self.stdout.write(
+            f"{name:<24}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+            f"{result['queries']:>9g}{result['peak_kb']:>11.0f}")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+
+        self.stdout.write(
+            f"{'operation':<24}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'peak KiB':>11}")
+        try:
+            results = benchmark.run(
+                iterations=options["iterations"], seed_value=options["seed"],
+                users=options["users"], folders=options["folders"], files=options["files"],
+                depth=options["depth"], only=options["operations"], progress=self.progress)
+        except (benchmark.BenchmarkError, ValueError) as e:
+            raise CommandError(str(e))
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Wrote {options['output']}")
+
+        if baseline is not None:
+            regressions = benchmark.compare(baseline, results, options["threshold"])
+            if regressions:
+                raise CommandError("Regressions:\n" + "\n".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regressions."))
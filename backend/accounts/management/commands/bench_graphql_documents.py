@@ -0,0 +1,75 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts import persisted
+from accounts.graphql_view import GraphQLView
+from cryogenum_backend.schema import schema
+
+
+# Operations the dashboard sends on every page load
+OPERATIONS = {
+    "me": "query Me { me { id username email credits avatarInitials } }",
+    "dashboardStats": """
+        query DashboardStats {
+            dashboardStats {
+                fileTypes { fileType count bytes }
+                foldersCount totalStorageUsed storageLimit
+            }
+        }""",
+    "folderContents": """
+        query FolderContents($folderId: ID!, $first: Int, $after: String) {
+            folderContents(folderId: $folderId) {
+                foldersConnection(first: $first) {
+                    edges { node { id name createdAt } }
+                    pageInfo { hasNextPage endCursor }
+                }
+                filesConnection(first: $first, after: $after) {
+                    edges { node { id name size fileType createdAt ownerAvatar thumbnailUrl(size: 256) } }
+                    pageInfo { hasNextPage endCursor }
+                }
+            }
+            folderInfo(folderId: $folderId) { id name breadcrumbs { id name } }
+        }""",
+    "searchFiles": """
+        query Search($query: String!) {
+            searchFiles(query: $query, first: 10) {
+                edges { node { id name fileType thumbnailUrl(size: 64) } }
+            }
+        }""",
+}
+
+
+class Command(BaseCommand):
+    help = "Time parse + validate against the persisted document cache for the dashboard's operations."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=2000)
+
+    def time(self, work, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            work()
+        return (time.perf_counter() - start) / iterations * 1e6
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+        view = GraphQLView(schema=schema)
+
+        def uncached(query):
+            persisted.documents.clear()
+            view.get_document(query)
+
+        self.stdout.write(f"{'operation':<16}{'parse+validate':>16}{'cached':>10}{'saved':>10}  (µs/request)")
+        for name, query in OPERATIONS.items():
+            _, _, errors = view.get_document(query)
+            if errors:
+                raise CommandError(f"{name}: {errors[0].message}")
+            cold = self.time(lambda: uncached(query), iterations)
+            view.get_document(query)
+            warm = self.time(lambda: view.get_document(query), iterations)
+            key = persisted.query_hash(query)
+            hashed = self.time(lambda: view.get_document(None, key), iterations)
+            self.stdout.write(
+                f"{name:<16}{cold:>16.1f}{min(warm, hashed):>10.1f}{cold - min(warm, hashed):>10.1f}")
+        persisted.documents.clear()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from accounts.filetypes import backfill
+
+
+class Command(BaseCommand):
+    help = "Sniff stored files' content and update their MIME type and file_type."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=500)
+        parser.add_argument(
+            "--all", action="store_true", dest="everything",
+            help="Reclassify every file, not only those never sniffed.")
+
+    def handle(self, *args, **options):
+        updated = backfill(options["batch"], options["everything"])
+        self.stdout.write(self.style.SUCCESS(f"Classified {updated} files."))
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts.journal import compact
+
+
+class Command(BaseCommand):
+    help = (
+        "Drop change journal entries superseded by a later change to the same "
+        "item, and entries past JOURNAL['RETENTION_DAYS']."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=settings.JOURNAL["BATCH_SIZE"])
+
+    def handle(self, *args, **options):
+        superseded, expired = compact(options["batch"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Removed {superseded} superseded and {expired} expired entries."))
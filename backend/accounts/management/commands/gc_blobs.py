@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from accounts.blobs import dedupe_stats, reconcile
+
+
+class Command(BaseCommand):
+    help = "Recount blob references, delete unreferenced blobs and report the dedupe ratio."
+
+    def handle(self, *args, **options):
+        recounted, collected = reconcile()
+        self.stdout.write(
+            f"Recounted {recounted} blobs, deleted {collected} unreferenced blobs.")
+
+        stats = dedupe_stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['blobs']} blobs, {stats['logical_bytes']} logical bytes in "
+            f"{stats['physical_bytes']} physical bytes "
+            f"(dedupe ratio {stats['dedupe_ratio']:.2f})."))
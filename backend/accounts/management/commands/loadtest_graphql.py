@@ -0,0 +1,126 @@
+import asyncio
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import ThreadSensitiveContext
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.backends.signals import connection_created
+from django.test import AsyncRequestFactory, RequestFactory
+
+from accounts import limits
+from accounts.graphql_view import AsyncGraphQLView, GraphQLView
+from accounts.middleware import TokenAuthenticationMiddleware
+from accounts.models import CustomUser, File, Folder
+from accounts.schema import get_tokens_for_user
+from cryogenum_backend.schema import schema
+
+from .bench_graphql_documents import OPERATIONS
+
+
+LOADTEST_USERNAME = "loadtest"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the sync (WSGI, one thread per request) and async (ASGI) "
+        "GraphQL views under concurrent load, in-process."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--query", choices=sorted(OPERATIONS), default="dashboardStats")
+        parser.add_argument(
+            "--db-latency-ms", type=float, default=0,
+            help="Add this much latency to every query, as a remote database would.")
+
+    def seed(self):
+        user, created = CustomUser.objects.get_or_create(
+            username=LOADTEST_USERNAME, defaults={"email": "loadtest@example.com"})
+        if created:
+            folder = Folder.objects.create(name="loadtest", owner=user)
+            File.objects.bulk_create(
+                File(name=f"file {i}.pdf", owner=user, folder=folder, size=1024, file_type="pdf")
+                for i in range(50))
+        folder = Folder.objects.filter(owner=user).first()
+        return user, {"folderId": folder.pk, "first": 20, "query": "file"}
+
+    def add_latency(self, seconds):
+        def wrapper(execute, sql, params, many, context):
+            time.sleep(seconds)
+            return execute(sql, params, many, context)
+
+        def install(sender, connection, **kwargs):
+            connection.execute_wrappers.append(wrapper)
+
+        connection_created.connect(install, weak=False)
+
+    def body(self, query, variables):
+        return json.dumps({"query": query, "variables": variables})
+
+    def run_sync(self, body, auth, concurrency, total):
+        view = TokenAuthenticationMiddleware(GraphQLView.as_view(schema=schema))
+        factory = RequestFactory()
+
+        def one(_):
+            start = time.perf_counter()
+            response = view(factory.post(
+                "/graphql/", body, content_type="application/json", HTTP_AUTHORIZATION=auth))
+            if response.status_code != 200:
+                raise CommandError(response.content.decode())
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            start = time.perf_counter()
+            latencies = list(pool.map(one, range(total)))
+        return time.perf_counter() - start, latencies
+
+    def run_async(self, body, auth, concurrency, total):
+        view = TokenAuthenticationMiddleware(AsyncGraphQLView.as_view(schema=schema))
+        factory = AsyncRequestFactory()
+
+        async def one(semaphore):
+            async with semaphore:
+                start = time.perf_counter()
+                # One sync thread per request, as Django's ASGI handler does
+                async with ThreadSensitiveContext():
+                    response = await view(factory.post(
+                        "/graphql/", body, content_type="application/json",
+                        HTTP_AUTHORIZATION=auth))
+                if response.status_code != 200:
+                    raise CommandError(response.content.decode())
+                return time.perf_counter() - start
+
+        async def main():
+            semaphore = asyncio.Semaphore(concurrency)
+            start = time.perf_counter()
+            latencies = await asyncio.gather(*(one(semaphore) for _ in range(total)))
+            return time.perf_counter() - start, latencies
+
+        return asyncio.run(main())
+
+    def report(self, name, elapsed, latencies, total):
+        latencies = sorted(latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        self.stdout.write(
+            f"{name:<8}{total / elapsed:>10.1f}{statistics.median(latencies) * 1000:>10.1f}"
+            f"{p95 * 1000:>10.1f}")
+
+    def handle(self, *args, **options):
+        user, variables = self.seed()
+        auth = f"Bearer {get_tokens_for_user(user)['access']}"
+        body = self.body(OPERATIONS[options["query"]], variables)
+        if options["db_latency_ms"]:
+            self.add_latency(options["db_latency_ms"] / 1000)
+
+        concurrency, total = options["concurrency"], options["requests"]
+        # One client sending everything would soon be rate limited
+        limits.buckets = limits.TokenBuckets(
+            limits.buckets.rate, total * settings.GRAPHQL_LIMITS["MAX_COST"], limits.buckets.size)
+        self.stdout.write(f"{options['query']}: {total} requests, {concurrency} concurrent")
+        self.stdout.write(f"{'view':<8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        self.report("wsgi", *self.run_sync(body, auth, concurrency, total), total)
+        self.report("asgi", *self.run_async(body, auth, concurrency, total), total)
@@ -0,0 +1,48 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts import trash
+
+
+class Command(BaseCommand):
+    help = (
+        "Permanently delete bin items past their owner's tier retention, in "
+        "batches. Safe to interrupt and re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=settings.TRASH["BATCH_SIZE"])
+        parser.add_argument(
+            "--workers", type=int, default=settings.TRASH["WORKERS"],
+            help="Threads deleting storage objects (0 deletes inline)")
+        parser.add_argument(
+            "--max-batches", type=int, default=None,
+            help="Stop after this many batches; the next run carries on")
+        parser.add_argument(
+            "--poll", type=float, default=None,
+            help="Keep running, purging again every this many seconds")
+
+    def progress(self, stats):
+        self.stdout.write(f"Batch {stats.batches}: {stats.summary()}")
+
+    def handle(self, *args, **options):
+        executor = None
+        if options["workers"] > 0:
+            executor = ThreadPoolExecutor(options["workers"])
+        try:
+            while True:
+                stats = trash.purge(
+                    options["batch"], executor,
+                    max_batches=options["max_batches"], progress=self.progress)
+                self.stdout.write(self.style.SUCCESS(f"Purged {stats.summary()}"))
+                if options["poll"] is None:
+                    break
+                time.sleep(options["poll"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if executor is not None:
+                executor.shutdown()
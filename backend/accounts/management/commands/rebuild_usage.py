@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import CustomUser
+from accounts.uploads import expire_sessions
+from accounts.usage import rebuild_usage
+
+
+class Command(BaseCommand):
+    help = "Rebuild per-user storage usage counters from File/Folder and report drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', action='append', dest='users', default=[],
+            help="Only rebuild this user (id or email). May be repeated.")
+
+    def handle(self, *args, **options):
+        users = CustomUser.objects.order_by('id')
+        if options['users']:
+            ids = [u for u in options['users'] if u.isdigit()]
+            emails = [u for u in options['users'] if not u.isdigit()]
+            users = users.filter(id__in=ids) | users.filter(email__in=emails)
+
+        checked = drifted = 0
+        for user in users.iterator():
+            # Expired upload sessions still hold reserved bytes
+            expire_sessions(user)
+            _, changed = rebuild_usage(user)
+            checked += 1
+            if changed:
+                drifted += 1
+                self.stdout.write(f"Reconciled usage for {user.email}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {checked} users, reconciled {drifted}."))
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts import result_cache
+
+
+class Command(BaseCommand):
+    help = "Report query result cache hits and misses (shared backends only)."
+
+    def handle(self, *args, **options):
+        if settings.RESULT_CACHE["BACKEND"] != "django":
+            self.stdout.write(self.style.WARNING(
+                "The locmem backend counts per process; these are this process's numbers."))
+        stats = result_cache.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['hits']} hits, {stats['misses']} misses "
+            f"(hit rate {stats['hit_rate']:.1%})."))
@@ -0,0 +1,51 @@
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from accounts import thumbnails
+
+
+class Command(BaseCommand):
+    help = "Render queued thumbnails and previews in a local process pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes", type=int, default=os.cpu_count() or 1,
+            help="Render processes (0 renders in this process)")
+        parser.add_argument("--batch", type=int, default=50)
+        parser.add_argument(
+            "--poll", type=float, default=2.0,
+            help="Seconds to wait when the queue is empty")
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Exit when the queue is empty instead of polling")
+
+    def handle(self, *args, **options):
+        pool = None
+        if options["processes"] > 0:
+            # Forked children must not inherit open database connections
+            connections.close_all()
+            pool = multiprocessing.Pool(options["processes"])
+
+        total = 0
+        try:
+            while True:
+                done = thumbnails.process(options["batch"], pool=pool)
+                total += done
+                if done:
+                    self.stdout.write(f"Processed {done} thumbnails.")
+                elif options["once"]:
+                    break
+                else:
+                    time.sleep(options["poll"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        self.stdout.write(self.style.SUCCESS(f"Processed {total} thumbnails."))
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts import uploads
+
+
+class Command(BaseCommand):
+    help = "Hash finalized multipart uploads and register their files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=10)
+        parser.add_argument(
+            "--poll", type=float, default=2.0,
+            help="Seconds to wait when the queue is empty")
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Exit when the queue is empty instead of polling")
+
+    def handle(self, *args, **options):
+        total = 0
+        try:
+            while True:
+                done = uploads.verify_pending(options["batch"])
+                total += done
+                if done:
+                    self.stdout.write(f"Verified {done} uploads.")
+                elif options["once"]:
+                    break
+                else:
+                    time.sleep(options["poll"])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f"Verified {total} uploads."))
@@ -1,6 +1,237 @@
+import copy
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.urls import reverse
 from django.utils.functional import SimpleLazyObject
 from django.contrib.auth.models import AnonymousUser
+from graphql import GraphQLError, parse
+from graphql.language import OperationDefinitionNode, OperationType
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+
+from . import persisted
+from .models import CustomUser
+
+
+# Claims copied into tokens by get_tokens_for_user, enough to rebuild a
+# read-only user without a query
+TOKEN_VERSION_CLAIM = "ver"
+USER_CLAIMS = ("username", "email", "avatar_initials", "tier")
+
+
+STAMP_PREFIX = "tokenauth:user:"
+TOKEN_STATE_PREFIX = "tokenauth:state:"
+
+
+class UserCache:
+    """
+    Per-process LRU of users keyed by id, valid for one token version and
+    at most TOKEN_AUTH["CACHE_TTL"] seconds. Entries are dropped when the
+    user is saved (see accounts.apps) or their credits change (see
+    accounts.ledger). With TOKEN_AUTH["SHARED_CACHE"], the alias of a cache
+    every process uses (e.g. Redis), drops reach all processes: each drop
+    leaves a new stamp there, and entries cached under an older stamp are
+    not used. Without it, other processes catch up when the TTL runs out.
+    The shared cache also holds each loaded user's token version and active
+    flag, which is all "stateless" mode needs to accept a token.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def shared():
+        alias = settings.TOKEN_AUTH.get("SHARED_CACHE")
+        return caches[alias] if alias else None
+
+    def stamp(self, user_id):
+        """
+        The user's current stamp, to read before loading the user.
+        """
+        shared = self.shared()
+        return shared.get(f"{STAMP_PREFIX}{user_id}") if shared is not None else None
+
+    def remember(self, user, stamp):
+        """
+        Record the token state of `user`, loaded after reading `stamp`.
+        """
+        shared = self.shared()
+        if shared is not None:
+            shared.set(f"{TOKEN_STATE_PREFIX}{user.pk}",
+                       (stamp, user.token_version, user.is_active),
+                       settings.TOKEN_AUTH["CACHE_TTL"])
+
+    def accepts(self, user_id, version):
+        """
+        Whether tokens of `version` are valid for `user_id` by the recorded
+        state: True, False, or None when nothing current is recorded.
+        """
+        shared = self.shared()
+        if shared is None:
+            return None
+        stamp_key, state_key = f"{STAMP_PREFIX}{user_id}", f"{TOKEN_STATE_PREFIX}{user_id}"
+        values = shared.get_many([stamp_key, state_key])
+        state = values.get(state_key)
+        # Recorded before the user last changed
+        if state is None or state[0] != values.get(stamp_key):
+            return None
+        _, current, is_active = state
+        return current == version and (is_active or not api_settings.CHECK_USER_IS_ACTIVE)
+
+    def get(self, user_id, version):
+        user_id = str(user_id)  # token claims carry ids as strings
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            cached_version, expires_at, stamp, user = entry
+            if cached_version != version or expires_at < time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+        if stamp != self.stamp(user_id):
+            self.invalidate(user_id, shared=False)
+            return None
+        # Callers may change and save the user, so never hand out the shared copy
+        return copy.copy(user)
+
+    def set(self, user_id, version, user, stamp=None):
+        user_id = str(user_id)
+        config = settings.TOKEN_AUTH
+        with self.lock:
+            self.entries[user_id] = (
+                version, time.monotonic() + config["CACHE_TTL"], stamp, copy.copy(user))
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > config["CACHE_SIZE"]:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id, shared=True):
+        with self.lock:
+            self.entries.pop(str(user_id), None)
+        cache = self.shared() if shared else None
+        if cache is not None:
+            # Entries older than the TTL are dropped anyway
+            cache.set(f"{STAMP_PREFIX}{user_id}", uuid.uuid4().hex,
+                      settings.TOKEN_AUTH["CACHE_TTL"])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+user_cache = UserCache()
+
+
+def invalidate_user(user_id):
+    user_cache.invalidate(user_id)
+    # Again once committed, in case another request reloaded the old row
+    transaction.on_commit(lambda: user_cache.invalidate(user_id))
+
+
+class VersionedJWTAuthentication(JWTAuthentication):
+    """
+    SimpleJWT authentication that also rejects tokens whose version claim
+    no longer matches the user's token_version.
+    """
+
+    def get_user(self, validated_token):
+        user = self.load_user(validated_token)
+        version = validated_token.get(TOKEN_VERSION_CLAIM)
+        if version is not None and version != user.token_version:
+            raise AuthenticationFailed("Token has been revoked")
+        # Cached users skip JWTAuthentication's own check
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive")
+        return user
+
+    def load_user(self, validated_token):
+        return super().get_user(validated_token)
+
+
+class CachedJWTAuthentication(VersionedJWTAuthentication):
+    """
+    Serves users from `user_cache` before falling back to the database.
+    """
+
+    def load_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        version = validated_token.get(TOKEN_VERSION_CLAIM)
+        user = user_cache.get(user_id, version) if user_id is not None else None
+        if user is None:
+            stamp = user_cache.stamp(user_id)
+            user = super().load_user(validated_token)
+            user_cache.set(user_id, version, user, stamp)
+            user_cache.remember(user, stamp)
+        return user
+
+
+def user_from_claims(validated_token):
+    """
+    Build an unsaved CustomUser from the token claims, or None if the token
+    predates those claims.
+    """
+    if any(claim not in validated_token for claim in USER_CLAIMS):
+        return None
+    user = CustomUser(
+        id=CustomUser._meta.pk.to_python(
+            validated_token[api_settings.USER_ID_CLAIM]),
+        token_version=validated_token.get(TOKEN_VERSION_CLAIM, 0),
+        **{claim: validated_token[claim] for claim in USER_CLAIMS},
+    )
+    user.is_stateless = True
+    return user
+
+
+def claims_user(validated_token):
+    """
+    The user from the token claims if the recorded token state accepts the
+    token, or None if the user must be loaded to tell.
+    """
+    user = user_from_claims(validated_token)
+    if user is None or TOKEN_VERSION_CLAIM not in validated_token:
+        return None
+    accepted = user_cache.accepts(user.pk, validated_token[TOKEN_VERSION_CLAIM])
+    if accepted is False:
+        raise AuthenticationFailed("Token has been revoked")
+    return user if accepted else None
+
+
+def is_read_only_graphql(request):
+    """
+    True for GET requests and JSON bodies containing only queries sent to
+    the GraphQL endpoint. Multipart bodies are uploads and never read here.
+    """
+    if request.path != reverse("graphql"):
+        return False
+    if request.method in ("GET", "HEAD"):
+        return True
+    if request.content_type != "application/json":
+        return False
+    try:
+        query = json.loads(request.body).get("query")
+        # The view parses it again unless it is already cached
+        document = persisted.documents.peek(persisted.query_hash(query)) or parse(query)
+    except (ValueError, TypeError, AttributeError, GraphQLError):
+        return False
+    return all(
+        definition.operation == OperationType.QUERY
+        for definition in document.definitions
+        if isinstance(definition, OperationDefinitionNode)
+    )
+
+
+_db_auth = VersionedJWTAuthentication()
+_cached_auth = CachedJWTAuthentication()
 
 
 def get_user_from_token(request):
@@ -8,24 +239,41 @@ def get_user_from_token(request):
     Resolve user from Authorization: Bearer <token> using SimpleJWT.
     Returns AnonymousUser if invalid or missing.
     """
-    auth = JWTAuthentication()
+    mode = settings.TOKEN_AUTH["MODE"]
+    auth = _db_auth if mode == "db" else _cached_auth
     try:
-        user_auth_tuple = auth.authenticate(request)
-        if user_auth_tuple is not None:
-            return user_auth_tuple[0]  # user object
+        header = auth.get_header(request)
+        raw_token = auth.get_raw_token(header) if header else None
+        if raw_token is None:
+            return AnonymousUser()
+        validated_token = auth.get_validated_token(raw_token)
+        if mode == "stateless" and is_read_only_graphql(request):
+            user = claims_user(validated_token)
+            if user is not None:
+                return user
+        return auth.get_user(validated_token)
     except Exception:
         return AnonymousUser()
-    return AnonymousUser()
 
 
 class TokenAuthenticationMiddleware:
     """
     Middleware that attaches request.user from JWT token.
-    Works with DRF SimpleJWT.
+    Works with DRF SimpleJWT. settings.TOKEN_AUTH["MODE"] picks how users
+    are loaded: "db" queries every time, "cached" uses the per-process
+    user cache, "stateless" also builds the user of read-only queries from
+    the token claims when the shared cache vouches for the token version.
+    Async-capable so ASGI requests don't pay a thread switch here; the lazy
+    user is resolved by whoever reads it first.
     """
 
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
         request.user = SimpleLazyObject(lambda: get_user_from_token(request))
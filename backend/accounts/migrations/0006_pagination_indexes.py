@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-17 17:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_storageusage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['owner', 'folder', 'is_deleted', 'created_at', 'id'], name='file_owner_folder_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['owner', 'is_deleted', 'created_at', 'id'], name='file_owner_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['owner', 'parent', 'is_deleted', 'created_at', 'id'], name='folder_owner_parent_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['owner', 'is_deleted', 'created_at', 'id'], name='folder_owner_page_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.5 on 2026-10-17 17:50
+
+from django.db import migrations, models
+
+
+def build_paths(apps, schema_editor):
+    """
+    Backfill Folder.path top-down, one tree level at a time.
+    """
+    Folder = apps.get_model('accounts', 'Folder')
+    level = list(Folder.objects.filter(parent__isnull=True).only('id'))
+    for folder in level:
+        folder.path = f'{folder.pk}/'
+    while level:
+        Folder.objects.bulk_update(level, ['path'], batch_size=1000)
+        paths = {folder.pk: folder.path for folder in level}
+        parent_ids = list(paths)
+        level = []
+        for start in range(0, len(parent_ids), 1000):
+            children = Folder.objects.filter(
+                parent_id__in=parent_ids[start:start + 1000]).only('id', 'parent_id')
+            for child in children:
+                child.path = f'{paths[child.parent_id]}{child.pk}/'
+                level.append(child)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, max_length=1024),
+        ),
+        migrations.RunPython(build_paths, migrations.RunPython.noop),
+    ]
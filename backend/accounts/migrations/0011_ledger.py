@@ -0,0 +1,38 @@
+# Generated by Django 5.2.5 on 2026-10-17 17:58
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_customuser_token_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storageusage',
+            name='reserved_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='reservation',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reservation', models.UUIDField(db_index=True)),
+                ('action', models.CharField(choices=[('reserve', 'Reserve'), ('commit', 'Commit'), ('release', 'Release')], max_length=10)),
+                ('credits', models.IntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('reference', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Thumbnail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.IntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('image', models.FileField(blank=True, null=True, upload_to='thumbnails/%Y/%m/%d/')),
+                ('error', models.CharField(blank=True, max_length=255)),
+                ('attempts', models.IntegerField(default=0)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thumbnails', to='accounts.file')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='thumbnail_queue_idx')],
+                'constraints': [models.UniqueConstraint(fields=('file', 'size'), name='unique_thumbnail_size')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+from django.db import migrations
+
+
+# Trigram indexes for accounts.search. GIN over (owner_id, UPPER(name)) lets
+# Postgres answer `owner_id = ... AND UPPER(name) LIKE '%...%'` from the
+# index alone; owner_id needs btree_gin to live in a GIN index. Other
+# databases (SQLite in tests) fall back to the owner indexes.
+
+INDEXES = [
+    ('file_name_trgm_idx', 'accounts_file'),
+    ('folder_name_trgm_idx', 'accounts_folder'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+    for name, table in INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} '
+            f'USING gin (owner_id, UPPER(name) gin_trgm_ops)')
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _ in INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_thumbnail'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
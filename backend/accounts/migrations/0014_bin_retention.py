@@ -0,0 +1,41 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:19
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def start_retention(apps, schema_editor):
+    # Items already in the bin get a full retention period from now
+    now = timezone.now()
+    for name in ('File', 'Folder'):
+        apps.get_model('accounts', name).objects.filter(
+            is_deleted=True, deleted_at__isnull=True).update(deleted_at=now)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_name_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(condition=models.Q(('is_deleted', True)), fields=['deleted_at'], name='file_bin_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(condition=models.Q(('is_deleted', True)), fields=['deleted_at'], name='folder_bin_expiry_idx'),
+        ),
+        migrations.RunPython(start_retention, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_bin_retention'),
+    ]
+
+    # New indexes first, so the filters are never left without one
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['owner', 'folder', '-created_at', '-id'], name='file_live_folder_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['owner', '-created_at', '-id'], name='file_live_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['owner', 'file_type'], name='file_live_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(condition=models.Q(('is_deleted', True)), fields=['owner', '-created_at', '-id'], name='file_bin_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['owner', 'parent', '-created_at', '-id'], name='folder_live_parent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['owner', '-created_at', '-id'], name='folder_live_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(condition=models.Q(('is_deleted', True)), fields=['owner', '-created_at', '-id'], name='folder_bin_page_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='file',
+            name='file_owner_folder_page_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='file',
+            name='file_owner_page_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='folder',
+            name='folder_owner_parent_page_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='folder',
+            name='folder_owner_page_idx',
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0015_live_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='multipart_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='storage_key',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
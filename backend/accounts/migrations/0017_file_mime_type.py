@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0016_direct_uploads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='mime_type',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.5 on 2026-10-17 18:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def start_journals(apps, schema_editor):
+    """
+    Existing accounts have history the journal never saw: put their floor
+    above cursor 0 so clients start with a full listing.
+    """
+    CustomUser = apps.get_model('accounts', 'CustomUser')
+    ChangeSequence = apps.get_model('accounts', 'ChangeSequence')
+    ids = list(CustomUser.objects.values_list('id', flat=True))
+    for start in range(0, len(ids), 1000):
+        ChangeSequence.objects.bulk_create([
+            ChangeSequence(owner_id=pk, last_seq=1, floor=1) for pk in ids[start:start + 1000]
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0017_file_mime_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_seq', models.BigIntegerField(default=0)),
+                ('floor', models.BigIntegerField(default=0)),
+                ('owner', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='change_sequence', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('file', 'File'), ('folder', 'Folder')], max_length=6)),
+                ('item_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('create', 'Create'), ('rename', 'Rename'), ('move', 'Move'), ('delete', 'Delete'), ('restore', 'Restore'), ('purge', 'Purge'), ('update', 'Update')], max_length=7)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', 'kind', 'item_id', 'seq'], name='change_item_idx'), models.Index(fields=['created_at'], name='change_age_idx')],
+                'constraints': [models.UniqueConstraint(fields=('owner', 'seq'), name='unique_change_seq')],
+            },
+        ),
+        migrations.RunPython(start_journals, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 
@@ -11,6 +13,8 @@ class CustomUser(AbstractUser):
         choices=[('free', 'Free'), ('pro', 'Pro')],
         default='free'
     )
+    # Part of every token's claims; bump it to revoke issued tokens
+    token_version = models.IntegerField(default=0)
 
     def save(self, *args, **kwargs):
         if not self.avatar_initials:
@@ -32,6 +36,49 @@ class Folder(models.Model):
         'self', null=True, blank=True, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     is_deleted = models.BooleanField(default=False)  # For bin
+    # When it went to the bin; purged after the owner's tier retention
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Materialized path of ancestor ids ending with our own, e.g. "1/5/9/".
+    # A subtree is everything whose path starts with ours, see accounts.tree
+    path = models.CharField(max_length=1024, blank=True, db_index=True)
+
+    class Meta:
+        # Partial indexes matching the resolvers' filters: live rows by
+        # parent or owner, newest first (keyset pagination on (created_at,
+        # id), see accounts.pagination), and the bin. Checked by the query
+        # plan tests in accounts.tests.
+        indexes = [
+            models.Index(fields=['owner', 'parent', '-created_at', '-id'],
+                         condition=models.Q(is_deleted=False),
+                         name='folder_live_parent_idx'),
+            models.Index(fields=['owner', '-created_at', '-id'],
+                         condition=models.Q(is_deleted=False),
+                         name='folder_live_page_idx'),
+            models.Index(fields=['owner', '-created_at', '-id'],
+                         condition=models.Q(is_deleted=True),
+                         name='folder_bin_page_idx'),
+            # Expired bin items, see accounts.trash
+            models.Index(fields=['deleted_at'], condition=models.Q(is_deleted=True),
+                         name='folder_bin_expiry_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if not self.path:
+            self.path = (self.parent.path if self.parent else '') + f'{self.pk}/'
+            Folder.objects.filter(pk=self.pk).update(path=self.path)
+
+
+class Blob(models.Model):
+    """
+    Stored bytes, kept once per SHA-256 digest and shared by every File with
+    the same content. See accounts.blobs.
+    """
+    digest = models.CharField(max_length=64, unique=True)  # hex SHA-256
+    size = models.BigIntegerField()
+    file = models.FileField(max_length=255)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
 
 
 class File(models.Model):
@@ -40,9 +87,206 @@ class File(models.Model):
     folder = models.ForeignKey(
         Folder, null=True, blank=True, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
-    size = models.IntegerField(default=0)  # in bytes
-    # e.g., 'image', 'pdf', 'doc', 'mp3', 'video'
+    size = models.BigIntegerField(default=0)  # in bytes
+    # Category from the content, e.g. 'image', 'pdf', 'doc', 'mp3', 'video';
+    # see accounts.filetypes
     file_type = models.CharField(max_length=50)
+    mime_type = models.CharField(max_length=100, blank=True)  # blank: not sniffed yet
     file = models.FileField(
         upload_to='uploads/%Y/%m/%d/', null=True, blank=True)
     is_deleted = models.BooleanField(default=False)  # For bin
+    # When it went to the bin; purged after the owner's tier retention
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Shared content; `file` names the same storage object
+    blob = models.ForeignKey(
+        Blob, null=True, blank=True, on_delete=models.PROTECT, related_name='files')
+
+    class Meta:
+        # Partial indexes like Folder's, plus live files by type for the
+        # usage counters and type-filtered search
+        indexes = [
+            models.Index(fields=['owner', 'folder', '-created_at', '-id'],
+                         condition=models.Q(is_deleted=False),
+                         name='file_live_folder_idx'),
+            models.Index(fields=['owner', '-created_at', '-id'],
+                         condition=models.Q(is_deleted=False),
+                         name='file_live_page_idx'),
+            models.Index(fields=['owner', 'file_type'],
+                         condition=models.Q(is_deleted=False),
+                         name='file_live_type_idx'),
+            models.Index(fields=['owner', '-created_at', '-id'],
+                         condition=models.Q(is_deleted=True),
+                         name='file_bin_page_idx'),
+            # Expired bin items, see accounts.trash
+            models.Index(fields=['deleted_at'], condition=models.Q(is_deleted=True),
+                         name='file_bin_expiry_idx'),
+        ]
+
+
+class StorageUsage(models.Model):
+    """
+    Denormalized per-user totals for live (non-deleted) files and folders.
+    Kept in step by accounts.usage; rebuilt with `manage.py rebuild_usage`.
+    """
+    owner = models.OneToOneField(
+        CustomUser, on_delete=models.CASCADE, related_name='usage')
+    bytes_used = models.BigIntegerField(default=0)
+    # Held by in-flight uploads and open upload sessions, see accounts.ledger
+    reserved_bytes = models.BigIntegerField(default=0)
+    files_count = models.IntegerField(default=0)
+    folders_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class FileTypeUsage(models.Model):
+    owner = models.ForeignKey(
+        CustomUser, on_delete=models.CASCADE, related_name='file_type_usage')
+    file_type = models.CharField(max_length=50)
+    files_count = models.IntegerField(default=0)
+    bytes_used = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['owner', 'file_type'], name='unique_file_type_usage'),
+        ]
+
+
+class Thumbnail(models.Model):
+    """
+    A preview image of a File at one size (longest edge in pixels), rendered
+    in the background by `manage.py run_thumbnail_worker`. See
+    accounts.thumbnails.
+    """
+    STATUSES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    ]
+
+    file = models.ForeignKey(
+        File, on_delete=models.CASCADE, related_name='thumbnails')
+    size = models.IntegerField()
+    status = models.CharField(max_length=10, choices=STATUSES, default='pending')
+    image = models.FileField(
+        upload_to='thumbnails/%Y/%m/%d/', null=True, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+    attempts = models.IntegerField(default=0)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['file', 'size'], name='unique_thumbnail_size'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'id'], name='thumbnail_queue_idx'),
+        ]
+
+
+class UploadSession(models.Model):
+    """
+    A resumable chunked upload. Chunks are appended to a partial file on
+    local disk until `offset` reaches `size`, then it becomes a File.
+    The declared size counts against the quota while the session is open.
+    Multipart direct uploads are verified in the background after
+    finalizing, see accounts.uploads.verify_pending().
+    """
+    STATUSES = [
+        ('open', 'Open'),
+        ('verifying', 'Verifying'),
+        ('complete', 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        CustomUser, on_delete=models.CASCADE, related_name='upload_sessions')
+    folder = models.ForeignKey(
+        Folder, null=True, blank=True, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()  # declared total, in bytes
+    offset = models.BigIntegerField(default=0)  # bytes received so far
+    # Credit and quota held for this upload, see accounts.ledger
+    reservation = models.UUIDField(null=True, blank=True)
+    # Direct uploads (accounts.object_storage): the object the client PUTs
+    # to, its declared SHA-256 and the store's id for a multipart upload
+    storage_key = models.CharField(max_length=255, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+    multipart_id = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default='open')
+    error = models.CharField(max_length=255, blank=True)  # of the last verification
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # Set once complete, for clients polling a verified session
+    file = models.ForeignKey(
+        File, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only audit trail of credit and storage reservations. Every
+    reservation gets a 'reserve' entry followed by 'commit' or 'release'.
+    """
+    ACTIONS = [('reserve', 'Reserve'), ('commit', 'Commit'), ('release', 'Release')]
+
+    owner = models.ForeignKey(
+        CustomUser, null=True, on_delete=models.SET_NULL, related_name='ledger')
+    reservation = models.UUIDField(db_index=True)
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    credits = models.IntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    reference = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("Ledger entries cannot be changed")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Ledger entries cannot be deleted")
+
+
+class ChangeSequence(models.Model):
+    """
+    The owner's change journal counter, see accounts.journal. Updating it
+    locks the row until commit, so the owner's changes commit in `seq` order.
+    """
+    owner = models.OneToOneField(
+        CustomUser, on_delete=models.CASCADE, related_name='change_sequence')
+    last_seq = models.BigIntegerField(default=0)
+    # Changes up to here may have been compacted away; older cursors resync
+    floor = models.BigIntegerField(default=0)
+
+
+class Change(models.Model):
+    """
+    One journal entry: a File or Folder was created, renamed, moved,
+    deleted, restored, purged or updated. `seq` counts up per owner.
+    """
+    KINDS = [('file', 'File'), ('folder', 'Folder')]
+    ACTIONS = [
+        ('create', 'Create'), ('rename', 'Rename'), ('move', 'Move'),
+        ('delete', 'Delete'), ('restore', 'Restore'), ('purge', 'Purge'),
+        ('update', 'Update'),
+    ]
+
+    owner = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='changes')
+    seq = models.BigIntegerField()
+    kind = models.CharField(max_length=6, choices=KINDS)
+    item_id = models.BigIntegerField()  # no foreign key: purged items stay
+    action = models.CharField(max_length=7, choices=ACTIONS)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'seq'], name='unique_change_seq'),
+        ]
+        indexes = [
+            # Superseded entries, see accounts.journal.compact
+            models.Index(fields=['owner', 'kind', 'item_id', 'seq'], name='change_item_idx'),
+            models.Index(fields=['created_at'], name='change_age_idx'),
+        ]
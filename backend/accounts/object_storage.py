@@ -0,0 +1,304 @@
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core import signing
+from django.core.files import File as DjangoFile
+from django.urls import reverse
+
+from .models import File
+
+
+# Direct-to-storage uploads
+#
+# Direct upload sessions (accounts.uploads) give the client presigned URLs
+# to PUT the bytes to, in one request or as the parts of a multipart
+# upload, so they never pass through our workers. The objects are named
+# like any other stored file and live in the default storage: when the
+# session is finalized, the object's size and SHA-256 are checked and it
+# becomes the File's blob in place.
+#
+# Backends, chosen by DIRECT_UPLOADS["BACKEND"]:
+#
+#   "s3"     presigned URLs for S3 or an S3-compatible store (MinIO, moto).
+#            The default storage must be the same bucket (see STORAGES in
+#            settings). S3 checks each request's SHA-256 checksum and
+#            reports the object's, so finalizing reads no bytes; objects
+#            whose store gives no full-object SHA-256 (multipart uploads,
+#            stores without checksums) are hashed by reading them once;
+#            for multipart uploads, by the upload worker.
+#   "local"  the default storage with PUT URLs signed for our own
+#            receive_put() view. Bytes go through Django; for development.
+
+
+SIGNED_URL_SALT = "accounts.object_storage"
+BLOCK_SIZE = 1024 * 1024
+
+
+class ObjectStoreError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def storage():
+    return File._meta.get_field("file").storage
+
+
+def sha256_base64(hex_digest):
+    return base64.b64encode(bytes.fromhex(hex_digest)).decode()
+
+
+def hash_object(key):
+    """
+    The SHA-256 of a stored object, read in blocks.
+    """
+    sha256 = hashlib.sha256()
+    with storage().open(key, "rb") as content:
+        for block in iter(lambda: content.read(BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class LocalObjectStore:
+    def part_key(self, key, upload_id, number):
+        return f"{key}.parts/{upload_id}/{number:05d}"
+
+    def _url(self, **claims):
+        token = signing.dumps(claims, salt=SIGNED_URL_SALT, compress=True)
+        return {"method": "PUT", "url": f"{reverse('direct_upload_put')}?sig={token}",
+                "headers": {}}
+
+    def presign_put(self, key, size, sha256):
+        return self._url(k=key, s=size, h=sha256)
+
+    def start_multipart(self, key):
+        return os.urandom(16).hex()
+
+    def presign_part(self, key, upload_id, number, size, sha256):
+        return self._url(k=self.part_key(key, upload_id, number), s=size, h=sha256)
+
+    def list_parts(self, key, upload_id):
+        """
+        (number, size, tag) of the parts received so far, in order.
+        """
+        prefix = f"{key}.parts/{upload_id}"
+        try:
+            _, names = storage().listdir(prefix)
+        except FileNotFoundError:
+            return []
+        return [(int(name), storage().size(f"{prefix}/{name}"), name)
+                for name in sorted(names)]
+
+    def complete_multipart(self, key, upload_id, parts):
+        with tempfile.TemporaryFile() as joined:
+            for number, _, _ in parts:
+                with storage().open(self.part_key(key, upload_id, number), "rb") as part:
+                    for block in iter(lambda: part.read(BLOCK_SIZE), b""):
+                        joined.write(block)
+            joined.seek(0)
+            self._save(key, joined)
+        self.abort_multipart(key, upload_id)
+
+    def abort_multipart(self, key, upload_id):
+        for number, _, _ in self.list_parts(key, upload_id):
+            storage().delete(self.part_key(key, upload_id, number))
+
+    def stat(self, key):
+        """
+        (size, hex SHA-256 or None) of the object, or None if missing.
+        """
+        if not storage().exists(key):
+            return None
+        return storage().size(key), None
+
+    def read_head(self, key, length):
+        """
+        The object's first `length` bytes, or None if it is missing.
+        """
+        try:
+            with storage().open(key, "rb") as content:
+                return content.read(length)
+        except FileNotFoundError:
+            return None
+
+    def _save(self, key, content):
+        storage().delete(key)
+        name = storage().save(key, DjangoFile(content, name=key))
+        if name != key:
+            storage().delete(name)
+            raise ObjectStoreError("Object key is taken", status=409)
+
+    def receive_put(self, token, stream, length):
+        """
+        Store the body of a PUT to a URL from presign_put()/presign_part(),
+        checking it against the signed size and SHA-256 like S3 would.
+        """
+        try:
+            claims = signing.loads(
+                token, salt=SIGNED_URL_SALT, max_age=settings.DIRECT_UPLOADS["URL_TTL"])
+        except signing.BadSignature:
+            raise ObjectStoreError("Invalid or expired upload URL", status=403)
+        if length != claims["s"]:
+            raise ObjectStoreError("Content-Length does not match the upload", status=400)
+
+        sha256 = hashlib.sha256()
+        received = 0
+        with tempfile.TemporaryFile() as body:
+            while received < length:
+                block = stream.read(min(settings.UPLOAD_BLOCK_SIZE, length - received))
+                if not block:
+                    break
+                sha256.update(block)
+                body.write(block)
+                received += len(block)
+            if received != length:
+                raise ObjectStoreError("Incomplete body", status=400)
+            if sha256.hexdigest() != claims["h"]:
+                raise ObjectStoreError("Body does not match its SHA-256", status=400)
+            body.seek(0)
+            self._save(claims["k"], body)
+
+
+class S3ObjectStore:
+    def __init__(self, options):
+        import boto3
+        from botocore.config import Config
+
+        self.bucket = options["BUCKET"]
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=options.get("ENDPOINT_URL") or None,
+            region_name=options.get("REGION") or None,
+            aws_access_key_id=options.get("ACCESS_KEY_ID") or None,
+            aws_secret_access_key=options.get("SECRET_ACCESS_KEY") or None,
+            config=Config(signature_version="s3v4",
+                          s3={"addressing_style": options.get("ADDRESSING_STYLE", "auto")}),
+        )
+
+    def _presign(self, method, params, sha256):
+        checksum = sha256_base64(sha256)
+        url = self.client.generate_presigned_url(
+            method, Params={"Bucket": self.bucket, "ChecksumSHA256": checksum, **params},
+            ExpiresIn=settings.DIRECT_UPLOADS["URL_TTL"])
+        return {"method": "PUT", "url": url, "headers": {"x-amz-checksum-sha256": checksum}}
+
+    def presign_put(self, key, size, sha256):
+        return self._presign("put_object", {"Key": key, "ContentLength": size}, sha256)
+
+    def start_multipart(self, key):
+        return self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, ChecksumAlgorithm="SHA256")["UploadId"]
+
+    def presign_part(self, key, upload_id, number, size, sha256):
+        return self._presign("upload_part", {
+            "Key": key, "UploadId": upload_id, "PartNumber": number, "ContentLength": size,
+        }, sha256)
+
+    def list_parts(self, key, upload_id):
+        parts = []
+        paginator = self.client.get_paginator("list_parts")
+        for page in paginator.paginate(Bucket=self.bucket, Key=key, UploadId=upload_id):
+            for part in page.get("Parts", []):
+                tag = {"PartNumber": part["PartNumber"], "ETag": part["ETag"]}
+                if part.get("ChecksumSHA256"):
+                    tag["ChecksumSHA256"] = part["ChecksumSHA256"]
+                parts.append((part["PartNumber"], part["Size"], tag))
+        return parts
+
+    def complete_multipart(self, key, upload_id, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={"Parts": [tag for _, _, tag in parts]})
+
+    def abort_multipart(self, key, upload_id):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchUpload":
+                raise
+
+    def stat(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key, ChecksumMode="ENABLED")
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        checksum = head.get("ChecksumSHA256")
+        # Multipart objects carry a checksum of the parts' checksums
+        if not checksum or "-" in checksum or head.get("ChecksumType") == "COMPOSITE":
+            return head["ContentLength"], None
+        return head["ContentLength"], base64.b64decode(checksum).hex()
+
+    def read_head(self, key, length):
+        """
+        The object's first `length` bytes, without downloading the rest,
+        or None if it is missing.
+        """
+        from botocore.exceptions import ClientError
+
+        if not length:
+            return b""
+        try:
+            body = self.client.get_object(
+                Bucket=self.bucket, Key=key, Range=f"bytes=0-{length - 1}")["Body"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store():
+    config = settings.DIRECT_UPLOADS
+    name = config["BACKEND"]
+    key = (name, tuple(sorted(config["S3"].items())) if name == "s3" else None)
+    with _stores_lock:
+        if key not in _stores:
+            if name == "s3":
+                _stores[key] = S3ObjectStore(config["S3"])
+            else:
+                _stores[key] = LocalObjectStore()
+        return _stores[key]
+
+
+def checked_digest(key, size):
+    """
+    The SHA-256 the store reports for the object (None if it has none),
+    after checking that it is `size` bytes long. Raises ObjectStoreError if
+    it is missing or has the wrong size.
+    """
+    found = get_store().stat(key)
+    if found is None:
+        raise ObjectStoreError("Nothing was uploaded", status=409)
+    stored_size, digest = found
+    if stored_size != size:
+        raise ObjectStoreError(
+            f"Uploaded {stored_size} bytes, expected {size}", status=422)
+    return digest
+
+
+def verified_digest(key, size):
+    """
+    checked_digest(), hashing the object when the store does not report a
+    SHA-256.
+    """
+    digest = checked_digest(key, size)
+    if digest is None:
+        return hash_object(key)
+    return digest
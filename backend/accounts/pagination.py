@@ -0,0 +1,108 @@
+import base64
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from graphene.relay import PageInfo
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+# Keyset cursors
+#
+# Lists are ordered newest first on (created_at, id). A cursor encodes the
+# last row's sort key, so the next page is `WHERE (created_at, id) < cursor`
+# and can be served as an index range scan instead of OFFSET + sort.
+
+
+def encode_cursor(obj):
+    raw = f"{obj.created_at.isoformat()}|{obj.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split('|')
+        created_at = parse_datetime(created_at)
+        if created_at is None:
+            raise ValueError(cursor)
+        return created_at, int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise Exception("Invalid cursor")
+
+
+def _clamp(first):
+    if first is None:
+        first = DEFAULT_PAGE_SIZE
+    if first < 1:
+        raise Exception("first must be a positive number")
+    return min(first, MAX_PAGE_SIZE)
+
+
+def _page(queryset, connection_type, first, after, encode):
+    rows = list(queryset[:first + 1])
+    has_next = len(rows) > first
+    rows = rows[:first]
+
+    edges = [
+        connection_type.Edge(node=row, cursor=encode(row))
+        for row in rows
+    ]
+    return connection_type(
+        edges=edges,
+        page_info=PageInfo(
+            has_next_page=has_next,
+            has_previous_page=bool(after),
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
+    )
+
+
+def paginate(queryset, connection_type, first=None, after=None):
+    """
+    Return one page of `queryset` as an instance of `connection_type`.
+    """
+    first = _clamp(first)
+    queryset = queryset.order_by('-created_at', '-id')
+    if after:
+        created_at, pk = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    return _page(queryset, connection_type, first, after, encode_cursor)
+
+
+# Ranked results (accounts.search) are ordered by an integer `rank`
+# annotation first, and their cursors carry it too.
+
+
+def encode_ranked_cursor(obj):
+    raw = f"{obj.rank}|{obj.created_at.isoformat()}|{obj.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_ranked_cursor(cursor):
+    try:
+        rank, rest = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split('|', 1)
+        rest = base64.urlsafe_b64encode(rest.encode()).decode()
+        return (int(rank), *decode_cursor(rest))
+    except (ValueError, UnicodeDecodeError):
+        raise Exception("Invalid cursor")
+
+
+def paginate_ranked(queryset, connection_type, first=None, after=None):
+    """
+    Like paginate() for a queryset annotated with `rank`, best first.
+    """
+    first = _clamp(first)
+    queryset = queryset.order_by('-rank', '-created_at', '-id')
+    if after:
+        rank, created_at, pk = decode_ranked_cursor(after)
+        queryset = queryset.filter(
+            Q(rank__lt=rank)
+            | Q(rank=rank, created_at__lt=created_at)
+            | Q(rank=rank, created_at=created_at, id__lt=pk))
+    return _page(queryset, connection_type, first, after, encode_ranked_cursor)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from graphql import GraphQLError
+
+
+# Persisted queries
+#
+# Parsed and validated documents are kept in a per-process LRU keyed by the
+# SHA-256 of the query text, so repeated operations skip parse() and
+# validate(). Clients may also send only the hash, using the automatic
+# persisted query protocol:
+#
+#   {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "..."}}}
+#
+# An unknown hash answers PERSISTED_QUERY_NOT_FOUND and the client retries
+# with the query text, which registers it. With
+# GRAPHQL_PERSISTED_QUERIES["ALLOWLIST_ONLY"] only the operations in the
+# ALLOWLIST manifest ({"<sha256>": "<query>"}) are executed.
+
+
+class PersistedQueryError(GraphQLError):
+    def __init__(self, message, code):
+        super().__init__(message, extensions={"code": code})
+
+
+class PersistedQueryNotFound(PersistedQueryError):
+    def __init__(self):
+        super().__init__("PersistedQueryNotFound", "PERSISTED_QUERY_NOT_FOUND")
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+class DocumentCache:
+    """
+    LRU of validated documents keyed by query hash.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            document = self.entries.get(key)
+            if document is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return document
+
+    def peek(self, key):
+        """
+        The cached document, if any, without counting or reordering.
+        """
+        with self.lock:
+            return self.entries.get(key)
+
+    def set(self, key, document):
+        with self.lock:
+            self.entries[key] = document
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+
+documents = DocumentCache(settings.GRAPHQL_PERSISTED_QUERIES["CACHE_SIZE"])
+
+_allowlist = None
+_allowlist_lock = threading.Lock()
+
+
+def allowlist():
+    """
+    The {hash: query} manifest named by the ALLOWLIST setting, read once.
+    """
+    global _allowlist
+    if _allowlist is None:
+        with _allowlist_lock:
+            if _allowlist is None:
+                path = settings.GRAPHQL_PERSISTED_QUERIES["ALLOWLIST"]
+                manifest = {}
+                if path:
+                    with open(path) as f:
+                        manifest = json.load(f)
+                    for key, query in manifest.items():
+                        if query_hash(query) != key:
+                            raise ValueError(f"Persisted query {key} does not match its hash")
+                _allowlist = manifest
+    return _allowlist
+
+
+def reset():
+    global _allowlist
+    documents.clear()
+    _allowlist = None
+
+
+def persisted_hash(extensions):
+    """
+    The sha256Hash of a persistedQuery request extension, if any.
+    """
+    if isinstance(extensions, str):
+        try:
+            extensions = json.loads(extensions)
+        except ValueError:
+            raise GraphQLError("Extensions are invalid JSON.")
+    if extensions is None:
+        return None
+    if not isinstance(extensions, dict):
+        raise GraphQLError("Extensions must be a JSON object.")
+    persisted = extensions.get("persistedQuery")
+    if not persisted:
+        return None
+    if (not isinstance(persisted, dict) or persisted.get("version") != 1
+            or not isinstance(persisted.get("sha256Hash"), str) or not persisted["sha256Hash"]):
+        raise PersistedQueryError(
+            "Unsupported persisted query", "PERSISTED_QUERY_NOT_SUPPORTED")
+    return persisted["sha256Hash"]
+
+
+def lookup(query, sent_hash):
+    """
+    Return (key, query_text) for a request: the document cache key and the
+    text to parse if that key is not cached. Raises PersistedQueryError.
+    """
+    allowed_only = settings.GRAPHQL_PERSISTED_QUERIES["ALLOWLIST_ONLY"]
+    if query:
+        key = query_hash(query)
+        if sent_hash and sent_hash != key:
+            raise PersistedQueryError(
+                "provided sha does not match query", "PERSISTED_QUERY_HASH_MISMATCH")
+    elif sent_hash:
+        key = sent_hash
+        query = allowlist().get(key)
+    else:
+        raise GraphQLError("Must provide query string.")
+
+    if allowed_only and key not in allowlist():
+        raise PersistedQueryError(
+            "Operation is not in the persisted query allow-list",
+            "PERSISTED_QUERY_NOT_ALLOWED")
+    return key, query
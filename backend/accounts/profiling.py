@@ -0,0 +1,274 @@
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from inspect import isawaitable
+
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject, empty
+from graphql import get_named_type, is_leaf_type
+
+
+# Request profiling
+#
+# With GRAPHQL_PROFILING["ENABLED"], every GraphQL request gets a Profile:
+# ProfilingMiddleware (a graphene middleware, see GRAPHENE["MIDDLEWARE"])
+# times each resolver, and a database execute wrapper (installed on every
+# connection by AccountsConfig.ready) charges each SQL statement to the
+# field being resolved, or to "(request)" outside resolvers. Both find the
+# profile through a context variable, so threads started by sync_to_async
+# and async resolvers report to the right request.
+#
+# The result goes out as a Server-Timing header, as the response's
+# `extensions.profile` when EXTENSIONS is on (DEBUG; it contains SQL), and
+# as one JSON log line on the "accounts.profiling" logger for a sample of
+# requests and every request slower than LOG_SLOW_MS.
+
+
+logger = logging.getLogger(__name__)
+
+REQUEST_FIELD = "(request)"
+REPEATED_QUERY_THRESHOLD = 5  # same statement, any params: likely an N+1
+
+current_profile = ContextVar("graphql_profile", default=None)
+current_field = ContextVar("graphql_profile_field", default=REQUEST_FIELD)
+
+
+class FieldStats:
+    __slots__ = ("calls", "seconds", "queries", "sql_seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+class Profile:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.lock = threading.Lock()
+        self.fields = {}
+        self.queries = []  # (sql, params, seconds, field)
+
+    def _field(self, path):
+        stats = self.fields.get(path)
+        if stats is None:
+            stats = self.fields[path] = FieldStats()
+        return stats
+
+    def record_field(self, path, seconds):
+        with self.lock:
+            stats = self._field(path)
+            stats.calls += 1
+            stats.seconds += seconds
+
+    def record_query(self, sql, params, seconds):
+        field = current_field.get()
+        with self.lock:
+            stats = self._field(field)
+            stats.queries += 1
+            stats.sql_seconds += seconds
+            self.queries.append((sql, params, seconds, field))
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    @property
+    def sql_seconds(self):
+        return sum(seconds for _, _, seconds, _ in self.queries)
+
+    def duplicates(self):
+        """
+        Statements run more than once with the same parameters, and
+        statements run at least REPEATED_QUERY_THRESHOLD times with any.
+        """
+        statements = Counter()
+        exact = Counter()
+        fields = {}
+        for sql, params, _, field in self.queries:
+            statements[sql] += 1
+            exact[sql, repr(params)] += 1
+            fields.setdefault(sql, set()).add(field)
+        identical = {}
+        for (sql, _), count in exact.items():
+            identical[sql] = max(identical.get(sql, 0), count)
+        found = []
+        for sql, count in statements.most_common():
+            same_params = identical[sql]
+            if same_params > 1 or count >= REPEATED_QUERY_THRESHOLD:
+                found.append({
+                    "sql": sql,
+                    "count": count,
+                    "identical": same_params,
+                    "fields": sorted(fields[sql]),
+                })
+        return found
+
+    def summary(self, include_sql=False):
+        top = sorted(
+            self.fields.items(), key=lambda item: item[1].seconds + item[1].sql_seconds,
+            reverse=True)[:settings.GRAPHQL_PROFILING["TOP_FIELDS"]]
+        duplicates = self.duplicates()
+        if not include_sql:
+            for duplicate in duplicates:
+                duplicate["sql"] = duplicate["sql"][:120]
+        return {
+            "durationMs": round(self.elapsed * 1000, 3),
+            "sql": {"count": len(self.queries), "durationMs": round(self.sql_seconds * 1000, 3)},
+            "fields": [
+                {
+                    "path": path,
+                    "calls": stats.calls,
+                    "durationMs": round(stats.seconds * 1000, 3),
+                    "sqlCount": stats.queries,
+                    "sqlDurationMs": round(stats.sql_seconds * 1000, 3),
+                }
+                for path, stats in top
+            ],
+            "duplicates": duplicates,
+        }
+
+    def server_timing(self):
+        resolvers = sum(stats.seconds for stats in self.fields.values())
+        return (
+            f"total;dur={self.elapsed * 1000:.1f}, "
+            f'sql;dur={self.sql_seconds * 1000:.1f};desc="{len(self.queries)} queries", '
+            f"resolvers;dur={resolvers * 1000:.1f}")
+
+
+def enabled():
+    return settings.GRAPHQL_PROFILING["ENABLED"]
+
+
+@contextmanager
+def profile_request():
+    """
+    Profile the GraphQL request handled in the block, if enabled.
+    """
+    if not enabled():
+        yield None
+        return
+    token = current_profile.set(Profile())
+    try:
+        yield current_profile.get()
+    finally:
+        current_profile.reset(token)
+
+
+def extension():
+    """
+    The `extensions.profile` value for the current request, or None.
+    """
+    profile = current_profile.get()
+    if profile is None or not settings.GRAPHQL_PROFILING["EXTENSIONS"]:
+        return None
+    return profile.summary(include_sql=True)
+
+
+def finish(request, response):
+    """
+    Add the Server-Timing header and log the profile if it is sampled.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        return
+    config = settings.GRAPHQL_PROFILING
+    if config["SERVER_TIMING"]:
+        response["Server-Timing"] = profile.server_timing()
+        origin = request.headers.get("Origin")
+        if origin in settings.CORS_ALLOWED_ORIGINS:
+            response["Timing-Allow-Origin"] = origin
+    slow = profile.elapsed * 1000 >= config["LOG_SLOW_MS"]
+    if slow or random.random() < config["LOG_SAMPLE_RATE"]:
+        summary = profile.summary()
+        summary.update(
+            status=response.status_code, slow=slow,
+            user=_user_id(request))
+        logger.info(json.dumps(summary), extra={"graphql_profile": summary})
+
+
+def _user_id(request):
+    # Never authenticate just for the log line (and not on the event loop)
+    user = getattr(request, "user", None)
+    if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+        return None
+    return getattr(user, "pk", None)
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.record_query(sql, params, time.perf_counter() - start)
+
+
+def install(sender, connection, **kwargs):
+    """
+    connection_created receiver adding execute_wrapper to new connections.
+    """
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(execute_wrapper)
+
+
+def field_path(info):
+    return ".".join(str(key) for key in info.path.as_list() if not isinstance(key, int))
+
+
+class ProfilingMiddleware:
+    """
+    Graphene middleware timing resolvers into the current Profile. Scalar
+    fields with default resolvers are not timed (they only read attributes).
+    """
+
+    def __init__(self):
+        self.skipped = {}
+
+    def skip(self, info):
+        key = (info.parent_type.name, info.field_name)
+        skip = self.skipped.get(key)
+        if skip is None:
+            from .graphql_view import runs_inline
+
+            # None for __typename and the introspection fields
+            field = info.parent_type.fields.get(info.field_name)
+            skip = self.skipped[key] = field is None or (
+                is_leaf_type(get_named_type(field.type)) and runs_inline(field))
+        return skip
+
+    def resolve(self, next, root, info, **args):
+        profile = current_profile.get()
+        if profile is None or self.skip(info):
+            return next(root, info, **args)
+
+        path = field_path(info)
+        token = current_field.set(path)
+        start = time.perf_counter()
+        try:
+            result = next(root, info, **args)
+        except Exception:
+            profile.record_field(path, time.perf_counter() - start)
+            raise
+        finally:
+            current_field.reset(token)
+        if isawaitable(result):
+            return self.timed(result, profile, path, start)
+        profile.record_field(path, time.perf_counter() - start)
+        return result
+
+    async def timed(self, awaitable, profile, path, start):
+        token = current_field.set(path)
+        try:
+            return await awaitable
+        finally:
+            current_field.reset(token)
+            profile.record_field(path, time.perf_counter() - start)
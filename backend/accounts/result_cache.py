@@ -0,0 +1,221 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from graphql import OperationType
+from graphql.language import FieldNode
+
+
+# Query result cache
+#
+# Read queries whose root fields are all listed in RESULT_CACHE["FIELDS"]
+# are cached per user, keyed by the document, operation name and variables.
+# Every key also carries the user's version counter, and every mutation
+# (plus uploads, purges and thumbnail renders outside GraphQL) bumps it via
+# invalidate(), so older entries are simply never read again and age out.
+#
+# Those bumps come from every web worker and from the upload, purge and
+# thumbnail worker processes, so the versions must live in a cache they all
+# share: "django" uses caches[RESULT_CACHE["CACHE_ALIAS"]] (e.g. Redis).
+# The "locmem" backend, or an alias that is itself per-process, would miss
+# the other processes' bumps and serve stale results until the TTL, so they
+# are refused unless RESULT_CACHE["SINGLE_PROCESS"] says one process does
+# everything (development, tests).
+
+
+VERSION_PREFIX = "gqlcache:version:"
+RESULT_PREFIX = "gqlcache:result:"
+STATS_PREFIX = "gqlcache:stats:"
+
+
+class LocalBackend:
+    """
+    Per-process LRU with expiry, the subset of the cache API used here.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires_at = time.monotonic() + timeout if timeout else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+
+    def incr(self, key):
+        with self.lock:
+            value, expires_at = self.entries.get(key, (0, None))
+            self.entries[key] = (value + 1, expires_at)
+            self.entries.move_to_end(key)
+            return value + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DjangoBackend:
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        self.cache.add(key, value, timeout)
+
+    def incr(self, key):
+        self.cache.add(key, 0, timeout=None)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Evicted between add() and incr()
+            self.cache.set(key, 1, timeout=None)
+            return 1
+
+    def clear(self):
+        self.cache.clear()
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+PER_PROCESS_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def get_backend():
+    config = settings.RESULT_CACHE
+    name = config["BACKEND"]
+    if not config.get("SINGLE_PROCESS") and (
+            name != "django"
+            or settings.CACHES[config["CACHE_ALIAS"]]["BACKEND"] in PER_PROCESS_CACHES):
+        raise ImproperlyConfigured(
+            "RESULT_CACHE needs a cache shared by every process, or SINGLE_PROCESS")
+    key = (name, config.get("CACHE_ALIAS"), config.get("SIZE"))
+    with _backends_lock:
+        if key not in _backends:
+            if name == "django":
+                _backends[key] = DjangoBackend(config["CACHE_ALIAS"])
+            else:
+                _backends[key] = LocalBackend(config["SIZE"])
+        return _backends[key]
+
+
+def enabled():
+    return settings.RESULT_CACHE["ENABLED"]
+
+
+def version(user_id):
+    """
+    The user's current version. Counters start from the clock, so one that
+    was evicted comes back above every value it had before.
+    """
+    backend = get_backend()
+    key = f"{VERSION_PREFIX}{user_id}"
+    value = backend.get(key)
+    if value is None:
+        backend.add(key, time.time_ns() // 1000, timeout=None)
+        value = backend.get(key, 0)
+    return value
+
+
+def invalidate(user_id):
+    """
+    Make every cached result of `user_id` stale, once the current
+    transaction commits (bumping earlier would let a concurrent read cache
+    the old rows under the new version).
+    """
+    if enabled() and user_id is not None:
+        def bump():
+            version(user_id)  # seed it first, see version()
+            get_backend().incr(f"{VERSION_PREFIX}{user_id}")
+        # The change is committed either way; a cache outage is logged
+        transaction.on_commit(bump, robust=True)
+
+
+def cacheable(operation):
+    """
+    True if `operation` is a query selecting only cacheable root fields.
+    """
+    if operation.operation != OperationType.QUERY:
+        return False
+    fields = settings.RESULT_CACHE["FIELDS"]
+    selections = operation.selection_set.selections
+    return bool(selections) and all(
+        isinstance(selection, FieldNode) and selection.name.value in fields
+        for selection in selections
+    )
+
+
+def key_for(request, operation, document_key, variables, operation_name):
+    """
+    The cache key for this request, or None if it must not be cached.
+    """
+    user = getattr(request, "user", None)
+    if not enabled() or user is None or not user.is_authenticated:
+        return None
+    if not cacheable(operation):
+        return None
+    variables = json.dumps(variables or {}, sort_keys=True, default=str)
+    digest = hashlib.sha256(
+        f"{document_key}|{operation_name or ''}|{variables}".encode()).hexdigest()
+    return f"{RESULT_PREFIX}{user.pk}:{version(user.pk)}:{digest}"
+
+
+def _record(outcome):
+    get_backend().incr(f"{STATS_PREFIX}{outcome}")
+
+
+def load(key):
+    data = get_backend().get(key)
+    _record("hits" if data is not None else "misses")
+    return data
+
+
+def store(key, data):
+    get_backend().set(key, data, settings.RESULT_CACHE["TTL"])
+
+
+def stats():
+    backend = get_backend()
+    hits = backend.get(f"{STATS_PREFIX}hits", 0)
+    misses = backend.get(f"{STATS_PREFIX}misses", 0)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+    }
@@ -3,8 +3,16 @@ from google.oauth2 import id_token
 import os
 from rest_framework_simplejwt.tokens import RefreshToken
 from allauth.socialaccount.models import SocialAccount
-from django.db.models import Sum
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from .models import CustomUser, File, Folder
+from . import (
+    archives, blobs, downloads, events, filetypes, journal, ledger, search, thumbnails, tree,
+    usage)
+from .loaders import get_loaders, load_rows, project
+from .middleware import TOKEN_VERSION_CLAIM, USER_CLAIMS
+from .pagination import paginate, paginate_ranked
 from django.contrib.auth import authenticate
 from graphene_file_upload.scalars import Upload
 from graphene_django import DjangoObjectType
@@ -14,6 +22,11 @@ import graphene
 # Helper to generate JWTs
 def get_tokens_for_user(user):
     refresh = RefreshToken.for_user(user)
+    # Lets the auth middleware check revocation and, in stateless mode,
+    # rebuild the user without a query
+    refresh[TOKEN_VERSION_CLAIM] = user.token_version
+    for claim in USER_CLAIMS:
+        refresh[claim] = getattr(user, claim)
     return {
         "refresh": str(refresh),
         "access": str(refresh.access_token),
@@ -31,17 +44,30 @@ class UserType(DjangoObjectType):
 class FileType(DjangoObjectType):
     class Meta:
         model = File
-        fields = ("id", "name", "created_at", "size", "file_type", "file")
+        fields = ("id", "name", "created_at", "size", "file_type", "mime_type", "file")
 
     owner_avatar = graphene.String()
     file_url = graphene.String()
+    download_url = graphene.String()
+    thumbnail_url = graphene.String(size=graphene.Int(default_value=256))
 
     def resolve_owner_avatar(self, info):
-        return self.owner.avatar_initials
+        owner = get_loaders(info).users.load(self.owner_id)
+        return owner.avatar_initials if owner else ""
 
     def resolve_file_url(self, info):
         return self.file.url if self.file else ""
 
+    def resolve_download_url(self, info):
+        return downloads.signed_url(self)
+
+    def resolve_thumbnail_url(self, info, size):
+        if self.file_type not in thumbnails.SUPPORTED_TYPES:
+            return None
+        thumbnail = get_loaders(info).thumbnails.load(
+            self.pk, thumbnails.pick_size(size))
+        return thumbnail.image.url if thumbnail else None
+
 
 # Folder type
 class FolderType(DjangoObjectType):
@@ -49,15 +75,78 @@ class FolderType(DjangoObjectType):
         model = Folder
         fields = ("id", "name", "created_at", "parent")
 
+    def resolve_parent(self, info):
+        return get_loaders(info).folders.load(self.parent_id)
+
+
+# Columns each selectable field needs, used to project list querysets
+FILE_PROJECTION = {
+    "id": ["id"],
+    "name": ["name"],
+    "createdAt": ["created_at"],
+    "size": ["size"],
+    "fileType": ["file_type"],
+    "mimeType": ["mime_type"],
+    "file": ["file"],
+    "fileUrl": ["file"],
+    "ownerAvatar": ["owner"],
+    "downloadUrl": [],
+    "thumbnailUrl": ["file_type"],
+}
+
+FOLDER_PROJECTION = {
+    "id": ["id"],
+    "name": ["name"],
+    "createdAt": ["created_at"],
+    "parent": ["parent"],
+}
+
+# Paginated connections
+class FileConnection(graphene.relay.Connection):
+    class Meta:
+        node = FileType
+
+
+class FolderConnection(graphene.relay.Connection):
+    class Meta:
+        node = FolderType
+
+
+def file_connection_field():
+    return graphene.Field(
+        FileConnection, first=graphene.Int(), after=graphene.String())
+
+
+def folder_connection_field():
+    return graphene.Field(
+        FolderConnection, first=graphene.Int(), after=graphene.String())
+
+
+def paginate_rows(info, queryset, connection_type, projection, first, after,
+                  paginator=paginate):
+    connection = paginator(
+        project(info, queryset, projection, "edges", "node"),
+        connection_type, first, after)
+    get_loaders(info).prime_rows([edge.node for edge in connection.edges])
+    return connection
+
+
+# Live files and bytes of one category, see accounts.filetypes
+class FileTypeCountType(graphene.ObjectType):
+    file_type = graphene.String()
+    count = graphene.Int()
+    bytes = graphene.BigInt()
+
 
 # Dashboard stats type
 class DashboardStatsType(graphene.ObjectType):
-    images_count = graphene.Int()
-    pdfs_count = graphene.Int()
-    docs_count = graphene.Int()
+    file_types = graphene.List(FileTypeCountType)
+    images_count = graphene.Int(deprecation_reason="Use fileTypes")
+    pdfs_count = graphene.Int(deprecation_reason="Use fileTypes")
+    docs_count = graphene.Int(deprecation_reason="Use fileTypes")
     folders_count = graphene.Int()
-    mp3s_count = graphene.Int()
-    videos_count = graphene.Int()
+    mp3s_count = graphene.Int(deprecation_reason="Use fileTypes")
+    videos_count = graphene.Int(deprecation_reason="Use fileTypes")
     total_storage_used = graphene.Int()
     storage_limit = graphene.Int()
 
@@ -66,12 +155,27 @@ class DashboardStatsType(graphene.ObjectType):
 class FolderContentsType(graphene.ObjectType):
     files = graphene.List(FileType)
     folders = graphene.List(FolderType)
+    files_connection = file_connection_field()
+    folders_connection = folder_connection_field()
+
+    def resolve_files(self, info):
+        return load_rows(info, self.files, FILE_PROJECTION)
+
+    def resolve_folders(self, info):
+        return load_rows(info, self.folders, FOLDER_PROJECTION)
+
+    def resolve_files_connection(self, info, first=None, after=None):
+        return paginate_rows(info, self.files, FileConnection,
+                             FILE_PROJECTION, first, after)
+
+    def resolve_folders_connection(self, info, first=None, after=None):
+        return paginate_rows(info, self.folders, FolderConnection,
+                             FOLDER_PROJECTION, first, after)
 
 
 # Bin contents type
-class BinContentsType(graphene.ObjectType):
-    files = graphene.List(FileType)
-    folders = graphene.List(FolderType)
+class BinContentsType(FolderContentsType):
+    pass
 
 
 # Folder info type
@@ -79,6 +183,60 @@ class FolderInfoType(graphene.ObjectType):
     id = graphene.ID()
     name = graphene.String()
     parent_id = graphene.ID()
+    # Ancestors from the root down to the parent
+    breadcrumbs = graphene.List(lambda: FolderInfoType)
+
+    @classmethod
+    def of(cls, folder):
+        info_type = cls(id=folder.id, name=folder.name, parent_id=folder.parent_id)
+        info_type.ancestor_ids = tree.ancestor_ids(folder)
+        return info_type
+
+    def resolve_breadcrumbs(self, info):
+        ancestors = Folder.objects.filter(
+            id__in=self.ancestor_ids).only('id', 'name', 'parent_id', 'path').in_bulk()
+        return [
+            FolderInfoType.of(a)
+            for a in (ancestors.get(pk) for pk in self.ancestor_ids) if a
+        ]
+
+
+# Archive download type
+class ArchiveType(graphene.ObjectType):
+    url = graphene.String()  # signed, like FileType.download_url
+    name = graphene.String()
+    files_count = graphene.Int()
+    size = graphene.BigInt()  # bytes of file content
+    # Bytes of the archive itself, null when members are compressed
+    content_length = graphene.BigInt()
+
+
+# One entry of the change feed, see accounts.journal
+class ChangeType(graphene.ObjectType):
+    kind = graphene.String()  # "file" or "folder"
+    id = graphene.ID()
+    # Latest of create, rename, move, delete, restore, purge, update
+    action = graphene.String()
+    deleted = graphene.Boolean()  # in the bin or purged
+    parent_id = graphene.ID()  # containing folder, null at the root
+    # Current row, null once purged
+    file = graphene.Field(FileType)
+    folder = graphene.Field(FolderType)
+
+    def resolve_file(self, info):
+        return self.item if self.kind == "file" else None
+
+    def resolve_folder(self, info):
+        return self.item if self.kind == "folder" else None
+
+
+class ChangesType(graphene.ObjectType):
+    changes = graphene.List(ChangeType)
+    # Pass as `since` next time
+    cursor = graphene.String()
+    has_more = graphene.Boolean()
+    # The cursor is too old: list everything again, then continue from `cursor`
+    resync = graphene.Boolean()
 
 
 # Upload file mutation
@@ -95,14 +253,6 @@ class UploadFileMutation(graphene.Mutation):
         if user.is_anonymous:
             raise Exception("Not authenticated")
 
-        # Storage check
-        total_storage_used = File.objects.filter(owner=user, is_deleted=False).aggregate(
-            total_size=Sum('size')
-        )['total_size'] or 0
-        new_files_size = sum(f.size for f in files)
-        if total_storage_used + new_files_size > user.storage_limit:
-            raise Exception("Storage limit exceeded. Upgrade your plan.")
-
         # Folder check
         folder = None
         if folder_id:
@@ -112,36 +262,41 @@ class UploadFileMutation(graphene.Mutation):
             except Folder.DoesNotExist:
                 raise Exception("Folder not found")
 
-        # ⚡ Deduct credits (e.g., 1 credit per file uploaded)
+        # ⚡ Deduct credits (e.g., 1 credit per file uploaded) and reserve
+        # the storage, atomically, before writing anything
         cost_per_file = 1
         total_cost = len(files) * cost_per_file
-
-        if user.credits < total_cost:
-            raise Exception("Not enough credits to upload files")
-
-        user.credits -= total_cost
-        user.save()
-
-        # Save files
-        for uploaded_file in files:
-            file_extension = uploaded_file.name.split('.')[-1].lower()
-            file_type = (
-                'image' if file_extension in ['jpg', 'jpeg', 'png', 'gif']
-                else 'pdf' if file_extension == 'pdf'
-                else 'doc' if file_extension in ['doc', 'docx']
-                else 'mp3' if file_extension == 'mp3'
-                else 'video' if file_extension == 'mp4'
-                else 'other'
-            )
-
-            File.objects.create(
-                name=uploaded_file.name,
-                owner=user,
-                folder=folder,
-                size=uploaded_file.size,
-                file_type=file_type,
-                file=uploaded_file
-            )
+        new_files_size = sum(f.size for f in files)
+        try:
+            reservation = ledger.reserve(
+                user, credits=total_cost, bytes=new_files_size, reference="upload")
+        except ledger.ReservationError as e:
+            raise Exception(str(e))
+
+        with reservation, transaction.atomic():
+            # Save files
+            totals = {}
+            created = []
+            for uploaded_file in files:
+                mime_type, file_type = filetypes.classify(
+                    uploaded_file.name, filetypes.head_of(uploaded_file))
+                blob = blobs.store(uploaded_file)
+                created.append(File.objects.create(
+                    name=uploaded_file.name,
+                    owner=user,
+                    folder=folder,
+                    size=uploaded_file.size,
+                    file_type=file_type,
+                    mime_type=mime_type,
+                    file=blob.file.name,
+                    blob=blob,
+                ))
+                totals = usage.merge_totals(
+                    totals, {file_type: (1, uploaded_file.size)})
+            usage.apply_file_totals(user, totals)
+            thumbnails.enqueue(created)
+            journal.record(user.pk, "create", files=[file.pk for file in created])
+            reservation.commit()
 
         return UploadFileMutation(success=True, message="Files uploaded successfully. Credits deducted.")
 
@@ -168,7 +323,11 @@ class CreateFolderMutation(graphene.Mutation):
             except Folder.DoesNotExist:
                 raise Exception("Parent folder not found")
 
-        folder = Folder.objects.create(name=name, owner=user, parent=parent)
+        with transaction.atomic():
+            folder = Folder.objects.create(
+                name=name, owner=user, parent=parent)
+            usage.apply_folder_count(user, 1)
+            journal.record(user.pk, "create", folders=[folder.pk])
         return CreateFolderMutation(folder=folder)
 
 
@@ -186,9 +345,11 @@ class RenameFileMutation(graphene.Mutation):
             raise Exception("Not authenticated")
 
         try:
-            file = File.objects.get(id=file_id, owner=user, is_deleted=False)
-            file.name = new_name
-            file.save()
+            with transaction.atomic():
+                file = File.objects.get(id=file_id, owner=user, is_deleted=False)
+                file.name = new_name
+                file.save()
+                journal.record(user.pk, "rename", files=[file.pk])
             return RenameFileMutation(success=True, message="File renamed successfully")
         except File.DoesNotExist:
             raise Exception("File not found")
@@ -208,10 +369,12 @@ class RenameFolderMutation(graphene.Mutation):
             raise Exception("Not authenticated")
 
         try:
-            folder = Folder.objects.get(
-                id=folder_id, owner=user, is_deleted=False)
-            folder.name = new_name
-            folder.save()
+            with transaction.atomic():
+                folder = Folder.objects.get(
+                    id=folder_id, owner=user, is_deleted=False)
+                folder.name = new_name
+                folder.save()
+                journal.record(user.pk, "rename", folders=[folder.pk])
             return RenameFolderMutation(success=True, message="Folder renamed successfully")
         except Folder.DoesNotExist:
             raise Exception("Folder not found")
@@ -230,9 +393,15 @@ class DeleteFileMutation(graphene.Mutation):
             raise Exception("Not authenticated")
 
         try:
-            file = File.objects.get(id=file_id, owner=user, is_deleted=False)
-            file.is_deleted = True
-            file.save()
+            with transaction.atomic():
+                file = File.objects.get(
+                    id=file_id, owner=user, is_deleted=False)
+                file.is_deleted = True
+                file.deleted_at = timezone.now()
+                file.save()
+                usage.apply_file_totals(
+                    user, {file.file_type: (1, file.size)}, sign=-1)
+                journal.record(user.pk, "delete", files=[file.pk])
             return DeleteFileMutation(success=True, message="File moved to bin")
         except File.DoesNotExist:
             raise Exception("File not found")
@@ -251,16 +420,21 @@ class DeleteFolderMutation(graphene.Mutation):
             raise Exception("Not authenticated")
 
         try:
-            folder = Folder.objects.get(
-                id=folder_id, owner=user, is_deleted=False)
-            folder.is_deleted = True
-            folder.save()
-            # Soft-delete all files in the folder
-            File.objects.filter(folder=folder, owner=user,
-                                is_deleted=False).update(is_deleted=True)
-            # Soft-delete all subfolders
-            Folder.objects.filter(parent=folder, owner=user,
-                                  is_deleted=False).update(is_deleted=True)
+            with transaction.atomic():
+                folder = Folder.objects.get(
+                    id=folder_id, owner=user, is_deleted=False)
+                # Soft-delete every file and folder in the subtree
+                files = tree.subtree_files(folder).filter(is_deleted=False)
+                folders = tree.subtree_folders(folder).filter(is_deleted=False)
+                totals = usage.file_totals(files)
+                file_ids = list(files.values_list('id', flat=True))
+                folder_ids = list(folders.values_list('id', flat=True))
+                now = timezone.now()
+                files.update(is_deleted=True, deleted_at=now)
+                trashed = folders.update(is_deleted=True, deleted_at=now)
+                usage.apply_file_totals(user, totals, sign=-1)
+                usage.apply_folder_count(user, -trashed)
+                journal.record(user.pk, "delete", files=file_ids, folders=folder_ids)
             return DeleteFolderMutation(success=True, message="Folder moved to bin")
         except Folder.DoesNotExist:
             raise Exception("Folder not found")
@@ -279,8 +453,10 @@ class DeleteFileForeverMutation(graphene.Mutation):
             raise Exception("Not authenticated")
 
         try:
-            file = File.objects.get(id=file_id, owner=user, is_deleted=True)
-            file.delete()
+            with transaction.atomic():
+                file = File.objects.get(id=file_id, owner=user, is_deleted=True)
+                blobs.delete_files(File.objects.filter(pk=file.pk))
+                journal.record(user.pk, "purge", files=[file.pk])
             return DeleteFileForeverMutation(success=True, message="File permanently deleted")
         except File.DoesNotExist:
             raise Exception("File not found in bin")
@@ -299,20 +475,107 @@ class DeleteFolderForeverMutation(graphene.Mutation):
             raise Exception("Not authenticated")
 
         try:
-            folder = Folder.objects.get(
-                id=folder_id, owner=user, is_deleted=True)
-            # Delete all files in the folder
-            File.objects.filter(folder=folder, owner=user,
-                                is_deleted=True).delete()
-            # Delete all subfolders recursively
-            Folder.objects.filter(parent=folder, owner=user,
-                                  is_deleted=True).delete()
-            folder.delete()
+            with transaction.atomic():
+                folder = Folder.objects.get(
+                    id=folder_id, owner=user, is_deleted=True)
+                # Anything in the subtree that was restored on its own is
+                # removed too, so take it off the counters first
+                files = tree.subtree_files(folder)
+                live_totals = usage.file_totals(files.filter(is_deleted=False))
+                folders = tree.subtree_folders(folder)
+                live_folders = folders.filter(is_deleted=False).count()
+                file_ids = list(files.values_list('id', flat=True))
+                folder_ids = list(folders.values_list('id', flat=True))
+                # Delete the whole subtree, files first
+                blobs.delete_files(files)
+                folders.delete()
+                usage.apply_file_totals(user, live_totals, sign=-1)
+                usage.apply_folder_count(user, -live_folders)
+                journal.record(user.pk, "purge", files=file_ids, folders=folder_ids)
             return DeleteFolderForeverMutation(success=True, message="Folder permanently deleted")
         except Folder.DoesNotExist:
             raise Exception("Folder not found in bin")
 
 
+# Restores run inside the mutation's transaction, so a failure rolls the
+# reservation back with everything else
+def _reserve_restore(user, size):
+    try:
+        return ledger.reserve(user, bytes=size, reference="restore")
+    except ledger.ReservationError as e:
+        raise Exception(str(e))
+
+
+class RestoreFileMutation(graphene.Mutation):
+    class Arguments:
+        file_id = graphene.ID(required=True)
+
+    success = graphene.Boolean()
+    message = graphene.String()
+
+    def mutate(self, info, file_id):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+
+        try:
+            with transaction.atomic():
+                file = File.objects.select_related('folder').get(
+                    id=file_id, owner=user, is_deleted=True)
+                reservation = _reserve_restore(user, file.size)
+                file.is_deleted = False
+                file.deleted_at = None
+                # A file whose folder is still in the bin goes back to root
+                if file.folder and file.folder.is_deleted:
+                    file.folder = None
+                file.save()
+                usage.apply_file_totals(
+                    user, {file.file_type: (1, file.size)})
+                journal.record(user.pk, "restore", files=[file.pk])
+                reservation.commit()
+            return RestoreFileMutation(success=True, message="File restored")
+        except File.DoesNotExist:
+            raise Exception("File not found in bin")
+
+
+class RestoreFolderMutation(graphene.Mutation):
+    class Arguments:
+        folder_id = graphene.ID(required=True)
+
+    success = graphene.Boolean()
+    message = graphene.String()
+
+    def mutate(self, info, folder_id):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+
+        try:
+            with transaction.atomic():
+                folder = Folder.objects.select_related('parent').get(
+                    id=folder_id, owner=user, is_deleted=True)
+                files = tree.subtree_files(folder).filter(is_deleted=True)
+                totals = usage.file_totals(files)
+                reservation = _reserve_restore(
+                    user, sum(s for _, s in totals.values()))
+                # A folder whose parent is still in the bin goes back to root
+                if folder.parent and folder.parent.is_deleted:
+                    tree.move_subtree(folder, None)
+                # Restore every file and folder in the subtree
+                folders = tree.subtree_folders(folder).filter(is_deleted=True)
+                file_ids = list(files.values_list('id', flat=True))
+                folder_ids = list(folders.values_list('id', flat=True))
+                files.update(is_deleted=False, deleted_at=None)
+                restored = folders.update(is_deleted=False, deleted_at=None)
+                usage.apply_file_totals(user, totals)
+                usage.apply_folder_count(user, restored)
+                journal.record(user.pk, "restore", files=file_ids, folders=folder_ids)
+                reservation.commit()
+            return RestoreFolderMutation(success=True, message="Folder restored")
+        except Folder.DoesNotExist:
+            raise Exception("Folder not found in bin")
+
+
 # Auth mutations
 class RegisterMutation(graphene.Mutation):
     class Arguments:
@@ -377,69 +640,181 @@ class GoogleLoginMutation(graphene.Mutation):
             raise Exception(f"Google login failed: {str(e)}")
 
 
+def dashboard_stats(user, stats, totals):
+    # Every category, then types only older rows still have
+    names = filetypes.categories()
+    names += sorted(set(totals) - set(names))
+    totals = {name: totals.get(name, (0, 0)) for name in names}
+    counts = {name: count for name, (count, _) in totals.items()}
+    return DashboardStatsType(
+        file_types=[
+            FileTypeCountType(file_type=name, count=count, bytes=size)
+            for name, (count, size) in totals.items()
+        ],
+        images_count=counts['image'],
+        pdfs_count=counts['pdf'],
+        docs_count=counts['doc'],
+        mp3s_count=counts['mp3'],
+        videos_count=counts['video'],
+        folders_count=stats.folders_count,
+        total_storage_used=stats.bytes_used,
+        storage_limit=user.storage_limit,
+    )
+
+
+def live_folder(user, folder_id):
+    return Folder.objects.filter(id=folder_id, owner=user, is_deleted=False)
+
+
+def folder_contents(user, folder_id):
+    # Lazy querysets, evaluated by the FolderContentsType resolvers
+    return FolderContentsType(
+        files=File.objects.filter(
+            owner=user, folder_id=folder_id, is_deleted=False).order_by('-created_at'),
+        folders=Folder.objects.filter(
+            owner=user, parent_id=folder_id, is_deleted=False).order_by('-created_at')
+    )
+
+
+def _search_folder(user, folder_id):
+    if not folder_id:
+        return None
+    try:
+        return Folder.objects.get(id=folder_id, owner=user, is_deleted=False)
+    except Folder.DoesNotExist:
+        raise Exception("Folder not found or not accessible")
+
+
 class Query(graphene.ObjectType):
     me = graphene.Field(UserType)
     dashboard_stats = graphene.Field(DashboardStatsType)
     user_files = graphene.List(FileType)
     user_folders = graphene.List(FolderType)
+    user_files_connection = file_connection_field()
+    user_folders_connection = folder_connection_field()
     folder_contents = graphene.Field(
         FolderContentsType, folder_id=graphene.ID(required=True))
     folder_info = graphene.Field(
         FolderInfoType, folder_id=graphene.ID(required=True))
     bin_contents = graphene.Field(BinContentsType)
+    search_files = graphene.Field(
+        FileConnection, query=graphene.String(required=True),
+        file_type=graphene.String(), folder_id=graphene.ID(),
+        first=graphene.Int(), after=graphene.String())
+    search_folders = graphene.Field(
+        FolderConnection, query=graphene.String(required=True),
+        folder_id=graphene.ID(), first=graphene.Int(), after=graphene.String())
+    download_archive = graphene.Field(
+        ArchiveType, file_ids=graphene.List(graphene.ID),
+        folder_ids=graphene.List(graphene.ID), compress=graphene.Boolean(default_value=False))
+    changes = graphene.Field(
+        ChangesType, since=graphene.String(), limit=graphene.Int())
+    # Opens /events/ for EventSource, which cannot send an Authorization header
+    event_stream_url = graphene.String()
 
     def resolve_me(self, info):
         user = info.context.user
         if user.is_anonymous:
             raise Exception("Not authenticated")
+        if getattr(user, 'is_stateless', False):
+            # Credits are not in the token claims
+            return CustomUser.objects.get(pk=user.pk)
         return user
 
     def resolve_dashboard_stats(self, info):
         user = info.context.user
         if user.is_anonymous:
             raise Exception("Not authenticated")
-        files = File.objects.filter(owner=user, is_deleted=False)
-        folders = Folder.objects.filter(owner=user, is_deleted=False)
-        return DashboardStatsType(
-            images_count=files.filter(file_type='image').count(),
-            pdfs_count=files.filter(file_type='pdf').count(),
-            docs_count=files.filter(file_type='doc').count(),
-            mp3s_count=files.filter(file_type='mp3').count(),
-            videos_count=files.filter(file_type='video').count(),
-            folders_count=folders.count(),
-            total_storage_used=files.aggregate(total_size=Sum('size'))[
-                'total_size'] or 0,
-            storage_limit=user.storage_limit,
-        )
+        return dashboard_stats(
+            user, usage.get_usage(user), usage.file_type_totals(user))
 
     def resolve_user_files(self, info):
         user = info.context.user
         if user.is_anonymous:
             raise Exception("Not authenticated")
-        return File.objects.filter(owner=user, is_deleted=False).order_by('-created_at')
+        return load_rows(info, File.objects.filter(
+            owner=user, is_deleted=False).order_by('-created_at'), FILE_PROJECTION)
 
     def resolve_user_folders(self, info):
         user = info.context.user
         if user.is_anonymous:
             raise Exception("Not authenticated")
-        return Folder.objects.filter(owner=user, is_deleted=False).order_by('-created_at')
+        return load_rows(info, Folder.objects.filter(
+            owner=user, is_deleted=False).order_by('-created_at'), FOLDER_PROJECTION)
 
-    def resolve_folder_contents(self, info, folder_id):
+    def resolve_user_files_connection(self, info, first=None, after=None):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+        return paginate_rows(info, File.objects.filter(owner=user, is_deleted=False),
+                             FileConnection, FILE_PROJECTION, first, after)
+
+    def resolve_user_folders_connection(self, info, first=None, after=None):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+        return paginate_rows(info, Folder.objects.filter(owner=user, is_deleted=False),
+                             FolderConnection, FOLDER_PROJECTION, first, after)
+
+    def resolve_search_files(self, info, query, file_type=None, folder_id=None,
+                             first=None, after=None):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+        folder = _search_folder(user, folder_id)
+        return paginate_rows(info, search.search_files(user, query, file_type, folder),
+                             FileConnection, FILE_PROJECTION, first, after,
+                             paginator=paginate_ranked)
+
+    def resolve_search_folders(self, info, query, folder_id=None, first=None, after=None):
         user = info.context.user
         if user.is_anonymous:
             raise Exception("Not authenticated")
+        folder = _search_folder(user, folder_id)
+        return paginate_rows(info, search.search_folders(user, query, folder),
+                             FolderConnection, FOLDER_PROJECTION, first, after,
+                             paginator=paginate_ranked)
+
+    def resolve_download_archive(self, info, file_ids=None, folder_ids=None, compress=False):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+        file_ids, folder_ids = _parse_ids(file_ids), _parse_ids(folder_ids)
         try:
-            folder = Folder.objects.get(
-                id=folder_id, owner=user, is_deleted=False)
-        except Folder.DoesNotExist:
-            raise Exception("Folder not found or not accessible")
-        return FolderContentsType(
-            files=File.objects.filter(
-                owner=user, folder_id=folder_id, is_deleted=False).order_by('-created_at'),
-            folders=Folder.objects.filter(
-                owner=user, parent_id=folder_id, is_deleted=False).order_by('-created_at')
+            selection = archives.select(user, file_ids, folder_ids, compress)
+        except archives.ArchiveError as e:
+            raise Exception(str(e))
+        return ArchiveType(
+            url=archives.signed_url(user, file_ids, folder_ids, compress),
+            name=selection.name,
+            files_count=selection.files,
+            size=selection.size,
+            content_length=selection.content_length(),
         )
 
+    def resolve_changes(self, info, since=None, limit=None):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+        feed = journal.changes(user, since, limit)
+        return ChangesType(
+            changes=feed.deltas, cursor=feed.cursor, has_more=feed.has_more,
+            resync=feed.resync)
+
+    def resolve_event_stream_url(self, info):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+        return events.signed_url(user)
+
+    def resolve_folder_contents(self, info, folder_id):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+        if not live_folder(user, folder_id).exists():
+            raise Exception("Folder not found or not accessible")
+        return folder_contents(user, folder_id)
+
     def resolve_folder_info(self, info, folder_id):
         user = info.context.user
         if user.is_anonymous:
@@ -447,11 +822,7 @@ class Query(graphene.ObjectType):
         try:
             folder = Folder.objects.get(
                 id=folder_id, owner=user, is_deleted=False)
-            return FolderInfoType(
-                id=folder.id,
-                name=folder.name,
-                parent_id=folder.parent_id if folder.parent else None
-            )
+            return FolderInfoType.of(folder)
         except Folder.DoesNotExist:
             raise Exception("Folder not found or not accessible")
 
@@ -488,8 +859,10 @@ class MoveFileMutation(graphene.Mutation):
             if folder_id:
                 folder = Folder.objects.get(
                     id=folder_id, owner=user, is_deleted=False)
-            file.folder = folder
-            file.save()
+            with transaction.atomic():
+                file.folder = folder
+                file.save()
+                journal.record(user.pk, "move", files=[file.pk])
             return MoveFileMutation(success=True, message="File moved successfully")
         except File.DoesNotExist:
             raise Exception("File not found")
@@ -520,18 +893,250 @@ class MoveFolderMutation(graphene.Mutation):
                 new_parent = Folder.objects.get(
                     id=parent_id, owner=user, is_deleted=False)
                 # Check for circular reference
-                current = new_parent
-                while current:
-                    if current.id == folder_id:
-                        raise Exception(
-                            "Cannot move folder into itself or its descendants")
-                    current = current.parent
-            folder.parent = new_parent
-            folder.save()
+                if tree.is_within(new_parent, folder):
+                    raise Exception(
+                        "Cannot move folder into itself or its descendants")
+            with transaction.atomic():
+                tree.move_subtree(folder, new_parent)
+                journal.record(user.pk, "move", folders=[folder.pk])
             return MoveFolderMutation(success=True, message="Folder moved successfully")
         except Folder.DoesNotExist:
             raise Exception("Folder or target parent not found")
 
+# Bulk item mutations
+#
+# Each takes lists of file and folder ids, checks ownership with one query
+# per model, applies the change with set-based updates in one transaction
+# and reports a result per requested id.
+
+
+class ItemResultType(graphene.ObjectType):
+    id = graphene.ID()
+    kind = graphene.String()  # "file" or "folder"
+    success = graphene.Boolean()
+    message = graphene.String()
+
+
+def _parse_ids(ids):
+    parsed = []
+    for pk in ids or []:
+        try:
+            parsed.append(int(pk))
+        except (TypeError, ValueError):
+            pass
+    return parsed
+
+
+def _item_results(kind, requested, done, missing, errors=None):
+    errors = errors or {}
+    results = []
+    for pk in requested or []:
+        key = int(pk) if str(pk).isdigit() else None
+        if key in done:
+            results.append(ItemResultType(id=pk, kind=kind, success=True))
+        else:
+            results.append(ItemResultType(
+                id=pk, kind=kind, success=False, message=errors.get(key, missing)))
+    return results
+
+
+def _bulk_response(mutation, results, verb):
+    done = sum(1 for r in results if r.success)
+    message = f"{done} of {len(results)} items {verb}"
+    return mutation(success=done == len(results), message=message, results=results)
+
+
+class MoveItemsMutation(graphene.Mutation):
+    class Arguments:
+        file_ids = graphene.List(graphene.ID)
+        folder_ids = graphene.List(graphene.ID)
+        target_folder_id = graphene.ID(required=False)  # null for root
+
+    success = graphene.Boolean()
+    message = graphene.String()
+    results = graphene.List(ItemResultType)
+
+    def mutate(self, info, file_ids=None, folder_ids=None, target_folder_id=None):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+
+        with transaction.atomic():
+            target = None
+            if target_folder_id:
+                try:
+                    target = Folder.objects.select_for_update().get(
+                        id=target_folder_id, owner=user, is_deleted=False)
+                except Folder.DoesNotExist:
+                    raise Exception("Target folder not found")
+
+            files = File.objects.filter(
+                owner=user, is_deleted=False, id__in=_parse_ids(file_ids))
+            moved_files = set(files.values_list('id', flat=True))
+            File.objects.filter(id__in=moved_files).update(folder=target)
+
+            # Deepest first, so moving a folder never changes the path of
+            # one still waiting to be moved
+            folders = sorted(
+                Folder.objects.select_for_update().filter(
+                    owner=user, is_deleted=False, id__in=_parse_ids(folder_ids)),
+                key=lambda f: -len(tree.ancestor_ids(f)))
+            moved_folders, errors = set(), {}
+            for folder in folders:
+                if target and tree.is_within(target, folder):
+                    errors[folder.id] = "Cannot move folder into itself or its descendants"
+                    continue
+                tree.move_subtree(folder, target)
+                moved_folders.add(folder.id)
+            journal.record(user.pk, "move", files=sorted(moved_files),
+                           folders=[f.id for f in folders if f.id in moved_folders])
+
+        results = (_item_results("file", file_ids, moved_files, "File not found")
+                   + _item_results("folder", folder_ids, moved_folders,
+                                   "Folder not found", errors))
+        return _bulk_response(MoveItemsMutation, results, "moved")
+
+
+class DeleteItemsMutation(graphene.Mutation):
+    class Arguments:
+        file_ids = graphene.List(graphene.ID)
+        folder_ids = graphene.List(graphene.ID)
+
+    success = graphene.Boolean()
+    message = graphene.String()
+    results = graphene.List(ItemResultType)
+
+    def mutate(self, info, file_ids=None, folder_ids=None):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+
+        with transaction.atomic():
+            found_files = set(File.objects.filter(
+                owner=user, is_deleted=False, id__in=_parse_ids(file_ids)
+            ).values_list('id', flat=True))
+            folders = list(Folder.objects.filter(
+                owner=user, is_deleted=False, id__in=_parse_ids(folder_ids)))
+
+            # Soft-delete the files and every file and folder in the subtrees
+            subtrees = tree.subtrees_folders(user.id, folders)
+            files = File.objects.filter(owner=user, is_deleted=False).filter(
+                Q(id__in=found_files) | Q(folder_id__in=subtrees.values('id')))
+            totals = usage.file_totals(files)
+            live = subtrees.filter(is_deleted=False)
+            changed_files = list(files.values_list('id', flat=True))
+            changed_folders = list(live.values_list('id', flat=True))
+            now = timezone.now()
+            files.update(is_deleted=True, deleted_at=now)
+            trashed = live.update(is_deleted=True, deleted_at=now)
+            usage.apply_file_totals(user, totals, sign=-1)
+            usage.apply_folder_count(user, -trashed)
+            journal.record(user.pk, "delete", files=changed_files, folders=changed_folders)
+
+        results = (_item_results("file", file_ids, found_files, "File not found")
+                   + _item_results("folder", folder_ids, {f.id for f in folders},
+                                   "Folder not found"))
+        return _bulk_response(DeleteItemsMutation, results, "moved to bin")
+
+
+class RestoreItemsMutation(graphene.Mutation):
+    class Arguments:
+        file_ids = graphene.List(graphene.ID)
+        folder_ids = graphene.List(graphene.ID)
+
+    success = graphene.Boolean()
+    message = graphene.String()
+    results = graphene.List(ItemResultType)
+
+    def mutate(self, info, file_ids=None, folder_ids=None):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+
+        with transaction.atomic():
+            found_files = list(File.objects.select_related('folder').filter(
+                owner=user, is_deleted=True, id__in=_parse_ids(file_ids)))
+            folders = list(Folder.objects.select_related('parent').filter(
+                owner=user, is_deleted=True, id__in=_parse_ids(folder_ids)))
+
+            subtrees = tree.subtrees_folders(user.id, folders)
+            files = File.objects.filter(owner=user, is_deleted=True).filter(
+                Q(id__in=[f.id for f in found_files])
+                | Q(folder_id__in=subtrees.values('id')))
+            totals = usage.file_totals(files)
+            reservation = _reserve_restore(
+                user, sum(s for _, s in totals.values()))
+
+            binned = subtrees.filter(is_deleted=True)
+            changed_files = list(files.values_list('id', flat=True))
+            changed_folders = list(binned.values_list('id', flat=True))
+            files.update(is_deleted=False, deleted_at=None)
+            restored = binned.update(is_deleted=False, deleted_at=None)
+
+            # Items whose parent stays in the bin go back to root
+            def stays_deleted(folder):
+                return folder.is_deleted and not any(
+                    tree.is_within(folder, f) for f in folders)
+            File.objects.filter(id__in=[
+                f.id for f in found_files if f.folder and stays_deleted(f.folder)
+            ]).update(folder=None)
+            orphans = [f for f in folders if f.parent and stays_deleted(f.parent)]
+            for folder in orphans:
+                tree.move_subtree(folder, None)
+
+            usage.apply_file_totals(user, totals)
+            usage.apply_folder_count(user, restored)
+            journal.record(user.pk, "restore", files=changed_files, folders=changed_folders)
+            reservation.commit()
+
+        results = (_item_results("file", file_ids, {f.id for f in found_files},
+                                 "File not found in bin")
+                   + _item_results("folder", folder_ids, {f.id for f in folders},
+                                   "Folder not found in bin"))
+        return _bulk_response(RestoreItemsMutation, results, "restored")
+
+
+class PurgeItemsMutation(graphene.Mutation):
+    class Arguments:
+        file_ids = graphene.List(graphene.ID)
+        folder_ids = graphene.List(graphene.ID)
+
+    success = graphene.Boolean()
+    message = graphene.String()
+    results = graphene.List(ItemResultType)
+
+    def mutate(self, info, file_ids=None, folder_ids=None):
+        user = info.context.user
+        if user.is_anonymous:
+            raise Exception("Not authenticated")
+
+        with transaction.atomic():
+            found_files = set(File.objects.filter(
+                owner=user, is_deleted=True, id__in=_parse_ids(file_ids)
+            ).values_list('id', flat=True))
+            folders = list(Folder.objects.filter(
+                owner=user, is_deleted=True, id__in=_parse_ids(folder_ids)))
+
+            subtrees = tree.subtrees_folders(user.id, folders)
+            files = File.objects.filter(owner=user).filter(
+                Q(id__in=found_files) | Q(folder_id__in=subtrees.values('id')))
+            # Anything in the subtrees that was restored on its own goes too
+            live_totals = usage.file_totals(files.filter(is_deleted=False))
+            live_folders = subtrees.filter(is_deleted=False).count()
+            changed_files = list(files.values_list('id', flat=True))
+            changed_folders = list(subtrees.values_list('id', flat=True))
+            blobs.delete_files(files)
+            subtrees.delete()
+            usage.apply_file_totals(user, live_totals, sign=-1)
+            usage.apply_folder_count(user, -live_folders)
+            journal.record(user.pk, "purge", files=changed_files, folders=changed_folders)
+
+        results = (_item_results("file", file_ids, found_files, "File not found in bin")
+                   + _item_results("folder", folder_ids, {f.id for f in folders},
+                                   "Folder not found in bin"))
+        return _bulk_response(PurgeItemsMutation, results, "permanently deleted")
+
+
 # Update Mutation class
 
 
@@ -547,8 +1152,54 @@ class Mutation(graphene.ObjectType):
     delete_folder = DeleteFolderMutation.Field()
     delete_file_forever = DeleteFileForeverMutation.Field()
     delete_folder_forever = DeleteFolderForeverMutation.Field()
+    restore_file = RestoreFileMutation.Field()
+    restore_folder = RestoreFolderMutation.Field()
     move_file = MoveFileMutation.Field()
     move_folder = MoveFolderMutation.Field()
+    move_items = MoveItemsMutation.Field()
+    delete_items = DeleteItemsMutation.Field()
+    restore_items = RestoreItemsMutation.Field()
+    purge_items = PurgeItemsMutation.Field()
 
 
 schema = graphene.Schema(query=Query, mutation=Mutation)
+
+
+# Async resolvers
+#
+# Used instead of the Query resolvers above by AsyncGraphQLView
+# (accounts.graphql_view), keyed by (type name, field name). Fields without
+# one run their sync resolver in a worker thread.
+
+
+async def resolve_me_async(root, info):
+    user = info.context.user
+    if user.is_anonymous:
+        raise Exception("Not authenticated")
+    if getattr(user, 'is_stateless', False):
+        return await CustomUser.objects.aget(pk=user.pk)
+    return user
+
+
+async def resolve_dashboard_stats_async(root, info):
+    user = info.context.user
+    if user.is_anonymous:
+        raise Exception("Not authenticated")
+    return dashboard_stats(
+        user, await usage.aget_usage(user), await usage.afile_type_totals(user))
+
+
+async def resolve_folder_contents_async(root, info, folder_id):
+    user = info.context.user
+    if user.is_anonymous:
+        raise Exception("Not authenticated")
+    if not await live_folder(user, folder_id).aexists():
+        raise Exception("Folder not found or not accessible")
+    return folder_contents(user, folder_id)
+
+
+ASYNC_RESOLVERS = {
+    ("Query", "me"): resolve_me_async,
+    ("Query", "dashboardStats"): resolve_dashboard_stats_async,
+    ("Query", "folderContents"): resolve_folder_contents_async,
+}
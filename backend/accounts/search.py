@@ -0,0 +1,73 @@
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from . import tree
+from .models import File, Folder
+
+
+# Name search
+#
+# Every word of the query must appear in the name (case-insensitive
+# substring). On Postgres these `UPPER(name) LIKE '%word%'` filters are
+# answered by the trigram indexes from migration 0013; elsewhere they scan
+# the owner's rows. Matches are ranked exact name > name prefix > word
+# prefix > substring, then newest first, which keeps keyset pagination
+# possible (see accounts.pagination.paginate_ranked).
+
+
+MAX_QUERY_LENGTH = 100
+MIN_SUBSTRING_LENGTH = 3  # shorter queries only match name prefixes
+
+RANK_EXACT = 3
+RANK_PREFIX = 2
+RANK_WORD_PREFIX = 1
+RANK_SUBSTRING = 0
+
+
+def normalize(query):
+    return ' '.join((query or '').split())[:MAX_QUERY_LENGTH]
+
+
+def rank_names(queryset, query):
+    """
+    Filter `queryset` to names matching `query` and annotate each row's rank.
+    An empty query matches nothing.
+    """
+    if not query:
+        match = Q(pk__in=[])
+    elif len(query) < MIN_SUBSTRING_LENGTH:
+        match = Q(name__istartswith=query)
+    else:
+        match = Q()
+        for word in query.split(' '):
+            match &= Q(name__icontains=word)
+    return queryset.filter(match).annotate(rank=Case(
+        When(name__iexact=query, then=Value(RANK_EXACT)),
+        When(name__istartswith=query, then=Value(RANK_PREFIX)),
+        When(name__icontains=f' {query}', then=Value(RANK_WORD_PREFIX)),
+        default=Value(RANK_SUBSTRING),
+        output_field=IntegerField(),
+    ))
+
+
+def search_files(user, query, file_type=None, folder=None):
+    """
+    The user's files matching `query`, optionally of one type and within
+    `folder`'s subtree. Unordered; paginate with paginate_ranked().
+    """
+    query = normalize(query)
+    files = tree.subtree_files(folder) if folder is not None else File.objects.filter(owner=user)
+    files = files.filter(is_deleted=False)
+    if file_type:
+        files = files.filter(file_type=file_type)
+    return rank_names(files, query)
+
+
+def search_folders(user, query, folder=None):
+    """
+    The user's folders matching `query`, optionally below `folder`.
+    """
+    query = normalize(query)
+    folders = Folder.objects.filter(owner=user, is_deleted=False)
+    if folder is not None:
+        folders = folders.filter(path__startswith=folder.path).exclude(pk=folder.pk)
+    return rank_names(folders, query)
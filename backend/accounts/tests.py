@@ -1,3 +1,1896 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import pathlib
+import tempfile
+import threading
+import time
+import zipfile
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, connection
+from django.test import (
+    AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature)
+from django.test.utils import CaptureQueriesContext
+
+from cryogenum_backend.schema import schema
+from .graphql_view import AsyncGraphQLView
+from . import (
+    archives, benchmark, blobs, downloads, events, explain, filetypes, journal, ledger, limits,
+    object_storage, persisted, profiling, result_cache, thumbnails, trash, tree, uploads, usage)
+from .middleware import STAMP_PREFIX, user_cache
+from .models import (
+    Blob, Change, CustomUser, File, FileTypeUsage, Folder, LedgerEntry, StorageUsage, Thumbnail,
+    UploadSession)
+from .schema import get_tokens_for_user
+from .usage import get_usage, rebuild_usage
+from .views import archive_download
+
+
+def execute(query, user, **variables):
+    request = RequestFactory().post('/graphql/')
+    request.user = user
+    result = schema.execute(
+        query, context_value=request, variable_values=variables)
+    if result.errors:
+        raise result.errors[0]
+    return result.data
+
+
+class GraphQLTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='Ada Lovelace', email='ada@example.com', password='secret')
+
+    def seed(self, count):
+        parent = None
+        for i in range(count):
+            parent = Folder.objects.create(
+                name=f'folder {i}', owner=self.user, parent=parent)
+            File.objects.create(
+                name=f'file {i}.pdf', owner=self.user, folder=parent,
+                size=10, file_type='pdf')
+
+
+class QueryCountTests(GraphQLTestCase):
+    LIST_QUERY = """
+        query {
+            userFiles { id name ownerAvatar thumbnailUrl }
+            userFolders { id name parent { id name } }
+            userFilesConnection(first: 100) {
+                edges { node { id ownerAvatar } }
+            }
+        }
+    """
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            execute(self.LIST_QUERY, self.user)
+        return len(queries)
+
+    def test_list_queries_do_not_grow_with_rows(self):
+        self.seed(3)
+        small = self.count_queries()
+        self.seed(30)
+        self.assertEqual(self.count_queries(), small)
+
+    def test_owner_avatar_is_resolved_without_user_queries(self):
+        self.seed(5)
+        with self.assertNumQueries(1):  # the files; the owner is the request user
+            data = execute("query { userFiles { ownerAvatar } }", self.user)
+        self.assertEqual({f['ownerAvatar'] for f in data['userFiles']}, {'AL'})
+
+
+class PaginationTests(GraphQLTestCase):
+    QUERY = """
+        query($first: Int, $after: String) {
+            userFilesConnection(first: $first, after: $after) {
+                edges { node { name } cursor }
+                pageInfo { hasNextPage hasPreviousPage endCursor }
+            }
+        }
+    """
+
+    def page(self, first, after=None):
+        return execute(self.QUERY, self.user, first=first, after=after)['userFilesConnection']
+
+    def test_cursors_walk_every_row_once(self):
+        self.seed(5)
+        names, after = [], None
+        while True:
+            page = self.page(2, after)
+            names += [edge['node']['name'] for edge in page['edges']]
+            self.assertEqual(page['pageInfo']['hasPreviousPage'], after is not None)
+            self.assertEqual(page['pageInfo']['endCursor'], page['edges'][-1]['cursor'])
+            if not page['pageInfo']['hasNextPage']:
+                break
+            after = page['pageInfo']['endCursor']
+        self.assertEqual(names, [f'file {i}.pdf' for i in reversed(range(5))])
+        # The last page is full but nothing follows it
+        last = self.page(1, self.page(4)['pageInfo']['endCursor'])
+        self.assertEqual([e['node']['name'] for e in last['edges']], ['file 0.pdf'])
+        self.assertFalse(last['pageInfo']['hasNextPage'])
+
+    def test_invalid_arguments_are_rejected(self):
+        for first, after, message in ((2, 'not a cursor', 'Invalid cursor'),
+                                      (2, 'MjAyNHwx', 'Invalid cursor'),
+                                      (0, None, 'first must be a positive number'),
+                                      (-1, None, 'first must be a positive number')):
+            with self.subTest(first=first, after=after):
+                with self.assertRaisesMessage(Exception, message):
+                    self.page(first, after)
+        with self.assertRaisesMessage(Exception, 'limit must be a positive number'):
+            journal.changes(self.user, limit=0)
+
+
+@skipUnless(explain.supported(), "EXPLAIN parsing is implemented for SQLite and PostgreSQL")
+class QueryPlanTests(GraphQLTestCase):
+    """
+    Every hot resolver's SQL must use an index: no full scans of our tables
+    and no sorts beyond the ranked search order.
+    """
+
+    def setUp(self):
+        super().setUp()
+        other = CustomUser.objects.create_user(
+            username='Grace Hopper', email='grace@example.com', password='secret')
+        for owner in (self.user, other):
+            parent = None
+            for i in range(20):
+                parent = Folder.objects.create(
+                    name=f'folder {i}', owner=owner, parent=parent if i % 4 else None,
+                    is_deleted=i % 5 == 0)
+                File.objects.bulk_create(
+                    File(name=f'file {i}-{j}.{kind}', owner=owner, folder=parent if j else None,
+                         size=10, file_type=kind, is_deleted=j == 3)
+                    for j, kind in enumerate(['pdf', 'image', 'doc', 'video']))
+        self.folder = Folder.objects.filter(owner=self.user, is_deleted=False).last()
+        get_usage(self.user)
+
+    CASES = [
+        ("dashboardStats", "{ dashboardStats { pdfsCount foldersCount totalStorageUsed } }",
+         {}, False),
+        ("userFiles", "{ userFiles { id name thumbnailUrl } }", {}, False),
+        ("userFolders", "{ userFolders { id name parent { id } } }", {}, False),
+        ("userFilesConnection", """
+            query($after: String) { userFilesConnection(first: 5, after: $after) {
+                edges { node { id } } pageInfo { endCursor } } }""", {}, False),
+        ("userFoldersConnection", """
+            { userFoldersConnection(first: 5) { edges { node { id name } } } }""", {}, False),
+        ("folderContents", """
+            query($folderId: ID!) { folderContents(folderId: $folderId) {
+                files { id } folders { id }
+                filesConnection(first: 5) { edges { node { id } } }
+                foldersConnection(first: 5) { edges { node { id } } } } }""", {"folder": True}, False),
+        ("folderInfo", """
+            query($folderId: ID!) { folderInfo(folderId: $folderId) {
+                id breadcrumbs { id name } } }""", {"folder": True}, False),
+        ("binContents", "{ binContents { files { id } folders { id } } }", {}, False),
+        ("searchFiles", """
+            { searchFiles(query: "file", fileType: "pdf", first: 5) { edges { node { id } } } }""",
+         {}, True),
+    ]
+
+    def test_resolvers_use_indexes(self):
+        for name, query, variables, allow_sort in self.CASES:
+            with self.subTest(name):
+                if variables.pop("folder", False):
+                    variables = {**variables, "folderId": self.folder.pk}
+                with explain.capture() as statements:
+                    execute(query, self.user, **variables)
+                self.assertTrue(statements)
+                self.assertEqual(explain.problems(statements, allow_sort=allow_sort), [])
+
+    def test_second_page_uses_the_index(self):
+        query = self.CASES[3][1]
+        cursor = execute(query, self.user)['userFilesConnection']['pageInfo']['endCursor']
+        with explain.capture() as statements:
+            execute(query, self.user, after=cursor)
+        self.assertEqual(explain.problems(statements), [])
+
+    def test_detects_scans_and_sorts(self):
+        with explain.capture() as statements:
+            list(File.objects.filter(name='x').order_by('size'))
+        found = explain.problems(statements)
+        self.assertEqual(len(found), 2)
+        self.assertIn("Full scan of accounts_file", found[0])
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class BenchmarkTests(TestCase):
+    def test_runs_every_operation_and_rolls_back(self):
+        results = benchmark.run(iterations=2, users=2, folders=6, files=30, depth=3)
+        self.assertEqual(
+            set(results["operations"]), {op.name for op in benchmark.OPERATIONS})
+        self.assertEqual(results["meta"]["files"], 30)
+        self.assertGreater(results["operations"]["userFiles"]["queries"], 0)
+        json.dumps(results)
+        self.assertFalse(CustomUser.objects.exists())
+
+        slower = json.loads(json.dumps(results))
+        slower["operations"]["me"]["p95_ms"] = results["operations"]["me"]["p95_ms"] * 2
+        slower["operations"]["userFiles"]["queries"] += 1
+        self.assertEqual(len(benchmark.compare(results, slower)), 2)
+        self.assertEqual(benchmark.compare(results, results), [])
+
+
+class FolderTreeTests(GraphQLTestCase):
+    def test_delete_and_restore_cover_the_whole_subtree(self):
+        self.seed(4)
+        root = Folder.objects.get(name='folder 0')
+        execute('mutation($id: ID!) { deleteFolder(folderId: $id) { success } }',
+                self.user, id=root.id)
+        self.assertFalse(Folder.objects.filter(is_deleted=False).exists())
+        self.assertFalse(File.objects.filter(is_deleted=False).exists())
+
+        execute('mutation($id: ID!) { restoreFolder(folderId: $id) { success } }',
+                self.user, id=root.id)
+        self.assertFalse(Folder.objects.filter(is_deleted=True).exists())
+        self.assertFalse(File.objects.filter(is_deleted=True).exists())
+
+    def test_move_rewrites_paths_and_rejects_cycles(self):
+        self.seed(3)
+        top, middle, leaf = Folder.objects.order_by('id')
+        with self.assertRaises(Exception):
+            execute('mutation($id: ID!, $to: ID) { moveFolder(folderId: $id, parentId: $to) { success } }',
+                    self.user, id=top.id, to=leaf.id)
+
+        execute('mutation($id: ID!) { moveFolder(folderId: $id) { success } }',
+                self.user, id=middle.id)
+        leaf.refresh_from_db()
+        self.assertEqual(leaf.path, f'{middle.id}/{leaf.id}/')
+
+        data = execute('query($id: ID!) { folderInfo(folderId: $id) { breadcrumbs { name } } }',
+                       self.user, id=leaf.id)
+        self.assertEqual(data['folderInfo']['breadcrumbs'], [{'name': 'folder 1'}])
+
+    def test_nested_breadcrumbs(self):
+        self.seed(3)
+        top, middle, leaf = Folder.objects.order_by('id')
+        data = execute("""
+            query($id: ID!) { folderInfo(folderId: $id) {
+                breadcrumbs { name breadcrumbs { name } } } }""", self.user, id=leaf.id)
+        self.assertEqual(data['folderInfo']['breadcrumbs'], [
+            {'name': 'folder 0', 'breadcrumbs': []},
+            {'name': 'folder 1', 'breadcrumbs': [{'name': 'folder 0'}]},
+        ])
+
+    def test_move_rereads_paths_under_the_lock(self):
+        self.seed(3)
+        top, middle, leaf = Folder.objects.order_by('id')
+        stale_leaf = Folder.objects.get(pk=leaf.pk)
+        tree.move_subtree(middle, None)
+        # `stale_leaf` still has the path from before `middle` left `top`
+        tree.move_subtree(top, stale_leaf)
+        top.refresh_from_db()
+        self.assertEqual(top.path, f'{middle.id}/{leaf.id}/{top.id}/')
+        with self.assertRaisesMessage(Exception, "Cannot move folder into itself"):
+            tree.move_subtree(middle, Folder.objects.get(pk=top.pk))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class UsageTests(GraphQLTestCase):
+    UPLOAD = 'mutation($files: [Upload]!) { uploadFile(files: $files) { success } }'
+
+    def usage(self):
+        stored = get_usage(self.user)
+        return (stored.files_count, stored.bytes_used, stored.folders_count,
+                usage.file_type_totals(self.user))
+
+    def test_mutations_keep_the_counters_in_step(self):
+        get_usage(self.user)
+        execute(self.UPLOAD, self.user, files=[
+            SimpleUploadedFile('a.pdf', b'%PDF-1.7\n' + b'x' * 11),
+            SimpleUploadedFile('b.txt', b'plain text'),
+        ])
+        execute('mutation { createFolder(name: "docs") { folder { id } } }', self.user)
+        pdf, txt = File.objects.order_by('id')
+        self.assertEqual(self.usage(), (2, 30, 1, {pdf.file_type: (1, 20), txt.file_type: (1, 10)}))
+
+        execute('mutation($id: ID!) { deleteFile(fileId: $id) { success } }', self.user, id=pdf.pk)
+        self.assertEqual(self.usage(), (1, 10, 1, {pdf.file_type: (0, 0), txt.file_type: (1, 10)}))
+        execute('mutation($id: ID!) { restoreFile(fileId: $id) { success } }', self.user, id=pdf.pk)
+        self.assertEqual(self.usage(), (2, 30, 1, {pdf.file_type: (1, 20), txt.file_type: (1, 10)}))
+
+        execute('mutation($id: ID!) { deleteFile(fileId: $id) { success } }', self.user, id=pdf.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            execute('mutation($id: ID!) { deleteFileForever(fileId: $id) { success } }',
+                    self.user, id=pdf.pk)
+        self.assertEqual(self.usage(), (1, 10, 1, {pdf.file_type: (0, 0), txt.file_type: (1, 10)}))
+        self.assertEqual(rebuild_usage(self.user)[1], False)
+
+    def test_rebuild_fixes_drifted_counters(self):
+        self.seed(2)
+        self.assertEqual(rebuild_usage(self.user)[1], True)  # built
+        StorageUsage.objects.filter(owner=self.user).update(
+            files_count=9, bytes_used=1, folders_count=0)
+        FileTypeUsage.objects.filter(owner=self.user).update(files_count=5)
+        FileTypeUsage.objects.create(owner=self.user, file_type='mp3', files_count=1, bytes_used=3)
+
+        stored, changed = rebuild_usage(self.user)
+        self.assertTrue(changed)
+        self.assertEqual((stored.files_count, stored.bytes_used, stored.folders_count), (2, 20, 2))
+        self.assertEqual(usage.file_type_totals(self.user), {'pdf': (2, 20)})
+        self.assertEqual(rebuild_usage(self.user)[1], False)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), UPLOAD_SESSION_DIR=tempfile.mkdtemp())
+class ChunkedUploadTests(GraphQLTestCase):
+    def setUp(self):
+        super().setUp()
+        token = get_tokens_for_user(self.user)["access"]
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+    def put_chunk(self, session_id, data, start, total):
+        return self.client.generic(
+            "PUT", f"/uploads/{session_id}/", data,
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes {start}-{start + len(data) - 1}/{total}",
+            **self.auth)
+
+    def test_chunks_resume_and_finalize_into_a_file(self):
+        payload = (b"%PDF-1.7\n" + b"0123456789" * 10)[:100]
+        response = self.client.post(
+            "/uploads/", json.dumps({"name": "notes.pdf", "size": len(payload)}),
+            content_type="application/json", **self.auth)
+        self.assertEqual(response.status_code, 201)
+        session_id = response.json()["id"]
+
+        self.assertEqual(self.put_chunk(session_id, payload[:40], 0, 100).status_code, 200)
+        # A chunk that skips ahead is rejected; the client resumes from offset
+        self.assertEqual(self.put_chunk(session_id, payload[60:], 60, 100).status_code, 409)
+        offset = self.client.get(f"/uploads/{session_id}/", **self.auth).json()["offset"]
+        self.assertEqual(offset, 40)
+        self.put_chunk(session_id, payload[40:], 40, 100)
+
+        response = self.client.post(f"/uploads/{session_id}/finalize/", **self.auth)
+        self.assertEqual(response.status_code, 201)
+        file = File.objects.get(owner=self.user)
+        with file.file.open("rb") as f:
+            self.assertEqual(f.read(), payload)
+        self.assertEqual((file.file_type, file.size), ("pdf", 100))
+        self.assertEqual(get_usage(self.user).bytes_used, 100)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_malformed_and_concurrent_chunks_are_rejected(self):
+        response = self.client.post(
+            "/uploads/", json.dumps({"name": "a.txt", "size": 10}),
+            content_type="application/json", **self.auth)
+        session = UploadSession.objects.get(id=response.json()["id"])
+        response = self.client.generic(
+            "PUT", f"/uploads/{session.id}/", b"hello", content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE="bytes 0-4/10", HTTP_CONTENT_LENGTH="five", **self.auth)
+        self.assertEqual(response.status_code, 400)
+
+        class Racing(io.BytesIO):
+            # Another request stores the same chunk while this one writes
+            def read(self, size=-1):
+                UploadSession.objects.filter(id=session.id).update(offset=5)
+                return super().read(size)
+
+        with self.assertRaises(uploads.UploadError) as caught:
+            uploads.write_chunk(session, 0, 5, Racing(b"hello"))
+        self.assertEqual(caught.exception.status, 409)
+
+    def test_finalize_rechecks_the_target_folder(self):
+        folder = Folder.objects.create(name="docs", owner=self.user)
+        response = self.client.post(
+            "/uploads/", json.dumps({"name": "a.txt", "size": 5, "folderId": folder.id}),
+            content_type="application/json", **self.auth)
+        session_id = response.json()["id"]
+        # The total must be the declared size
+        self.assertEqual(self.put_chunk(session_id, b"hello", 0, 6).status_code, 416)
+        self.assertEqual(self.put_chunk(session_id, b"hello", 0, "*").status_code, 200)
+
+        execute('mutation($id: ID!) { deleteFolder(folderId: $id) { success } }',
+                self.user, id=folder.id)
+        response = self.client.post(f"/uploads/{session_id}/finalize/", **self.auth)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(File.objects.exists())
+
+        execute('mutation($id: ID!) { restoreFolder(folderId: $id) { success } }',
+                self.user, id=folder.id)
+        response = self.client.post(f"/uploads/{session_id}/finalize/", **self.auth)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(File.objects.get().folder, folder)
+
+    def test_declared_size_is_reserved_against_the_quota(self):
+        limit = self.user.storage_limit
+        response = self.client.post(
+            "/uploads/", json.dumps({"name": "a.mp4", "size": limit - 10}),
+            content_type="application/json", **self.auth)
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post(
+            "/uploads/", json.dumps({"name": "b.mp4", "size": 20}),
+            content_type="application/json", **self.auth)
+        self.assertEqual(response.status_code, 413)
+
+    def test_sessions_opened_before_reservations(self):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        # They hold no reservation: charged when finalized, nothing to give back
+        finished, aborted = (
+            UploadSession.objects.create(
+                owner=self.user, name=name, size=5,
+                expires_at=timezone.now() + timedelta(hours=1))
+            for name in ("a.txt", "b.txt"))
+        self.put_chunk(finished.id, b"hello", 0, 5)
+        response = self.client.post(f"/uploads/{finished.id}/finalize/", **self.auth)
+        self.assertEqual(response.status_code, 201)
+        self.client.delete(f"/uploads/{aborted.id}/", **self.auth)
+
+        credits = self.user.credits
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.credits, credits - 1)
+        self.assertEqual(get_usage(self.user).reserved_bytes, 0)
+        self.assertEqual(get_usage(self.user).bytes_used, 5)
+        self.assertEqual(
+            list(LedgerEntry.objects.order_by("id").values_list("action", flat=True)),
+            ["reserve", "commit"])
+
+
+try:
+    import requests
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+
+class DirectUploadTestsMixin:
+    PAYLOAD = b"direct upload " * 100
+
+    def setUp(self):
+        super().setUp()
+        object_storage._stores.clear()
+        self.addCleanup(object_storage._stores.clear)
+        token = get_tokens_for_user(self.user)["access"]
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+    def create(self, payload, name="movie.mp4", folder=None):
+        response = self.client.post("/uploads/", json.dumps({
+            "name": name, "size": len(payload),
+            "sha256": hashlib.sha256(payload).hexdigest(),
+            "folderId": folder and folder.id,
+        }), content_type="application/json", **self.auth)
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def finalize(self, session):
+        return self.client.post(f"/uploads/{session['id']}/finalize/", **self.auth)
+
+    def read(self, file):
+        with file.file.open("rb") as f:
+            return f.read()
+
+    def test_single_put(self):
+        session = self.create(self.PAYLOAD)
+        self.assertFalse(session["upload"]["multipart"])
+        self.assertEqual(self.put(session["upload"], self.PAYLOAD), 200)
+        self.assertEqual(self.finalize(session).status_code, 201)
+
+        file = File.objects.get(owner=self.user)
+        self.assertEqual(self.read(file), self.PAYLOAD)
+        self.assertEqual(file.blob.digest, hashlib.sha256(self.PAYLOAD).hexdigest())
+        self.assertTrue(file.blob.file.name.startswith(blobs.blob_name(file.blob.digest)))
+        self.assertEqual(get_usage(self.user).bytes_used, len(self.PAYLOAD))
+
+        # The same content again is adopted by the existing blob
+        session = self.create(self.PAYLOAD)
+        self.put(session["upload"], self.PAYLOAD)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.finalize(session).status_code, 201)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+        self.assertIsNone(object_storage.get_store().stat(
+            blobs.blob_name(file.blob.digest) + "." + session["id"].replace("-", "")))
+
+    def test_wrong_content_is_rejected(self):
+        session = self.create(self.PAYLOAD)
+        self.put(session["upload"], self.PAYLOAD.upper())
+        self.assertIn(self.finalize(session).status_code, (409, 422))
+        self.assertFalse(File.objects.exists())
+
+        # A fresh URL to upload again
+        session = self.client.get(f"/uploads/{session['id']}/", **self.auth).json()
+        self.assertEqual(self.put(session["upload"], self.PAYLOAD), 200)
+        self.assertEqual(self.finalize(session).status_code, 201)
+        self.assertEqual(self.read(File.objects.get()), self.PAYLOAD)
+
+    def multipart_payload(self):
+        config = settings.DIRECT_UPLOADS
+        payload = bytes(range(256)) * (config["MULTIPART_THRESHOLD"] // 256) + b"tail"
+        part_size = config["PART_SIZE"]
+        return payload, [payload[i:i + part_size] for i in range(0, len(payload), part_size)]
+
+    def put_parts(self, session, parts):
+        response = self.client.post(f"/uploads/{session['id']}/parts/", json.dumps({
+            "parts": [{"number": n, "sha256": hashlib.sha256(part).hexdigest()}
+                      for n, part in enumerate(parts, 1)],
+        }), content_type="application/json", **self.auth)
+        urls = response.json()["parts"]
+        for url, part in zip(urls, parts):
+            self.assertEqual(self.put(url, part), 200)
+
+    def session(self, session):
+        return self.client.get(f"/uploads/{session['id']}/", **self.auth).json()
+
+    def test_multipart(self):
+        payload, parts = self.multipart_payload()
+        session = self.create(payload)
+        self.assertEqual(session["upload"], {
+            "multipart": True, "partSize": settings.DIRECT_UPLOADS["PART_SIZE"],
+            "partCount": len(parts)})
+
+        self.put_parts(session, parts[:-1])
+        self.assertEqual(self.finalize(session).status_code, 409)
+        self.put_parts(session, parts)
+
+        # The whole object is hashed by the upload worker, not the request
+        response = self.finalize(session)
+        self.assertEqual((response.status_code, response.json()["status"]), (202, "verifying"))
+        self.assertNotIn("upload", response.json())
+        self.assertFalse(File.objects.exists())
+        self.assertEqual(self.finalize(session).status_code, 202)
+        self.assertEqual(uploads.verify_pending(), 1)
+        self.assertEqual(uploads.verify_pending(), 0)
+
+        file = File.objects.get()
+        self.assertEqual(self.read(file), payload)
+        polled = self.session(session)
+        self.assertEqual((polled["status"], polled["file"]["id"]), ("complete", str(file.id)))
+        self.assertEqual(self.finalize(session).json()["file"]["id"], str(file.id))
+        self.assertEqual(get_usage(self.user).reserved_bytes, 0)
+        self.client.delete(f"/uploads/{session['id']}/", **self.auth)
+        self.assertEqual(self.read(file), payload)
+        self.assertEqual(get_usage(self.user).bytes_used, len(payload))
+
+    def test_multipart_into_a_binned_folder(self):
+        folder = Folder.objects.create(name="videos", owner=self.user)
+        payload, parts = self.multipart_payload()
+        session = self.create(payload, folder=folder)
+        self.put_parts(session, parts)
+        self.assertEqual(self.finalize(session).status_code, 202)
+        execute('mutation($id: ID!) { deleteFolder(folderId: $id) { success } }',
+                self.user, id=folder.id)
+        uploads.verify_pending()
+        self.assertFalse(File.objects.exists())
+        polled = self.session(session)
+        self.assertEqual((polled["status"], polled["error"]), ("open", "Target folder is in the bin"))
+        self.assertEqual(self.finalize(session).status_code, 409)
+
+        execute('mutation($id: ID!) { restoreFolder(folderId: $id) { success } }',
+                self.user, id=folder.id)
+        self.assertEqual(self.finalize(session).status_code, 202)
+        uploads.verify_pending()
+        self.assertEqual(File.objects.get().folder, folder)
+
+    def test_multipart_mismatch_reopens_the_session(self):
+        payload, parts = self.multipart_payload()
+        session = self.create(payload)
+        wrong = [part.upper() for part in parts]
+        self.put_parts(session, wrong)
+        self.assertEqual(self.finalize(session).status_code, 202)
+        uploads.verify_pending()
+        self.assertFalse(File.objects.exists())
+        polled = self.session(session)
+        self.assertEqual(polled["status"], "open")
+        self.assertEqual(polled["error"], "Uploaded content does not match its SHA-256")
+
+        self.put_parts(session, parts)
+        self.assertEqual(self.finalize(session).status_code, 202)
+        uploads.verify_pending()
+        self.assertEqual(self.read(File.objects.get()), payload)
+
+    def test_retried_finalize(self):
+        session = self.create(self.PAYLOAD)
+        self.put(session["upload"], self.PAYLOAD)
+        stale = UploadSession.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.finalize(session).status_code, 201)
+        self.assertEqual(self.finalize(session).status_code, 404)
+        with self.assertRaises(uploads.UploadError):
+            uploads.finalize(stale)
+        blob = Blob.objects.get()
+        self.assertEqual((blob.ref_count, File.objects.count()), (1, 1))
+
+        # Adopting the blob's own object again never deletes it
+        with self.captureOnCommitCallbacks(execute=True):
+            blobs.adopt(blob.digest, blob.file.name, blob.size)
+        self.assertIsNotNone(object_storage.get_store().stat(blob.file.name))
+
+    def test_abort_removes_the_object(self):
+        session = self.create(self.PAYLOAD)
+        self.put(session["upload"], self.PAYLOAD)
+        key = UploadSession.objects.get().storage_key
+        self.client.delete(f"/uploads/{session['id']}/", **self.auth)
+        self.assertIsNone(object_storage.get_store().stat(key))
+        self.assertEqual(get_usage(self.user).reserved_bytes, 0)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), DIRECT_UPLOADS={
+    **settings.DIRECT_UPLOADS, "BACKEND": "local",
+    "MULTIPART_THRESHOLD": 2048, "PART_SIZE": 1024})
+class LocalDirectUploadTests(DirectUploadTestsMixin, GraphQLTestCase):
+    def put(self, upload, data):
+        return self.client.generic(
+            upload["method"], upload["url"], data,
+            content_type="application/octet-stream", headers=upload["headers"]).status_code
+
+    def test_malformed_content_length(self):
+        upload = self.create(self.PAYLOAD)["upload"]
+        response = self.client.generic(
+            upload["method"], upload["url"], self.PAYLOAD, content_type="application/octet-stream",
+            headers={**upload["headers"], "Content-Length": "lots"})
+        self.assertEqual(response.status_code, 400)
+
+
+@skipUnless(mock_aws, "needs boto3 and moto")
+@override_settings(
+    DIRECT_UPLOADS={
+        **settings.DIRECT_UPLOADS, "BACKEND": "s3",
+        # S3 parts are at least 5 MB
+        "MULTIPART_THRESHOLD": 5 * 1024 * 1024, "PART_SIZE": 5 * 1024 * 1024,
+        "S3": {"BUCKET": "cryogena-test", "ENDPOINT_URL": "", "REGION": "us-east-1",
+               "ACCESS_KEY_ID": "test", "SECRET_ACCESS_KEY": "test"}},
+    STORAGES={
+        **settings.STORAGES,
+        "default": {"BACKEND": "storages.backends.s3.S3Storage", "OPTIONS": {
+            "bucket_name": "cryogena-test", "region_name": "us-east-1",
+            "access_key": "test", "secret_key": "test"}}})
+class S3DirectUploadTests(DirectUploadTestsMixin, GraphQLTestCase):
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        super().setUp()
+        object_storage.get_store().client.create_bucket(Bucket="cryogena-test")
+
+    def put(self, upload, data):
+        return requests.request(
+            upload["method"], upload["url"], data=data, headers=upload["headers"]).status_code
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class DownloadTests(GraphQLTestCase):
+    PAYLOAD = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        blob = blobs.store(ContentFile(self.PAYLOAD, name='clip.mp4'))
+        self.file = File.objects.create(
+            name='clip.mp4', owner=self.user, size=len(self.PAYLOAD),
+            file_type='video', file=blob.file.name, blob=blob)
+        self.url = f"/files/{self.file.id}/download/"
+        token = get_tokens_for_user(self.user)["access"]
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+    def test_requires_the_owner(self):
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+        other = CustomUser.objects.create_user(
+            username='Bob', email='bob@example.com', password='secret')
+        token = get_tokens_for_user(other)["access"]
+        response = self.client.get(self.url, HTTP_AUTHORIZATION=f"Bearer {token}")
+        self.assertEqual(response.status_code, 404)
+
+        data = execute('query { userFiles { downloadUrl } }', self.user)
+        response = self.client.get(data['userFiles'][0]['downloadUrl'])
+        self.assertEqual(response.status_code, 200)
+
+        # Not from the bin, even with a signed URL
+        File.objects.filter(pk=self.file.pk).update(is_deleted=True)
+        self.assertEqual(self.client.get(data['userFiles'][0]['downloadUrl']).status_code, 404)
+        self.assertEqual(self.client.get(self.url, **self.auth).status_code, 404)
+
+    def test_full_and_conditional_responses(self):
+        response = self.client.get(self.url, **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.PAYLOAD)
+        self.assertEqual(response["Content-Type"], "video/mp4")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+        etag = response["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.auth)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"], **self.auth)
+        self.assertEqual(response.status_code, 304)
+
+    def test_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=10-19", **self.auth)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.PAYLOAD)}")
+        self.assertEqual(response["Content-Length"], "10")
+        self.assertEqual(b"".join(response.streaming_content), self.PAYLOAD[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-4", **self.auth)
+        self.assertEqual(b"".join(response.streaming_content), self.PAYLOAD[-4:])
+
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-1,100-101", **self.auth)
+        self.assertEqual(response.status_code, 206)
+        body = b"".join(response.streaming_content)
+        self.assertEqual(int(response["Content-Length"]), len(body))
+        self.assertIn(b"Content-Range: bytes 100-101/1024\r\n\r\n" + self.PAYLOAD[100:102], body)
+
+        response = self.client.get(self.url, HTTP_RANGE="bytes=5000-", **self.auth)
+        self.assertEqual(response.status_code, 416)
+        # A stale If-Range gets the whole file
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE='"stale"', **self.auth)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(DOWNLOADS={
+        "SENDFILE": "x-accel-redirect", "ACCEL_PREFIX": "/protected/", "SIGNED_URL_TTL": 60})
+    def test_proxy_offload(self):
+        response = self.client.get(self.url, **self.auth)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected/{self.file.file.name}")
+        self.assertEqual(response.content, b"")
+        legacy = File(name='old clip.mp4', file='uploads/old clip é.mp4')
+        self.assertEqual(downloads._offload(legacy, "x-accel-redirect")["X-Accel-Redirect"],
+                         "/protected/uploads/old%20clip%20%C3%A9.mp4")
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ArchiveTests(GraphQLTestCase):
+    QUERY = """query($files: [ID], $folders: [ID], $compress: Boolean) {
+        downloadArchive(fileIds: $files, folderIds: $folders, compress: $compress) {
+            url name filesCount size contentLength } }"""
+
+    def add_file(self, name, content, folder=None, **kwargs):
+        blob = blobs.store(ContentFile(content, name=name))
+        return File.objects.create(
+            name=name, owner=self.user, folder=folder, size=len(content),
+            file_type='other', file=blob.file.name, blob=blob, **kwargs)
+
+    def setUp(self):
+        super().setUp()
+        self.root = Folder.objects.create(name='Trip', owner=self.user)
+        self.sub = Folder.objects.create(name='Photos', owner=self.user, parent=self.root)
+        binned = Folder.objects.create(
+            name='Old', owner=self.user, parent=self.root, is_deleted=True)
+        self.add_file('notes.txt', b'hello ' * 500, self.root)
+        self.add_file('notes.txt', b'second', self.root)
+        self.add_file('clip.mp4', bytes(range(256)) * 40, self.sub)
+        self.add_file('gone.txt', b'x', binned, is_deleted=True)
+        self.add_file('deleted.txt', b'x', self.sub, is_deleted=True)
+        self.loose = self.add_file('cv.pdf', b'%PDF' * 10)
+
+    def download(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        body = b"".join(response.streaming_content)
+        return response, body, zipfile.ZipFile(io.BytesIO(body))
+
+    def test_folder_archive_is_stored_with_exact_length(self):
+        data = execute(self.QUERY, self.user, folders=[self.root.id])['downloadArchive']
+        self.assertEqual(data['name'], 'Trip.zip')
+        self.assertEqual(data['filesCount'], 3)
+        response, body, archive = self.download(data['url'])
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertEqual(data['contentLength'], len(body))
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertIn('Trip.zip', response['Content-Disposition'])
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(sorted(archive.namelist()), [
+            'Trip/', 'Trip/Photos/', 'Trip/Photos/clip.mp4',
+            'Trip/notes (2).txt', 'Trip/notes.txt'])
+        self.assertEqual(archive.read('Trip/Photos/clip.mp4'), bytes(range(256)) * 40)
+        self.assertTrue(all(i.compress_type == zipfile.ZIP_STORED for i in archive.infolist()))
+
+    def test_selection_with_compression(self):
+        data = execute(self.QUERY, self.user, folders=[self.sub.id, self.root.id],
+                       files=[self.loose.id], compress=True)['downloadArchive']
+        self.assertEqual(data['name'], 'download.zip')
+        self.assertIsNone(data['contentLength'])
+        response, body, archive = self.download(data['url'])
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.read('cv.pdf'), b'%PDF' * 10)
+        self.assertEqual(archive.getinfo('Trip/notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(
+            archive.getinfo('Trip/Photos/clip.mp4').compress_type, zipfile.ZIP_STORED)
+
+    def test_streams_asynchronously_under_asgi(self):
+        url = execute(self.QUERY, self.user, folders=[self.root.id])['downloadArchive']['url']
+        response = self.client.get(url)
+        expected = b"".join(response.streaming_content)
+        request = AsyncRequestFactory().get(url)
+        response = archive_download(request)
+        self.assertTrue(response.is_async)
+
+        async def read():
+            return b"".join([block async for block in response])
+        self.assertEqual(async_to_sync(read)(), expected)
+
+    def test_permissions_and_limits(self):
+        other = CustomUser.objects.create_user(
+            username='Bob', email='bob@example.com', password='secret')
+        with self.assertRaisesMessage(Exception, 'Nothing to download'):
+            execute(self.QUERY, other, folders=[self.root.id])
+        token = get_tokens_for_user(other)['access']
+        response = self.client.get(
+            f'/archives/download/?folders={self.root.id}', HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get('/archives/download/?sig=forged').status_code, 403)
+
+        # Signed links stop working once the user's tokens are revoked or
+        # the account is deactivated
+        url = execute(self.QUERY, self.user, folders=[self.root.id])['downloadArchive']['url']
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.user.token_version += 1
+        self.user.save()
+        self.assertEqual(self.client.get(url).status_code, 403)
+        url = execute(self.QUERY, self.user, folders=[self.root.id])['downloadArchive']['url']
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.user.is_active = True
+        self.user.save()
+
+        with override_settings(ARCHIVES={**settings.ARCHIVES, 'MAX_BYTES': {'free': 100}}):
+            with self.assertRaisesMessage(Exception, 'limited to 100 bytes'):
+                execute(self.QUERY, self.user, folders=[self.root.id])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class BlobDedupeTests(GraphQLTestCase):
+    UPLOAD = 'mutation($files: [Upload]!) { uploadFile(files: $files) { success } }'
+    PURGE = 'mutation($id: ID!) { deleteFileForever(fileId: $id) { success } }'
+
+    def test_same_content_is_stored_once_and_collected_after_purge(self):
+        execute(self.UPLOAD, self.user, files=[
+            SimpleUploadedFile('a.pdf', b'same bytes'),
+            SimpleUploadedFile('b.pdf', b'same bytes'),
+        ])
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        first, second = File.objects.order_by('id')
+        self.assertEqual(first.file.name, second.file.name)
+
+        File.objects.update(is_deleted=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            execute(self.PURGE, self.user, id=first.id)
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(blob.file.storage.exists(blob.file.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            execute(self.PURGE, self.user, id=second.id)
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(blob.file.storage.exists(blob.file.name))
+
+    def test_http_multipart_upload(self):
+        token = get_tokens_for_user(self.user)["access"]
+        content = b'%PDF-1.7\n' + b'x' * 1000
+        for size, handler in ((settings.FILE_UPLOAD_MAX_MEMORY_SIZE, 'memory'), (100, 'temporary')):
+            with self.subTest(handler), self.settings(FILE_UPLOAD_MAX_MEMORY_SIZE=size):
+                response = self.client.post('/graphql/', {
+                    'operations': json.dumps(
+                        {'query': self.UPLOAD, 'variables': {'files': [None]}}),
+                    'map': json.dumps({'0': ['variables.files.0']}),
+                    '0': SimpleUploadedFile(f'{handler}.pdf', content),
+                }, HTTP_AUTHORIZATION=f'Bearer {token}')
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(json.loads(response.content)['data']['uploadFile']['success'])
+                file = File.objects.get(name=f'{handler}.pdf')
+                self.assertEqual(file.blob.digest, hashlib.sha256(content).hexdigest())
+                self.assertEqual(file.mime_type, 'application/pdf')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class BinPurgeTests(GraphQLTestCase):
+    UPLOAD = 'mutation($files: [Upload]!) { uploadFile(files: $files) { success } }'
+
+    def test_expired_items_are_purged_by_tier(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from datetime import timedelta
+        from django.utils import timezone
+
+        pro = CustomUser.objects.create_user(
+            username='Grace Hopper', email='grace@example.com', password='secret', tier='pro')
+        execute(self.UPLOAD, self.user, files=[SimpleUploadedFile('a.pdf', b'free bytes')])
+        execute(self.UPLOAD, pro, files=[SimpleUploadedFile('b.pdf', b'pro bytes')])
+        kept = File.objects.create(name='kept.pdf', owner=self.user, size=1, file_type='pdf')
+        execute('mutation($id: ID!) { deleteFile(fileId: $id) { success } }',
+                self.user, id=File.objects.get(name='a.pdf').pk)
+        self.assertIsNotNone(File.objects.get(name='a.pdf').deleted_at)
+
+        folder = Folder.objects.create(name='old', owner=self.user)
+        File.objects.create(name='inner.pdf', owner=self.user, folder=folder,
+                            size=5, file_type='pdf')
+        execute('mutation($id: ID!) { deleteFolder(folderId: $id) { success } }',
+                self.user, id=folder.pk)
+        name = File.objects.get(name='b.pdf').file.name
+        File.objects.filter(name='b.pdf').update(
+            is_deleted=True, deleted_at=timezone.now())
+
+        # 40 days on: past the free tier's 30, within the pro tier's 90
+        later = timezone.now() + timedelta(days=40)
+        with ThreadPoolExecutor(2) as pool, self.captureOnCommitCallbacks(execute=True):
+            stats = trash.purge(batch_size=1, executor=pool, now=later)
+        self.assertEqual((stats.files, stats.folders, stats.batches), (2, 1, 3))
+        self.assertEqual(
+            sorted(File.objects.values_list('name', flat=True)), ['b.pdf', 'kept.pdf'])
+        self.assertFalse(Folder.objects.exists())
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertTrue(Blob.objects.get().file.storage.exists(name))
+        self.assertTrue(File.objects.filter(pk=kept.pk, deleted_at=None).exists())
+
+        # Resuming finds nothing left until the pro retention runs out
+        self.assertEqual(trash.purge(now=later).batches, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            trash.purge(now=later + timedelta(days=60))
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(default_storage.exists(name))
+
+    def test_restore_clears_deleted_at(self):
+        file = File.objects.create(name='a.pdf', owner=self.user, size=1, file_type='pdf')
+        execute('mutation($ids: [ID]) { deleteItems(fileIds: $ids) { success } }',
+                self.user, ids=[file.pk])
+        self.assertIsNotNone(File.objects.get(pk=file.pk).deleted_at)
+        execute('mutation($ids: [ID]) { restoreItems(fileIds: $ids) { success } }',
+                self.user, ids=[file.pk])
+        self.assertIsNone(File.objects.get(pk=file.pk).deleted_at)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), THUMBNAIL_SIZES=[64, 256])
+class ThumbnailTests(GraphQLTestCase):
+    UPLOAD = 'mutation($files: [Upload]!) { uploadFile(files: $files) { success } }'
+
+    def png(self, width, height):
+        from PIL import Image
+
+        out = io.BytesIO()
+        Image.new('RGB', (width, height), 'red').save(out, 'PNG')
+        return out.getvalue()
+
+    def test_uploads_are_queued_and_rendered_by_the_worker(self):
+        execute(self.UPLOAD, self.user, files=[
+            SimpleUploadedFile('photo.png', self.png(800, 400)),
+            SimpleUploadedFile('notes.txt', b'no preview'),
+        ])
+        self.assertEqual(
+            sorted(Thumbnail.objects.values_list('size', flat=True)), [64, 256])
+        self.assertIsNone(execute(
+            'query { userFiles { thumbnailUrl } }', self.user)['userFiles'][0]['thumbnailUrl'])
+
+        self.assertEqual(thumbnails.process(), 2)
+        self.assertEqual(thumbnails.process(), 0)
+        data = execute(
+            'query { userFiles { name thumbnailUrl(size: 100) } }', self.user)
+        urls = {f['name']: f['thumbnailUrl'] for f in data['userFiles']}
+        self.assertIsNone(urls['notes.txt'])
+        thumbnail = Thumbnail.objects.get(size=256, status='ready')
+        self.assertEqual(urls['photo.png'], thumbnail.image.url)
+
+        from PIL import Image
+        with Image.open(thumbnail.image.path) as image:
+            self.assertEqual(image.size, (256, 128))
+
+    def test_files_purged_while_rendering(self):
+        execute(self.UPLOAD, self.user, files=[SimpleUploadedFile('photo.png', self.png(80, 40))])
+        file_id = File.objects.get().pk
+        render = thumbnails.render
+
+        def purge_then_render(job):
+            File.objects.all().delete()
+            return render(job)
+
+        with mock.patch.object(thumbnails, 'render', purge_then_render):
+            self.assertEqual(thumbnails.process(), 2)
+        self.assertFalse(Thumbnail.objects.exists())
+        # Nor are the rendered images left behind
+        self.assertEqual(list(pathlib.Path(settings.MEDIA_ROOT).rglob(f'{file_id}-*.jpg')), [])
+
+    def test_backfill_queues_existing_files(self):
+        File.objects.create(name='a.png', owner=self.user, size=1, file_type='image')
+        File.objects.create(name='b.mp3', owner=self.user, size=1, file_type='audio')
+        self.assertEqual(thumbnails.backfill(), 2)
+        self.assertEqual(thumbnails.backfill(), 0)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class FileTypeTests(GraphQLTestCase):
+    UPLOAD = 'mutation($files: [Upload]!) { uploadFile(files: $files) { success } }'
+    PNG = b'\x89PNG\r\n\x1a\n' + bytes(32)
+
+    def docx(self):
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, 'w') as archive:
+            archive.writestr('[Content_Types].xml', '<Types/>')
+            archive.writestr('word/document.xml', '<w:document/>')
+        return out.getvalue()
+
+    def test_content_wins_over_the_name(self):
+        self.assertEqual(filetypes.classify('photo.pdf', self.PNG), ('image/png', 'image'))
+        self.assertEqual(filetypes.classify('fake.pdf', b'just text'), ('text/plain', 'text'))
+        self.assertEqual(filetypes.classify('data.csv', b'a,b\n1,2\n'), ('text/csv', 'spreadsheet'))
+        self.assertEqual(filetypes.classify('report.docx', self.docx())[1], 'doc')
+        self.assertEqual(filetypes.classify('report.zip', self.docx())[1], 'doc')
+        self.assertEqual(filetypes.classify('song.mp3', b'ID3\x04')[1], 'mp3')
+        # A UTF-16LE byte order mark is not an MPEG frame
+        self.assertEqual(filetypes.classify('notes.txt', 'hi'.encode('utf-16')),
+                         ('text/plain', 'text'))
+        self.assertEqual(filetypes.classify('data.csv', b'\xff\xfe' + 'a,b'.encode('utf-16-le')),
+                         ('text/csv', 'spreadsheet'))
+        self.assertEqual(filetypes.classify('song', b'\xff\xfb\x90\x00')[1], 'mp3')
+        self.assertEqual(filetypes.classify('blob', bytes(range(256))),
+                         ('application/octet-stream', 'other'))
+        # Without content the name decides
+        self.assertEqual(filetypes.classify('talk.pptx')[1], 'presentation')
+
+    @override_settings(FILE_TYPE_CATEGORIES={'text/markdown': 'notes', 'image/png': 'png'})
+    def test_categories_come_from_settings_first(self):
+        self.assertEqual(filetypes.classify('README.md', b'# Title\n')[1], 'notes')
+        self.assertEqual(filetypes.classify('a.png', self.PNG)[1], 'png')
+        self.assertEqual(filetypes.categories()[:2], ['notes', 'png'])
+
+    def test_uploads_are_sniffed_and_counted_by_category(self):
+        execute(self.UPLOAD, self.user, files=[
+            SimpleUploadedFile('scan.pdf', self.PNG),
+            SimpleUploadedFile('sheet.xlsx', b'PK\x03\x04' + bytes(26) + b'xl/workbook.xml'),
+        ])
+        self.assertEqual(
+            dict(File.objects.values_list('name', 'mime_type')),
+            {'scan.pdf': 'image/png',
+             'sheet.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'})
+        stats = execute(
+            '{ dashboardStats { imagesCount pdfsCount fileTypes { fileType count bytes } } }',
+            self.user)['dashboardStats']
+        self.assertEqual((stats['imagesCount'], stats['pdfsCount']), (1, 0))
+        types = {t['fileType']: (t['count'], t['bytes']) for t in stats['fileTypes']}
+        self.assertEqual(types['image'], (1, len(self.PNG)))
+        self.assertEqual(types['spreadsheet'][0], 1)
+        self.assertEqual(types['ebook'], (0, 0))
+        self.assertEqual(list(types), filetypes.categories())
+
+    def test_backfill_reclassifies_stored_files_and_moves_the_counters(self):
+        execute(self.UPLOAD, self.user, files=[SimpleUploadedFile('a.pdf', self.PNG)])
+        binned = File.objects.create(
+            name='b.pdf', owner=self.user, size=1, file_type='pdf', is_deleted=True)
+        # As stored before sniffing
+        File.objects.update(file_type='pdf', mime_type='')
+        rebuild_usage(self.user)
+
+        self.assertEqual(filetypes.backfill(batch_size=1), 2)
+        self.assertEqual(filetypes.backfill(), 0)
+        file = File.objects.get(name='a.pdf')
+        self.assertEqual((file.file_type, file.mime_type), ('image', 'image/png'))
+        # Missing content: classified by name
+        self.assertEqual(File.objects.get(pk=binned.pk).mime_type, 'application/pdf')
+        self.assertEqual(usage.file_type_totals(self.user),
+                         {'pdf': (0, 0), 'image': (1, len(self.PNG))})
+        self.assertEqual(rebuild_usage(self.user)[1], False)
+        self.assertTrue(Thumbnail.objects.filter(file=file).exists())
+
+
+class SearchTests(GraphQLTestCase):
+    SEARCH = """
+        query($q: String!, $type: String, $folder: ID, $after: String) {
+            searchFiles(query: $q, fileType: $type, folderId: $folder, first: 2, after: $after) {
+                edges { node { name } }
+                pageInfo { hasNextPage endCursor }
+            }
+        }
+    """
+
+    def search(self, q, **variables):
+        data = execute(self.SEARCH, self.user, q=q, **variables)['searchFiles']
+        return [edge['node']['name'] for edge in data['edges']], data['pageInfo']
+
+    def test_results_are_ranked_and_paginated(self):
+        folder = Folder.objects.create(name='Reports', owner=self.user)
+        for name, file_type, parent in [
+            ('old report.pdf', 'pdf', None),
+            ('report.pdf', 'pdf', folder),
+            ('annual report.pdf', 'pdf', None),
+            ('report', 'doc', None),
+            ('misreported.pdf', 'pdf', None),
+            ('holiday.png', 'image', None),
+        ]:
+            File.objects.create(name=name, owner=self.user, folder=parent,
+                                size=1, file_type=file_type)
+
+        names, page = self.search('REPORT')
+        self.assertEqual(names, ['report', 'report.pdf'])
+        rest, page = self.search('report', after=page['endCursor'])
+        self.assertEqual(rest, ['annual report.pdf', 'old report.pdf'])
+        rest, page = self.search('report', after=page['endCursor'])
+        self.assertEqual((rest, page['hasNextPage']), (['misreported.pdf'], False))
+
+        self.assertEqual(self.search('rep', type='doc')[0], ['report'])
+        self.assertEqual(self.search('report', folder=folder.id)[0], ['report.pdf'])
+        self.assertEqual(self.search('annual pdf')[0], ['annual report.pdf'])
+        self.assertEqual(self.search('ho')[0], ['holiday.png'])
+        self.assertEqual(self.search('  ')[0], [])
+
+
+class BulkItemsTests(GraphQLTestCase):
+    def test_bulk_delete_restore_and_purge(self):
+        self.seed(3)
+        top = Folder.objects.get(name='folder 0')
+        loose = File.objects.create(
+            name='loose.mp3', owner=self.user, size=5, file_type='mp3')
+        ids = {'files': [loose.id, 999999], 'folders': [top.id]}
+
+        data = execute("""
+            mutation($files: [ID], $folders: [ID]) {
+                deleteItems(fileIds: $files, folderIds: $folders) {
+                    success results { id kind success message }
+                }
+            }""", self.user, **ids)['deleteItems']
+        self.assertFalse(data['success'])
+        self.assertEqual([r['success'] for r in data['results']], [True, False, True])
+        self.assertFalse(File.objects.filter(is_deleted=False).exists())
+        self.assertEqual(get_usage(self.user).bytes_used, 0)
+
+        execute("""
+            mutation($files: [ID], $folders: [ID]) {
+                restoreItems(fileIds: $files, folderIds: $folders) { success }
+            }""", self.user, **ids)
+        self.assertFalse(Folder.objects.filter(is_deleted=True).exists())
+        self.assertEqual(get_usage(self.user).bytes_used, 35)
+
+        File.objects.update(is_deleted=True)
+        Folder.objects.update(is_deleted=True)
+        execute("""
+            mutation($files: [ID], $folders: [ID]) {
+                purgeItems(fileIds: $files, folderIds: $folders) { success }
+            }""", self.user, **ids)
+        self.assertFalse(File.objects.exists())
+        self.assertFalse(Folder.objects.exists())
+
+    def test_bulk_move_skips_cycles(self):
+        self.seed(2)
+        top, child = Folder.objects.order_by('id')
+        other = Folder.objects.create(name='other', owner=self.user)
+        data = execute("""
+            mutation($folders: [ID], $to: ID) {
+                moveItems(folderIds: $folders, targetFolderId: $to) {
+                    results { id success message }
+                }
+            }""", self.user, folders=[top.id, other.id], to=child.id)['moveItems']
+        self.assertEqual([r['success'] for r in data['results']], [False, True])
+        other.refresh_from_db()
+        self.assertEqual(other.parent_id, child.id)
+        self.assertEqual(other.path, f'{top.id}/{child.id}/{other.id}/')
+
+
+class ChangeJournalTests(GraphQLTestCase):
+    CHANGES = """
+        query($since: String, $limit: Int) {
+            changes(since: $since, limit: $limit) {
+                cursor hasMore resync
+                changes { kind id action deleted parentId file { name } folder { name } }
+            }
+        }"""
+
+    def changes(self, since=None, limit=None):
+        return execute(self.CHANGES, self.user, since=since, limit=limit)['changes']
+
+    def test_feed_returns_the_latest_change_per_item_since_the_cursor(self):
+        folder = execute('mutation { createFolder(name: "docs") { folder { id } } }',
+                         self.user)['createFolder']['folder']
+        execute('mutation($files: [Upload]!) { uploadFile(files: $files) { success } }',
+                self.user, files=[SimpleUploadedFile('a.txt', b'a')])
+        file = File.objects.get()
+        start = self.changes()
+        self.assertEqual(
+            [(c['kind'], c['action']) for c in start['changes']],
+            [('folder', 'create'), ('file', 'create')])
+        self.assertFalse(start['hasMore'] or start['resync'])
+
+        execute('mutation($id: ID!, $name: String!) { renameFile(fileId: $id, newName: $name) '
+                '{ success } }', self.user, id=file.pk, name='b.txt')
+        execute('mutation($id: ID!, $to: ID) { moveFile(fileId: $id, folderId: $to) { success } }',
+                self.user, id=file.pk, to=folder['id'])
+        execute('mutation($id: ID!) { deleteFolder(folderId: $id) { success } }',
+                self.user, id=folder['id'])
+        # Rename, move and delete of the file come back as one delta
+        data = self.changes(start['cursor'])
+        self.assertEqual(
+            [(c['kind'], c['action'], c['deleted']) for c in data['changes']],
+            [('file', 'delete', True), ('folder', 'delete', True)])
+        self.assertEqual(data['changes'][0]['file']['name'], 'b.txt')
+        self.assertEqual(data['changes'][0]['parentId'], folder['id'])
+
+        # Pages stop at `limit` and carry on from their cursor
+        first = self.changes(start['cursor'], limit=2)
+        self.assertTrue(first['hasMore'])
+        self.assertEqual(len(self.changes(first['cursor'])['changes']), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            execute('mutation($id: ID!) { deleteFolderForever(folderId: $id) { success } }',
+                    self.user, id=folder['id'])
+        purged = self.changes(data['cursor'])['changes']
+        self.assertEqual({(c['kind'], c['action']) for c in purged},
+                         {('file', 'purge'), ('folder', 'purge')})
+        self.assertIsNone(purged[0]['file'] or purged[0]['folder'])
+        self.assertEqual(self.changes(self.changes(data['cursor'])['cursor'])['changes'], [])
+
+    def test_compaction_keeps_the_feed_and_resyncs_old_cursors(self):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        self.seed(2)  # not journaled
+        file = File.objects.first()
+        for name in ('one', 'two', 'three'):
+            execute('mutation($id: ID!, $name: String!) { renameFile(fileId: $id, newName: $name) '
+                    '{ success } }', self.user, id=file.pk, name=name)
+        before = self.changes()
+        self.assertEqual(journal.compact(), (2, 0))
+        self.assertEqual(Change.objects.count(), 1)
+        self.assertEqual(self.changes(), before)
+
+        self.assertEqual(journal.compact(now=timezone.now() + timedelta(days=31)), (0, 1))
+        self.assertFalse(Change.objects.exists())
+        data = self.changes()
+        self.assertTrue(data['resync'])
+        self.assertEqual(data['cursor'], before['cursor'])
+        # Continuing from the cursor handed out with the resync
+        self.assertFalse(self.changes(data['cursor'])['resync'])
+
+    def test_bin_purge_is_journaled(self):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        file = File.objects.create(name='old.txt', owner=self.user, size=1, file_type='text',
+                                   is_deleted=True, deleted_at=timezone.now())
+        trash.purge(now=timezone.now() + timedelta(days=365))
+        self.assertEqual(
+            list(Change.objects.values_list('kind', 'item_id', 'action')),
+            [('file', file.pk, 'purge')])
+
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class EventStreamTests(GraphQLTestCase):
+    async def read(self, response, count):
+        return [await anext(response.streaming_content) for _ in range(count)]
+
+    def message(self, chunk):
+        lines = dict(line.split(": ", 1) for line in chunk.decode().strip().split("\n"))
+        self.assertEqual(lines["event"], "changes")
+        return lines["id"], json.loads(lines["data"])
+
+    def create_folder(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            return execute('mutation($name: String!) { createFolder(name: $name) '
+                           '{ folder { id } } }', self.user, name=name)['createFolder']['folder']
+
+    def test_stream_pushes_committed_changes(self):
+        url = execute('{ eventStreamUrl }', self.user)['eventStreamUrl']
+        broker = events.get_broker()
+
+        async def scenario():
+            response = await self.async_client.get(url)
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            self.assertEqual(await self.read(response, 1), [b"retry: 3000\n\n"])
+            self.assertEqual(broker.connections(self.user.pk), 1)
+            folder = await sync_to_async(self.create_folder)("docs")
+            cursor, message = self.message((await self.read(response, 1))[0])
+            await response.streaming_content.aclose()
+            return folder, cursor, message
+
+        folder, cursor, message = async_to_sync(scenario)()
+        self.assertEqual(message, {"cursor": cursor, "more": False, "changes": [
+            {"kind": "folder", "id": folder["id"], "action": "create"}]})
+        self.assertEqual(cursor, journal.head(self.user.pk))
+        self.assertEqual(broker.connections(self.user.pk), 0)
+
+    def test_reconnect_catches_up_from_last_event_id(self):
+        token = get_tokens_for_user(self.user)["access"]
+        before = journal.head(self.user.pk)
+        self.create_folder("docs")
+
+        async def connect(last_event_id):
+            response = await self.async_client.get(
+                "/events/", headers={
+                    "Authorization": f"Bearer {token}", "Last-Event-ID": last_event_id})
+            chunks = await self.read(response, 2)
+            await response.streaming_content.aclose()
+            return chunks[1]
+
+        cursor, message = self.message(async_to_sync(connect)(before))
+        self.assertEqual((cursor, message["changes"], message["more"]),
+                         (journal.head(self.user.pk), [], True))
+        # Up to date: the next chunk is a keepalive
+        with self.settings(EVENTS={**settings.EVENTS, "HEARTBEAT": 0.01}):
+            self.assertEqual(async_to_sync(connect)(cursor), b": keepalive\n\n")
+
+    def test_rejected_connections(self):
+        self.assertEqual(self.client.get("/events/").status_code, 501)  # WSGI
+        get = async_to_sync(self.async_client.get)
+        self.assertEqual(get("/events/").status_code, 401)
+        self.assertEqual(get("/events/?sig=forged").status_code, 403)
+        url = execute('{ eventStreamUrl }', self.user)['eventStreamUrl']
+        with self.settings(EVENTS={**settings.EVENTS, "MAX_CONNECTIONS": 0}):
+            self.assertEqual(get(url).status_code, 429)
+        # Revoking the user's tokens revokes their stream URLs too
+        self.user.token_version += 1
+        self.user.save()
+        self.assertEqual(get(url).status_code, 403)
+
+    @override_settings(RESULT_CACHE={
+        **settings.RESULT_CACHE, "ENABLED": True, "BACKEND": "locmem", "SINGLE_PROCESS": True,
+        "SIZE": 100})
+    def test_cached_results_are_stale_before_the_push(self):
+        seen = []
+        broker = mock.Mock()
+        broker.publish.side_effect = lambda *args: seen.append(result_cache.version(self.user.pk))
+        before = result_cache.version(self.user.pk)
+        with mock.patch.object(events, "get_broker", return_value=broker):
+            with self.captureOnCommitCallbacks(execute=True):
+                journal.record(self.user.pk, "update", files=[1])
+        self.assertEqual(len(seen), 1)
+        self.assertGreater(seen[0], before)
+
+    def test_slow_clients_are_coalesced(self):
+        broker = events.LocalBroker()
+
+        async def scenario():
+            subscription = await broker.subscribe(self.user.pk)
+            for seq in range(1, settings.EVENTS["BUFFER_SIZE"] + 2):
+                broker.publish(self.user.pk, events.message_for(
+                    str(seq), [("file", seq, "create")]))
+            await asyncio.sleep(0)
+            received = [await subscription.get(0), await subscription.get(0)]
+            broker.unsubscribe(subscription)
+            return subscription, received
+
+        subscription, received = async_to_sync(scenario)()
+        last = str(settings.EVENTS["BUFFER_SIZE"] + 1)
+        self.assertEqual(received, [{"cursor": last, "changes": [], "more": True}, None])
+        self.assertEqual(subscription.coalesced, settings.EVENTS["BUFFER_SIZE"])
+        self.assertEqual(broker.connections(self.user.pk), 0)
+
+    def test_messages_list_at_most_max_items(self):
+        changes = [("file", pk, "purge") for pk in range(settings.EVENTS["MAX_ITEMS"] + 1)]
+        message = events.message_for("9", changes)
+        self.assertEqual(len(message["changes"]), settings.EVENTS["MAX_ITEMS"])
+        self.assertTrue(message["more"])
+
+    @skipUnless(fakeredis, "needs fakeredis")
+    def test_redis_broker_reaches_other_nodes(self):
+        server = fakeredis.FakeServer()
+
+        def node():
+            return events.RedisBroker(
+                "redis://", client=fakeredis.FakeRedis(server=server),
+                async_client=fakeredis.aioredis.FakeRedis(server=server))
+
+        receiver, sender = node(), node()
+
+        async def scenario():
+            subscription = await receiver.subscribe(self.user.pk)
+            await sync_to_async(sender.publish, thread_sensitive=False)(
+                self.user.pk, events.message_for("7", [("folder", 3, "move")]))
+            message = await subscription.get(5)
+            receiver.unsubscribe(subscription)
+            await asyncio.sleep(0.05)
+            receiver.listener.cancel()
+            return message
+
+        self.assertEqual(async_to_sync(scenario)(), {
+            "cursor": "7", "changes": [{"kind": "folder", "id": "3", "action": "move"}],
+            "more": False})
+        self.assertEqual(receiver.channels, set())
+
+
+class TokenAuthModeTests(GraphQLTestCase):
+    def setUp(self):
+        super().setUp()
+        user_cache.clear()
+        token = get_tokens_for_user(self.user)["access"]
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+    def post(self, query):
+        return self.client.post(
+            "/graphql/", json.dumps({"query": query}),
+            content_type="application/json", **self.auth).json()
+
+    def user_queries(self, query):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.post(query)
+        table = CustomUser._meta.db_table
+        return data, [q for q in queries if f'FROM "{table}"' in q["sql"]]
+
+    @override_settings(TOKEN_AUTH={"MODE": "cached", "CACHE_TTL": 60, "CACHE_SIZE": 10})
+    def test_cached_mode_loads_the_user_once_until_it_is_saved(self):
+        self.assertEqual(len(self.user_queries("{ me { credits } }")[1]), 1)
+        self.assertEqual(len(self.user_queries("{ me { credits } }")[1]), 0)
+
+        self.user.credits = 42
+        self.user.save()
+        data, queries = self.user_queries("{ me { credits } }")
+        self.assertEqual(data["data"]["me"]["credits"], 42)
+        self.assertEqual(len(queries), 1)
+
+    @override_settings(TOKEN_AUTH={"MODE": "cached", "CACHE_TTL": 60, "CACHE_SIZE": 10})
+    def test_bumping_token_version_revokes_tokens(self):
+        self.user.token_version += 1
+        self.user.save()
+        self.assertEqual(
+            self.post("{ me { id } }")["errors"][0]["message"], "Not authenticated")
+
+    STATELESS = override_settings(
+        TOKEN_AUTH={"MODE": "stateless", "CACHE_TTL": 60, "CACHE_SIZE": 10, "SHARED_CACHE": "shared"},
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                       "LOCATION": "token-auth-tests"},
+        },
+    )
+
+    def test_stateless_mode_reads_need_no_user_load(self):
+        query = "{ userFiles { id } dashboardStats { storageLimit } }"
+        with self.STATELESS:
+            caches["shared"].clear()
+            self.assertEqual(len(self.user_queries(query)[1]), 1)
+            # Not even in this process's cache: the shared token state is enough
+            user_cache.clear()
+            data, queries = self.user_queries(query)
+            self.assertNotIn("errors", data)
+            self.assertEqual(queries, [])
+            # Mutations still load the user
+            self.assertEqual(len(self.user_queries(
+                'mutation { createFolder(name: "a") { folder { id } } }')[1]), 1)
+
+    def test_stateless_mode_rejects_revoked_tokens_and_inactive_users(self):
+        with self.STATELESS:
+            caches["shared"].clear()
+            self.assertNotIn("errors", self.post("{ userFiles { id } }"))
+
+            self.user.token_version += 1
+            self.user.save()
+            self.assertEqual(
+                self.post("{ userFiles { id } }")["errors"][0]["message"], "Not authenticated")
+            # Rejected by the recorded token version from then on
+            data, queries = self.user_queries("{ userFiles { id } }")
+            self.assertEqual((data["errors"][0]["message"], queries), ("Not authenticated", []))
+
+            self.user.token_version -= 1
+            self.user.is_active = False
+            self.user.save()
+            self.assertEqual(
+                self.post("{ userFiles { id } }")["errors"][0]["message"], "Not authenticated")
+
+    def test_stateless_mode_reads_only_graphql_bodies(self):
+        with self.STATELESS, mock.patch("accounts.middleware.parse") as parse:
+            self.client.post("/uploads/", json.dumps({"name": "a.txt", "size": 1}),
+                             content_type="application/json", **self.auth)
+            parse.assert_not_called()
+
+    @override_settings(TOKEN_AUTH={"MODE": "cached", "CACHE_TTL": 0, "CACHE_SIZE": 10})
+    def test_cache_settings_are_read_per_request(self):
+        self.assertEqual(len(self.user_queries("{ me { credits } }")[1]), 1)
+        self.assertEqual(len(self.user_queries("{ me { credits } }")[1]), 1)
+
+    @override_settings(
+        TOKEN_AUTH={"MODE": "cached", "CACHE_TTL": 60, "CACHE_SIZE": 10, "SHARED_CACHE": "shared"},
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                       "LOCATION": "token-auth-tests"},
+        },
+    )
+    def test_shared_cache_drops_users_cached_by_other_processes(self):
+        self.assertEqual(len(self.user_queries("{ me { credits } }")[1]), 1)
+        # Another process bumps the credits with an F() update, which only
+        # reaches this one through the shared stamp
+        CustomUser.objects.filter(pk=self.user.pk).update(credits=7)
+        caches["shared"].set(f"{STAMP_PREFIX}{self.user.pk}", "from-another-process")
+        data, queries = self.user_queries("{ me { credits } }")
+        self.assertEqual(data["data"]["me"]["credits"], 7)
+        self.assertEqual(len(queries), 1)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class QueryLimitTests(GraphQLTestCase):
+    def setUp(self):
+        super().setUp()
+        limits.buckets.clear()
+        token = get_tokens_for_user(self.user)["access"]
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+    def post(self, query, **variables):
+        return self.client.post(
+            "/graphql/", json.dumps({"query": query, "variables": variables}),
+            content_type="application/json", **self.auth)
+
+    def test_cost_is_reported_and_scales_with_page_size(self):
+        query = "query($n: Int) { userFilesConnection(first: $n) { edges { node { id ownerAvatar } } } }"
+        small = self.post(query, n=10).json()["extensions"]["cost"]
+        large = self.post(query, n=100).json()["extensions"]["cost"]
+        # connection + first * (edge + node)
+        self.assertEqual((small["requested"], large["requested"]), (21, 201))
+        self.assertEqual(small["depth"], 4)
+
+    def test_invalid_variables_are_rejected_without_charge(self):
+        query = "query($n: Int) { userFilesConnection(first: $n) { edges { node { id } } } }"
+        for value in ("abc", 2.5, [1]):
+            with self.subTest(value):
+                response = self.post(query, n=value)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("$n", response.json()["errors"][0]["message"])
+                self.assertEqual(response.json()["extensions"]["cost"]["requested"], 0)
+
+    def test_deep_and_expensive_queries_are_rejected(self):
+        nested = "id " + "parent { id " * 12 + "}" * 12
+        response = self.post("{ userFolders { %s } }" % nested)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["errors"][0]["extensions"]["code"], "DEPTH_LIMIT_EXCEEDED")
+
+        wide = "userFolders { parent { parent { id } } }"
+        with override_settings(GRAPHQL_LIMITS={**settings.GRAPHQL_LIMITS, "MAX_COST": 300}):
+            self.assertEqual(self.post("{ %s }" % wide).status_code, 200)
+            response = self.post("{ a: %s b: %s }" % (wide, wide))
+        self.assertEqual(response.json()["errors"][0]["extensions"]["code"], "COST_LIMIT_EXCEEDED")
+
+    def test_rate_limit_is_keyed_on_cost(self):
+        with mock.patch.object(limits, "buckets", limits.TokenBuckets(0.001, 25, 10)):
+            for _ in range(2):
+                self.assertEqual(self.post("{ dashboardStats { foldersCount } }").status_code, 200)
+            response = self.post("{ dashboardStats { foldersCount } }")
+            self.assertEqual(response.status_code, 429)
+            self.assertIn("Retry-After", response)
+            self.assertEqual(response.json()["errors"][0]["extensions"]["code"], "RATE_LIMITED")
+
+
+class PersistedQueryTests(GraphQLTestCase):
+    QUERY = "{ me { username } }"
+
+    def setUp(self):
+        super().setUp()
+        persisted.reset()
+        self.addCleanup(persisted.reset)
+        token = get_tokens_for_user(self.user)["access"]
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+    def post(self, query=None, sha=None, extensions=None):
+        body = {"query": query}
+        if sha:
+            body["extensions"] = {"persistedQuery": {"version": 1, "sha256Hash": sha}}
+        if extensions is not None:
+            body["extensions"] = extensions
+        return self.client.post(
+            "/graphql/", json.dumps(body), content_type="application/json", **self.auth)
+
+    def test_hash_only_requests_after_registration(self):
+        sha = persisted.query_hash(self.QUERY)
+        response = self.post(sha=sha)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["errors"][0]["extensions"]["code"],
+                         "PERSISTED_QUERY_NOT_FOUND")
+
+        self.assertIn("data", self.post(self.QUERY, sha=sha).json())
+        data = self.post(sha=sha).json()["data"]
+        self.assertEqual(data["me"]["username"], "Ada Lovelace")
+        self.assertGreaterEqual(persisted.documents.hits, 1)
+
+        response = self.post(self.QUERY, sha="0" * 64)
+        self.assertEqual(response.json()["errors"][0]["extensions"]["code"],
+                         "PERSISTED_QUERY_HASH_MISMATCH")
+
+    def test_malformed_extensions_are_rejected(self):
+        for extensions, message in (
+                (["persistedQuery"], "Extensions must be a JSON object."),
+                ("[1]", "Extensions must be a JSON object."),
+                ("{", "Extensions are invalid JSON."),
+                ({"persistedQuery": "abc"}, "Unsupported persisted query"),
+                ({"persistedQuery": {"version": 1, "sha256Hash": 5}}, "Unsupported persisted query")):
+            with self.subTest(extensions=extensions):
+                response = self.post(self.QUERY, extensions=extensions)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()["errors"][0]["message"], message)
+
+    def test_allowlist_only_mode(self):
+        manifest = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        json.dump({persisted.query_hash(self.QUERY): self.QUERY}, manifest)
+        manifest.close()
+        with override_settings(GRAPHQL_PERSISTED_QUERIES={
+                "CACHE_SIZE": 10, "ALLOWLIST": manifest.name, "ALLOWLIST_ONLY": True}):
+            data = self.post(sha=persisted.query_hash(self.QUERY)).json()["data"]
+            self.assertEqual(data["me"]["username"], "Ada Lovelace")
+            self.assertIn("data", self.post(self.QUERY).json())
+            response = self.post("{ me { email } }")
+            self.assertEqual(response.json()["errors"][0]["extensions"]["code"],
+                             "PERSISTED_QUERY_NOT_ALLOWED")
+
+
+class ResultCacheTests(GraphQLTestCase):
+    STATS = "{ dashboardStats { foldersCount } }"
+
+    def setUp(self):
+        super().setUp()
+        get_usage(self.user)  # building the counters invalidates too
+        token = get_tokens_for_user(self.user)["access"]
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+    def post(self, query, **variables):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                "/graphql/", json.dumps({"query": query, "variables": variables}),
+                content_type="application/json", **self.auth).json()
+
+    def check_invalidation(self):
+        first = self.post(self.STATS)
+        self.assertEqual(first["extensions"]["cache"], "miss")
+        with self.assertNumQueries(1):  # the user, from the token
+            cached = self.post(self.STATS)
+        self.assertEqual((cached["extensions"]["cache"], cached["data"]), ("hit", first["data"]))
+
+        self.post('mutation { createFolder(name: "new") { folder { id } } }')
+        fresh = self.post(self.STATS)
+        self.assertEqual(fresh["extensions"]["cache"], "miss")
+        self.assertEqual(fresh["data"]["dashboardStats"]["foldersCount"], 1)
+        # Mixed with an uncached root field, nothing is cached
+        self.assertNotIn("cache", self.post("{ me { id } dashboardStats { foldersCount } }")["extensions"])
+
+    @override_settings(RESULT_CACHE={
+        **settings.RESULT_CACHE, "ENABLED": True, "BACKEND": "locmem", "SINGLE_PROCESS": True,
+        "SIZE": 100})
+    def test_locmem_backend(self):
+        self.check_invalidation()
+        self.assertGreaterEqual(result_cache.stats()["hits"], 1)
+
+    @override_settings(
+        RESULT_CACHE={**settings.RESULT_CACHE, "ENABLED": True, "BACKEND": "django",
+                      "CACHE_ALIAS": "results", "SINGLE_PROCESS": True},
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+                "results": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                            "LOCATION": "result-cache-tests"}})
+    def test_django_cache_backend(self):
+        self.check_invalidation()
+
+    def test_per_process_caches_need_single_process(self):
+        for config in ({"BACKEND": "locmem"}, {"BACKEND": "django", "CACHE_ALIAS": "default"}):
+            with self.subTest(**config), self.settings(
+                    RESULT_CACHE={**settings.RESULT_CACHE, "ENABLED": True,
+                                  "SINGLE_PROCESS": False, **config},
+                    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}):
+                with self.assertRaises(ImproperlyConfigured):
+                    result_cache.get_backend()
+
+    @override_settings(RESULT_CACHE={
+        **settings.RESULT_CACHE, "ENABLED": True, "BACKEND": "locmem", "SINGLE_PROCESS": True})
+    def test_cache_outage_does_not_fail_committed_mutations(self):
+        with mock.patch.object(result_cache, "get_backend", side_effect=ConnectionError):
+            data = self.post('mutation { createFolder(name: "new") { folder { id } } }')
+        self.assertNotIn("errors", data)
+        self.assertTrue(Folder.objects.filter(name="new").exists())
+
+
+class AsyncViewTests(GraphQLTestCase):
+    QUERY = """
+        query Dashboard($folderId: ID!) {
+            me { id username }
+            dashboardStats { pdfsCount foldersCount }
+            folderContents(folderId: $folderId) {
+                files { name }
+                foldersConnection(first: 10) { edges { node { name } } }
+            }
+        }
+    """
+
+    async def post(self, query, variables=None, user=None):
+        request = AsyncRequestFactory().post(
+            "/graphql/", json.dumps({"query": query, "variables": variables or {}}),
+            content_type="application/json")
+        request.user = user or self.user
+        view = AsyncGraphQLView.as_view(schema=schema)
+        return await view(request)
+
+    def test_matches_sync_view(self):
+        self.seed(2)
+        root = Folder.objects.get(name='folder 0')
+        variables = {"folderId": root.pk}
+        expected = execute(self.QUERY, self.user, **variables)
+
+        response = async_to_sync(self.post)(self.QUERY, variables)
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertEqual(body["data"], expected)
+        self.assertEqual(body["data"]["dashboardStats"]["pdfsCount"], 2)
+        self.assertEqual(body["data"]["folderContents"]["files"], [{"name": "file 0.pdf"}])
+
+    def test_errors_and_mutations(self):
+        response = async_to_sync(self.post)(
+            "{ folderContents(folderId: 0) { files { name } } }")
+        self.assertEqual(
+            json.loads(response.content)["errors"][0]["message"],
+            "Folder not found or not accessible")
+
+        response = async_to_sync(self.post)(
+            'mutation { createFolder(name: "async") { folder { name } } }')
+        self.assertEqual(
+            json.loads(response.content)["data"]["createFolder"]["folder"]["name"], "async")
+        self.assertTrue(Folder.objects.filter(name="async", owner=self.user).exists())
+
+    def test_meta_fields(self):
+        response = async_to_sync(self.post)("{ __typename me { __typename id } }")
+        body = json.loads(response.content)
+        self.assertNotIn("errors", body)
+        self.assertEqual(body["data"], {
+            "__typename": "Query", "me": {"__typename": "UserType", "id": str(self.user.pk)}})
+
+        response = async_to_sync(self.post)(
+            "{ __schema { queryType { name } } __type(name: \"FileType\") { name } }")
+        body = json.loads(response.content)
+        self.assertNotIn("errors", body)
+        self.assertEqual(body["data"]["__schema"]["queryType"]["name"], "Query")
+        self.assertEqual(body["data"]["__type"]["name"], "FileType")
+
+
+@override_settings(GRAPHQL_PROFILING={
+    **settings.GRAPHQL_PROFILING, "ENABLED": True, "EXTENSIONS": True, "LOG_SAMPLE_RATE": 0})
+class ProfilingTests(GraphQLTestCase):
+    QUERY = """
+        query($folderId: ID!) {
+            folderContents(folderId: $folderId) { files { name } folders { name } }
+        }
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.seed(2)
+        self.folder = Folder.objects.get(name='folder 0')
+        token = get_tokens_for_user(self.user)["access"]
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+    def post(self, **extra):
+        return self.client.post(
+            "/graphql/", json.dumps({"query": self.QUERY, "variables": {"folderId": self.folder.pk}}),
+            content_type="application/json", **self.auth, **extra)
+
+    def check_profile(self, response):
+        self.assertRegex(
+            response["Server-Timing"], r'^total;dur=[\d.]+, sql;dur=[\d.]+;desc="\d+ queries", resolvers')
+        profile = json.loads(response.content)["extensions"]["profile"]
+        fields = {field["path"]: field for field in profile["fields"]}
+        self.assertEqual(fields["folderContents.files"]["sqlCount"], 1)
+        self.assertEqual(fields["folderContents.folders"]["sqlCount"], 1)
+        self.assertEqual(fields["folderContents"]["calls"], 1)
+        self.assertNotIn("folderContents.files.name", fields)  # plain attributes
+        self.assertEqual(profile["sql"]["count"], sum(f["sqlCount"] for f in profile["fields"]))
+        return profile
+
+    def test_sync_view(self):
+        response = self.post(HTTP_ORIGIN="http://localhost:5173")
+        self.check_profile(response)
+        self.assertEqual(response["Timing-Allow-Origin"], "http://localhost:5173")
+
+    def test_async_view(self):
+        request = AsyncRequestFactory().post(
+            "/graphql/", json.dumps({"query": self.QUERY, "variables": {"folderId": self.folder.pk}}),
+            content_type="application/json")
+        request.user = self.user
+        response = async_to_sync(AsyncGraphQLView.as_view(schema=schema))(request)
+        self.check_profile(response)
+
+    def test_slow_requests_are_logged(self):
+        slow = {**settings.GRAPHQL_PROFILING, "ENABLED": True, "LOG_SLOW_MS": 0}
+        with self.settings(GRAPHQL_PROFILING=slow), self.assertLogs("accounts.profiling") as logs:
+            self.post()
+        record = logs.records[0].graphql_profile
+        self.assertTrue(record["slow"])
+        self.assertEqual(record["user"], self.user.pk)
+
+    def test_disabled(self):
+        with self.settings(GRAPHQL_PROFILING={**settings.GRAPHQL_PROFILING, "ENABLED": False}):
+            response = self.post()
+        self.assertNotIn("Server-Timing", response)
+        self.assertNotIn("profile", json.loads(response.content).get("extensions", {}))
+
+    def test_meta_fields(self):
+        response = self.client.post(
+            "/graphql/", json.dumps({"query": "{ __typename me { __typename id } "
+                                              "__schema { queryType { name } } }"}),
+            content_type="application/json", **self.auth)
+        body = json.loads(response.content)
+        self.assertNotIn("errors", body)
+        self.assertEqual(body["data"]["__typename"], "Query")
+        self.assertEqual(body["data"]["me"]["__typename"], "UserType")
+        self.assertEqual(body["data"]["__schema"]["queryType"]["name"], "Query")
+
+    def test_duplicates(self):
+        profile = profiling.Profile()
+        for pk in [1, 1, 2, 3, 4]:
+            profile.record_query("SELECT name FROM file WHERE id = %s", (pk,), 0.001)
+        profile.record_query("SELECT 1", (), 0.001)
+        [duplicate] = profile.duplicates()
+        self.assertEqual((duplicate["count"], duplicate["identical"]), (5, 2))
+        self.assertEqual(duplicate["fields"], [profiling.REQUEST_FIELD])
+
+
+class ConcurrentUploadTests(TransactionTestCase):
+    WORKERS = 12
+
+    def run_in_parallel(self, work):
+        barrier = threading.Barrier(self.WORKERS)
+        outcomes = []
+
+        def worker(i):
+            try:
+                barrier.wait()
+                outcomes.append(work(i))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(self.WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def reserve_with_retry(self, user, **amounts):
+        # SQLite's in-memory test database reports lock contention instead
+        # of waiting for it, so retry those; Postgres just waits
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                ledger.reserve(user, reference='test', **amounts)
+                return True
+            except ledger.ReservationError:
+                return False
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+            time.sleep(0.005)
+        return 'locked'  # not a rejection; fails the test below
+
+    def test_parallel_reservations_never_overspend_credits(self):
+        user = CustomUser.objects.create_user(
+            username='racer', email='racer@example.com', password='secret', credits=5)
+        outcomes = self.run_in_parallel(
+            lambda i: self.reserve_with_retry(user, credits=1))
+        self.assertNotIn('locked', outcomes)
+        user.refresh_from_db()
+        self.assertEqual(outcomes.count(True), 5)
+        self.assertEqual(user.credits, 0)
+
+    def test_parallel_reservations_never_exceed_the_quota(self):
+        user = CustomUser.objects.create_user(
+            username='filler', email='filler@example.com', password='secret')
+        chunk = user.storage_limit // 4
+        outcomes = self.run_in_parallel(
+            lambda i: self.reserve_with_retry(user, bytes=chunk))
+        self.assertNotIn('locked', outcomes)
+        self.assertEqual(outcomes.count(True), 4)
+        self.assertEqual(get_usage(user).reserved_bytes, 4 * chunk)
+        self.assertEqual(LedgerEntry.objects.filter(action='reserve').count(), 4)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_parallel_uploads_never_overspend(self):
+        user = CustomUser.objects.create_user(
+            username='uploader', email='uploader@example.com', password='secret', credits=5)
+
+        def upload(i):
+            # Each thread gets its own user object, as separate requests would
+            request_user = CustomUser.objects.get(pk=user.pk)
+            try:
+                execute('mutation($f: [Upload]!) { uploadFile(files: $f) { success } }',
+                        request_user, f=[SimpleUploadedFile(f'{i}.pdf', f'{i}'.encode())])
+                return True
+            except Exception:
+                return False
+
+        outcomes = self.run_in_parallel(upload)
+        user.refresh_from_db()
+        self.assertEqual(outcomes.count(True), 5)
+        self.assertEqual(user.credits, 0)
+        self.assertEqual(File.objects.filter(owner=user).count(), 5)
+        self.assertEqual(get_usage(user).reserved_bytes, 0)
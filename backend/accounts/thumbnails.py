@@ -0,0 +1,256 @@
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import ExitStack
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import result_cache
+from .models import File, Thumbnail
+
+
+# Thumbnails and previews
+#
+# Uploads queue one pending Thumbnail row per configured size for images,
+# PDFs (first page) and videos (a poster frame). The database table is the
+# queue: `manage.py run_thumbnail_worker` claims pending rows, renders them
+# in a local process pool and stores the JPEGs. Rendering never touches
+# the database, so it is safe in forked worker processes.
+
+
+SUPPORTED_TYPES = ('image', 'pdf', 'video')
+JPEG_QUALITY = 85
+RENDER_TIMEOUT = 60  # seconds, for the external pdf/video tools
+
+
+class RenderError(Exception):
+    pass
+
+
+def sizes():
+    return sorted(settings.THUMBNAIL_SIZES)
+
+
+def pick_size(requested):
+    """
+    The smallest configured size at least `requested`, else the largest.
+    """
+    for size in sizes():
+        if size >= requested:
+            return size
+    return sizes()[-1]
+
+
+def enqueue(files):
+    """
+    Queue thumbnails for every supported file in `files` (File objects or a
+    queryset). Already queued sizes are left alone. Returns rows created.
+    """
+    rows = [
+        Thumbnail(file_id=file.pk, size=size)
+        for file in files
+        if file.file_type in SUPPORTED_TYPES
+        for size in sizes()
+    ]
+    return len(Thumbnail.objects.bulk_create(rows, ignore_conflicts=True))
+
+
+def discard(files, executor=None):
+    """
+    Remove the stored images of `files`' thumbnails once the transaction
+    commits. The rows go with the files (on_delete=CASCADE).
+    """
+    from .blobs import remove_stored
+
+    names = list(Thumbnail.objects.filter(file__in=files).exclude(image='')
+                 .exclude(image__isnull=True).values_list('image', flat=True))
+    if not names:
+        return
+    storage = Thumbnail._meta.get_field('image').storage
+    transaction.on_commit(lambda: remove_stored(storage, names, executor))
+
+
+# Rendering (runs in worker processes)
+
+
+def _to_jpeg(image, size):
+    from PIL import ImageOps
+
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((size, size))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def _render_image(path, size):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image.draft('RGB', (size, size))  # lets JPEG decode at reduced scale
+        return _to_jpeg(image, size)
+
+
+def _run(tool, args):
+    executable = shutil.which(tool)
+    if executable is None:
+        raise RenderError(f"{tool} is not installed")
+    result = subprocess.run(
+        [executable, *args], capture_output=True, timeout=RENDER_TIMEOUT)
+    if result.returncode != 0:
+        raise RenderError(
+            result.stderr.decode(errors='replace').strip()[-200:] or f"{tool} failed")
+
+
+def _render_pdf(path, size):
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = os.path.join(tmp, 'page')
+        _run('pdftoppm', ['-f', '1', '-l', '1', '-singlefile', '-png',
+                          '-scale-to', str(size), path, prefix])
+        return _render_image(prefix + '.png', size)
+
+
+def _render_video(path, size):
+    with tempfile.TemporaryDirectory() as tmp:
+        frame = os.path.join(tmp, 'frame.png')
+        # A frame one second in is more representative than the first one,
+        # but short clips may not have it
+        for offset in ('1', '0'):
+            _run('ffmpeg', ['-v', 'error', '-y', '-ss', offset, '-i', path,
+                            '-frames:v', '1', frame])
+            if os.path.exists(frame):
+                return _render_image(frame, size)
+        raise RenderError("No video frame found")
+
+
+RENDERERS = {
+    'image': _render_image,
+    'pdf': _render_pdf,
+    'video': _render_video,
+}
+
+
+def render(job):
+    """
+    Render one (thumbnail_id, file_type, source_path, size) job.
+    Returns (thumbnail_id, jpeg_bytes, error).
+    """
+    thumbnail_id, file_type, path, size = job
+    try:
+        return thumbnail_id, RENDERERS[file_type](path, size), ''
+    except Exception as e:
+        return thumbnail_id, None, (str(e) or type(e).__name__)[:255]
+
+
+# Queue
+
+
+def claim(limit):
+    """
+    Mark up to `limit` pending thumbnails (or ones a crashed worker left
+    processing) as processing and return them with their files.
+    """
+    stale = timezone.now() - timedelta(seconds=settings.THUMBNAIL_CLAIM_TIMEOUT)
+    with transaction.atomic():
+        ids = list(
+            Thumbnail.objects
+            .filter(Q(status='pending') | Q(status='processing', claimed_at__lt=stale))
+            .order_by('id')
+            .select_for_update(skip_locked=True)
+            .values_list('id', flat=True)[:limit])
+        Thumbnail.objects.filter(id__in=ids).update(
+            status='processing', claimed_at=timezone.now(),
+            attempts=F('attempts') + 1)
+    return list(Thumbnail.objects.filter(id__in=ids).select_related('file'))
+
+
+def _source_path(file, stack):
+    """
+    A local path for a File's content, copying it to a temporary file if
+    the storage backend has no local paths.
+    """
+    try:
+        return file.file.path
+    except NotImplementedError:
+        tmp = stack.enter_context(tempfile.NamedTemporaryFile())
+        with file.file.open('rb') as source:
+            shutil.copyfileobj(source, tmp)
+        tmp.flush()
+        return tmp.name
+
+
+def _save_result(thumbnail, content, error):
+    if content is not None:
+        thumbnail.image.save(
+            f'{thumbnail.file_id}-{thumbnail.size}.jpg', ContentFile(content), save=False)
+        thumbnail.status = 'ready'
+        thumbnail.error = ''
+    else:
+        retry = thumbnail.attempts < settings.THUMBNAIL_MAX_ATTEMPTS
+        # Missing tools will not appear by retrying
+        if 'not installed' in error:
+            retry = False
+        thumbnail.status = 'pending' if retry else 'failed'
+        thumbnail.error = error
+    thumbnail.claimed_at = None
+    updated = Thumbnail.objects.filter(pk=thumbnail.pk).update(
+        image=thumbnail.image.name, status=thumbnail.status,
+        error=thumbnail.error, claimed_at=None)
+    if not updated:
+        # The file was purged while rendering
+        if content is not None:
+            thumbnail.image.delete(save=False)
+        return
+    if content is not None:
+        # Cached listings would keep showing no thumbnail
+        result_cache.invalidate(thumbnail.file.owner_id)
+
+
+def process(limit=50, pool=None):
+    """
+    Claim and render one batch. Renders in `pool` (a multiprocessing pool)
+    if given, otherwise in this process. Returns the number processed.
+    """
+    thumbnails = {thumbnail.id: thumbnail for thumbnail in claim(limit)}
+    if not thumbnails:
+        return 0
+
+    with ExitStack() as stack:
+        jobs = []
+        for thumbnail in thumbnails.values():
+            try:
+                path = _source_path(thumbnail.file, stack)
+            except (OSError, ValueError) as e:
+                _save_result(thumbnail, None, str(e)[:255])
+                continue
+            jobs.append((thumbnail.id, thumbnail.file.file_type, path, thumbnail.size))
+
+        results = pool.imap_unordered(render, jobs) if pool is not None else map(render, jobs)
+        for thumbnail_id, content, error in results:
+            _save_result(thumbnails[thumbnail_id], content, error)
+    return len(thumbnails)
+
+
+def backfill(batch_size=500):
+    """
+    Queue thumbnails for existing files that have none. Returns rows created.
+    """
+    files = (File.objects.filter(file_type__in=SUPPORTED_TYPES, thumbnails__isnull=True)
+             .only('id', 'file_type').order_by('id'))
+    created = 0
+    last_id = 0
+    while True:
+        batch = list(files.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return created
+        created += enqueue(batch)
+        last_id = batch[-1].id
@@ -0,0 +1,145 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from . import blobs, journal, tree, usage
+from .models import File, Folder
+
+
+# Bin retention
+#
+# Bin items carry deleted_at, and purge() permanently deletes those older
+# than their owner's tier retention (TRASH["RETENTION_DAYS"]) in batches of
+# TRASH["BATCH_SIZE"] rows. Every batch is its own transaction and picks
+# the oldest expired rows left, so an interrupted purge just starts again
+# where it stopped. Storage objects are removed after each commit through
+# a thread pool.
+
+
+def retention(tier):
+    config = settings.TRASH
+    return timedelta(days=config["RETENTION_DAYS"].get(
+        tier, config["DEFAULT_RETENTION_DAYS"]))
+
+
+def expired(model, now=None):
+    """
+    Bin rows of `model` (File or Folder) past their owner's retention.
+    """
+    now = now or timezone.now()
+    tiers = settings.TRASH["RETENTION_DAYS"]
+    match = Q(deleted_at__lt=now - retention(None)) & ~Q(owner__tier__in=list(tiers))
+    for tier in tiers:
+        match |= Q(owner__tier=tier, deleted_at__lt=now - retention(tier))
+    return model.objects.filter(match, is_deleted=True)
+
+
+class PurgeStats:
+    def __init__(self):
+        self.files = 0
+        self.folders = 0
+        self.bytes = 0
+        self.batches = 0
+        self.started_at = time.monotonic()
+
+    def add(self, files, folders, size):
+        self.files += files
+        self.folders += folders
+        self.bytes += size
+        self.batches += 1
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def summary(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return (
+            f"{self.files} files ({self.bytes / 1024 / 1024:.1f} MB) and "
+            f"{self.folders} folders in {self.batches} batches, {elapsed:.1f}s: "
+            f"{(self.files + self.folders) / elapsed:.0f} items/s, "
+            f"{self.bytes / 1024 / 1024 / elapsed:.1f} MB/s")
+
+
+def _oldest(queryset, batch_size):
+    return list(queryset.select_for_update(skip_locked=True, of=('self',))
+                .order_by('deleted_at', 'pk')[:batch_size])
+
+
+def purge_files(batch_size, now=None, executor=None):
+    """
+    Delete one batch of expired bin files. Returns (files, bytes).
+    """
+    with transaction.atomic():
+        batch = _oldest(expired(File, now).only('pk', 'owner_id', 'size'), batch_size)
+        if not batch:
+            return 0, 0
+        blobs.delete_files(
+            File.objects.filter(pk__in=[file.pk for file in batch]), executor)
+        for owner_id in {file.owner_id for file in batch}:
+            journal.record(owner_id, "purge",
+                           files=[file.pk for file in batch if file.owner_id == owner_id])
+    return len(batch), sum(file.size for file in batch)
+
+
+def purge_folders(batch_size, now=None, executor=None):
+    """
+    Delete one batch of expired bin folders with their subtrees, like
+    PurgeItemsMutation. Returns (files, folders, bytes).
+    """
+    with transaction.atomic():
+        batch = _oldest(expired(Folder, now).select_related('owner'), batch_size)
+        files_deleted = folders_deleted = size = 0
+        owners = {}
+        for folder in batch:
+            owners.setdefault(folder.owner, []).append(folder)
+        for owner, folders in owners.items():
+            subtrees = tree.subtrees_folders(owner.pk, folders)
+            files = tree.subtrees_files(owner.pk, folders)
+            # Anything in the subtrees that was restored on its own goes too
+            live_totals = usage.file_totals(files.filter(is_deleted=False))
+            live_folders = subtrees.filter(is_deleted=False).count()
+            totals = files.aggregate(count=Count('id'), size=Sum('size'))
+            files_deleted += totals['count']
+            size += totals['size'] or 0
+            file_ids = list(files.values_list('id', flat=True))
+            folder_ids = list(subtrees.values_list('id', flat=True))
+            blobs.delete_files(files, executor)
+            folders_deleted += subtrees.delete()[1].get(Folder._meta.label, 0)
+            usage.apply_file_totals(owner, live_totals, sign=-1)
+            usage.apply_folder_count(owner, -live_folders)
+            journal.record(owner.pk, "purge", files=file_ids, folders=folder_ids)
+    return files_deleted, folders_deleted, size
+
+
+def purge(batch_size=None, executor=None, now=None, max_batches=None, progress=None):
+    """
+    Purge every expired bin item, files first. Calls progress(stats)
+    after each batch. Returns the PurgeStats.
+    """
+    batch_size = batch_size or settings.TRASH["BATCH_SIZE"]
+    now = now or timezone.now()
+    stats = PurgeStats()
+
+    def more():
+        return max_batches is None or stats.batches < max_batches
+
+    while more():
+        files, size = purge_files(batch_size, now, executor)
+        if not files:
+            break
+        stats.add(files, 0, size)
+        if progress:
+            progress(stats)
+    while more():
+        files, folders, size = purge_folders(batch_size, now, executor)
+        if not folders:
+            break
+        stats.add(files, folders, size)
+        if progress:
+            progress(stats)
+    return stats
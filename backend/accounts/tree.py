@@ -0,0 +1,77 @@
+from django.db.models import CharField, Q, Value
+from django.db.models.functions import Concat, Substr
+
+from .models import File, Folder
+
+
+# Folder tree helpers
+#
+# Folder.path holds the ids from the root down to the folder itself
+# ("1/5/9/"), so a whole subtree is one `path LIKE '1/5/%'` range and every
+# subtree operation is a fixed number of statements whatever the depth.
+
+
+def subtree_folders(folder):
+    """
+    The folder and every folder below it.
+    """
+    return subtrees_folders(folder.owner_id, [folder])
+
+
+def subtree_files(folder):
+    """
+    Every file in the folder or any folder below it.
+    """
+    return subtrees_files(folder.owner_id, [folder])
+
+
+def subtrees_folders(owner_id, folders):
+    """
+    Every folder in any of the given folders' subtrees, in one query.
+    """
+    match = Q(pk__in=[])
+    for folder in folders:
+        match |= Q(path__startswith=folder.path)
+    return Folder.objects.filter(match, owner_id=owner_id)
+
+
+def subtrees_files(owner_id, folders):
+    return File.objects.filter(
+        owner_id=owner_id,
+        folder_id__in=subtrees_folders(owner_id, folders).values('id'))
+
+
+def ancestor_ids(folder):
+    """
+    Ids from the root down to the folder's parent.
+    """
+    return [int(pk) for pk in folder.path.split('/') if pk][:-1]
+
+
+def is_within(folder, ancestor):
+    return folder.path.startswith(ancestor.path)
+
+
+def move_subtree(folder, new_parent):
+    """
+    Reparent `folder` and rewrite the paths of its whole subtree. Both
+    folders are locked and their paths re-read first, so a concurrent move
+    can neither be lost nor turn this one into a cycle.
+    """
+    pks = [folder.pk] + ([new_parent.pk] if new_parent else [])
+    paths = dict(Folder.objects.select_for_update().filter(pk__in=pks)
+                 .order_by('pk').values_list('pk', 'path'))
+    folder.path = paths[folder.pk]
+    if new_parent:
+        new_parent.path = paths[new_parent.pk]
+        if is_within(new_parent, folder):
+            raise Exception("Cannot move folder into itself or its descendants")
+    old_path = folder.path
+    new_path = (new_parent.path if new_parent else '') + f'{folder.pk}/'
+    if new_path != old_path:
+        subtree_folders(folder).update(path=Concat(
+            Value(new_path), Substr('path', len(old_path) + 1),
+            output_field=CharField()))
+    folder.parent = new_parent
+    folder.path = new_path
+    folder.save(update_fields=['parent'])
@@ -0,0 +1,498 @@
+import logging
+import os
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File as DjangoFile
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import (
+    blobs, filetypes, journal, ledger, object_storage, thumbnails, usage)
+from .models import File, Folder, UploadSession
+
+
+# Resumable chunked uploads
+#
+# create_session() reserves the upload credit and the declared size
+# against the quota up front (accounts.ledger).
+# write_chunk() streams one byte range from the request straight to a
+# partial file on disk in fixed-size blocks, so memory use does not depend
+# on the chunk or file size. finalize() hands the partial file to the blob
+# store, which moves it into place without copying (or drops it if the
+# same content is already stored).
+#
+# Direct sessions, created with the file's SHA-256, skip our workers
+# altogether: the client PUTs the bytes to presigned storage URLs (see
+# accounts.object_storage), in one request or, above
+# DIRECT_UPLOADS["MULTIPART_THRESHOLD"], as parts of PART_SIZE bytes.
+# finalize() then checks the object's size and digest and registers it.
+# The store checks every part's SHA-256 as it arrives, but the digest of a
+# whole multipart object takes reading it back: finalize() only checks the
+# part sizes and leaves the session "verifying" for verify_pending() (the
+# `run_upload_worker` command), which hashes and registers it. Clients poll
+# the session until it is "complete" and names the File.
+
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class PartialFile(DjangoFile):
+    """
+    Exposes temporary_file_path() so FileSystemStorage moves the partial
+    file into place instead of copying it.
+    """
+
+    def temporary_file_path(self):
+        return self.name
+
+
+def partial_path(session):
+    return os.path.join(settings.UPLOAD_SESSION_DIR, f'{session.id}.part')
+
+
+def open_sessions(user):
+    return UploadSession.objects.filter(owner=user, expires_at__gt=timezone.now())
+
+
+def reserve_upload(user, size, reference):
+    try:
+        return ledger.reserve(user, credits=1, bytes=size, reference=reference)
+    except ledger.ReservationError as e:
+        status = 402 if 'credits' in str(e) else 413
+        raise UploadError(str(e), status=status)
+
+
+def session_reservation(session):
+    """
+    The Reservation the session holds, or None for sessions opened before
+    reservations existed: those are charged when finalized, and aborting
+    them gives nothing back.
+    """
+    if session.reservation is None:
+        return None
+    return ledger.resume(session.owner, session.reservation, credits=1,
+                         bytes=session.size, reference=f'upload_session:{session.id}')
+
+
+def expire_sessions(user=None):
+    """
+    Abort expired sessions, giving back what they reserved.
+    """
+    expired = UploadSession.objects.filter(expires_at__lte=timezone.now())
+    if user is not None:
+        expired = expired.filter(owner=user)
+    count = 0
+    for session in expired.select_related('owner'):
+        abort(session)
+        count += 1
+    return count
+
+
+def get_session(user, session_id):
+    try:
+        return open_sessions(user).get(id=session_id)
+    except (UploadSession.DoesNotExist, ValueError):
+        raise UploadError("Upload session not found", status=404)
+
+
+def is_multipart(session):
+    return bool(session.storage_key) and (
+        session.size > settings.DIRECT_UPLOADS["MULTIPART_THRESHOLD"])
+
+
+def part_count(session):
+    part_size = settings.DIRECT_UPLOADS["PART_SIZE"]
+    return max(1, -(-session.size // part_size))
+
+
+def part_size(session, number):
+    part_size = settings.DIRECT_UPLOADS["PART_SIZE"]
+    return min(part_size, session.size - (number - 1) * part_size)
+
+
+def direct_upload(session):
+    """
+    What the client needs to upload a direct session's bytes: a presigned
+    PUT, or the part size and count of a multipart upload.
+    """
+    if is_multipart(session):
+        return {
+            "multipart": True,
+            "partSize": settings.DIRECT_UPLOADS["PART_SIZE"],
+            "partCount": part_count(session),
+        }
+    return {"multipart": False, **object_storage.get_store().presign_put(
+        session.storage_key, session.size, session.sha256)}
+
+
+def check_open(session):
+    if session.status != 'open':
+        raise UploadError("Upload is already finalized", status=409)
+
+
+def presign_parts(session, parts):
+    """
+    Presigned PUTs for multipart upload parts, given as (number, hex SHA-256).
+    """
+    check_open(session)
+    if not is_multipart(session):
+        raise UploadError("Not a multipart upload", status=409)
+    store = object_storage.get_store()
+    urls = []
+    for number, sha256 in parts:
+        if not 1 <= number <= part_count(session):
+            raise UploadError(f"No part {number}", status=416)
+        if not SHA256_RE.match(sha256 or ''):
+            raise UploadError("Each part needs its SHA-256")
+        urls.append({"number": number, **store.presign_part(
+            session.storage_key, session.multipart_id, number,
+            part_size(session, number), sha256)})
+    return urls
+
+
+def create_session(user, name, size, folder_id=None, sha256=None):
+    """
+    Open an upload session. With the file's `sha256` (hex), a direct
+    session whose bytes go straight to storage.
+    """
+    if not name:
+        raise UploadError("File name is required")
+    if size is None or size < 0:
+        raise UploadError("File size is required")
+    if sha256 is not None:
+        sha256 = sha256.lower()
+        if not SHA256_RE.match(sha256):
+            raise UploadError("Invalid SHA-256")
+
+    folder = None
+    if folder_id:
+        try:
+            folder = Folder.objects.get(
+                id=folder_id, owner=user, is_deleted=False)
+        except Folder.DoesNotExist:
+            raise UploadError("Folder not found", status=404)
+
+    expire_sessions(user)
+    with transaction.atomic():
+        session = UploadSession(
+            owner=user,
+            folder=folder,
+            name=name,
+            size=size,
+            expires_at=timezone.now() + timedelta(
+                seconds=settings.UPLOAD_SESSION_TTL),
+        )
+        reservation = reserve_upload(user, size, f'upload_session:{session.id}')
+        session.reservation = reservation.id
+        if sha256 is not None:
+            session.sha256 = sha256
+            session.storage_key = f'{blobs.blob_name(sha256)}.{session.id.hex}'
+            if is_multipart(session):
+                session.multipart_id = object_storage.get_store().start_multipart(
+                    session.storage_key)
+        session.save()
+        return session
+
+
+def write_chunk(session, start, length, stream):
+    """
+    Write `length` bytes read from `stream` at byte `start`.
+    The chunk must begin at the current offset; anything after it from an
+    interrupted earlier attempt is overwritten. The session stays locked
+    meanwhile, so a concurrent PUT for the same offset waits and then
+    finds the offset moved on.
+    """
+    if session.storage_key:
+        raise UploadError("Upload the bytes to the session's storage URL", status=409)
+    if length > settings.UPLOAD_MAX_CHUNK_SIZE:
+        raise UploadError("Chunk too large", status=413)
+
+    with transaction.atomic():
+        session = lock_session(session)
+        check_open(session)
+        if start != session.offset:
+            raise UploadError(
+                f"Expected chunk at offset {session.offset}", status=409)
+        if start + length > session.size:
+            raise UploadError("Chunk exceeds declared file size", status=416)
+
+        path = partial_path(session)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        written = 0
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as part:
+            part.seek(start)
+            part.truncate()
+            while written < length:
+                block = stream.read(min(settings.UPLOAD_BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                part.write(block)
+                written += len(block)
+
+        if written != length:
+            raise UploadError("Incomplete chunk, resume from the current offset")
+
+        updated = UploadSession.objects.filter(id=session.id, offset=start).update(
+            offset=start + length)
+        if not updated:
+            raise UploadError("Chunk was written concurrently, check the offset", status=409)
+    session.offset = start + length
+    return session
+
+
+def lock_session(session):
+    """
+    The session's row, locked until the transaction ends. Raises
+    UploadError if it is gone (finalized or aborted meanwhile).
+    """
+    locked = UploadSession.objects.select_for_update().filter(id=session.id).first()
+    if locked is None:
+        raise UploadError("Upload session not found", status=404)
+    return locked
+
+
+def check_folder(session):
+    """
+    Lock the session's target folder until the transaction ends. Raises
+    UploadError if it has gone to the bin since the session was opened.
+    """
+    if session.folder_id and not Folder.objects.select_for_update().filter(
+            id=session.folder_id, is_deleted=False).exists():
+        raise UploadError("Target folder is in the bin", status=409)
+
+
+def finalize(session):
+    """
+    Turn a fully received session into a File and release its reservation.
+    Returns None while a multipart upload waits for verify_pending().
+    """
+    failure = None
+    with transaction.atomic():
+        # A retried request waits for the first one, then finds no session
+        session = lock_session(session)
+        try:
+            if session.storage_key:
+                return finalize_direct(session)
+            return finalize_chunked(session)
+        except UploadError as e:
+            # Keep what was saved before failing (a restarted multipart upload)
+            failure = e
+    raise failure
+
+
+def finalize_chunked(session):
+    """
+    finalize() for a chunked session: store the assembled partial file.
+    """
+    if session.offset != session.size:
+        raise UploadError(
+            f"Upload incomplete: {session.offset} of {session.size} bytes", status=409)
+    check_folder(session)
+
+    with transaction.atomic():
+        path = partial_path(session)
+        if not os.path.exists(path):
+            # Zero-byte uploads never receive a chunk
+            open(path, 'wb').close()
+        # Chunks may arrive in separate processes, so the digest is taken
+        # over the assembled file. Known content is not stored again.
+        with PartialFile(open(path, 'rb'), name=path) as content:
+            head = filetypes.head_of(content)
+            blob = blobs.store(content, size=session.size)
+        if os.path.exists(path):
+            os.remove(path)
+        return register(session, blob, head)
+
+
+def reopen(session, error):
+    """
+    Delete a direct session's object that does not match, to be uploaded
+    again.
+    """
+    store = object_storage.get_store()
+    object_storage.storage().delete(session.storage_key)
+    session.status, session.error, session.claimed_at = 'open', error, None
+    if is_multipart(session):
+        session.multipart_id = store.start_multipart(session.storage_key)
+    session.save(update_fields=['status', 'error', 'claimed_at', 'multipart_id'])
+
+
+def finalize_direct(session):
+    """
+    finalize() for a direct session: complete the multipart upload, check
+    the object against the declared size and SHA-256 and adopt it as the
+    File's blob. Multipart objects are left for verify_pending() to hash.
+    An object that does not match is deleted, to be uploaded again.
+    """
+    if session.status == 'verifying':
+        return None
+    if session.status == 'complete':
+        if session.file is None:
+            raise UploadError("Upload session not found", status=404)
+        return session.file
+    check_folder(session)
+
+    store = object_storage.get_store()
+    if session.multipart_id:
+        parts = store.list_parts(session.storage_key, session.multipart_id)
+        expected = [(n, part_size(session, n)) for n in range(1, part_count(session) + 1)]
+        if [(number, size) for number, size, _ in parts] != expected:
+            raise UploadError(
+                f"Upload incomplete: {len(parts)} of {len(expected)} parts", status=409)
+        store.complete_multipart(session.storage_key, session.multipart_id, parts)
+        session.multipart_id = ''
+        session.save(update_fields=['multipart_id'])
+
+    try:
+        if is_multipart(session):
+            object_storage.checked_digest(session.storage_key, session.size)
+            session.status, session.error, session.claimed_at = 'verifying', '', None
+            session.expires_at = timezone.now() + timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+            session.save(update_fields=['status', 'error', 'claimed_at', 'expires_at'])
+            return None
+        digest = object_storage.verified_digest(session.storage_key, session.size)
+        if digest != session.sha256:
+            raise object_storage.ObjectStoreError(
+                "Uploaded content does not match its SHA-256", status=422)
+    except object_storage.ObjectStoreError as e:
+        if e.status == 422:
+            reopen(session, str(e))
+        raise UploadError(str(e), status=e.status)
+    return adopt(session, digest)
+
+
+def adopt(session, digest):
+    head = object_storage.get_store().read_head(
+        session.storage_key, min(filetypes.SNIFF_SIZE, session.size))
+    with transaction.atomic():
+        blob = blobs.adopt(digest, session.storage_key, session.size)
+        return register(session, blob, head)
+
+
+def claim_verifications(limit):
+    """
+    Mark up to `limit` verifying sessions (or ones a crashed worker left
+    claimed) as claimed and return their ids.
+    """
+    stale = timezone.now() - timedelta(
+        seconds=settings.DIRECT_UPLOADS["VERIFY_CLAIM_TIMEOUT"])
+    with transaction.atomic():
+        ids = list(
+            UploadSession.objects
+            .filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale), status='verifying')
+            .order_by('created_at')
+            .select_for_update(skip_locked=True)
+            .values_list('id', flat=True)[:limit])
+        UploadSession.objects.filter(id__in=ids).update(claimed_at=timezone.now())
+    return ids
+
+
+def verify(session_id):
+    """
+    Hash a verifying session's object (holding no lock meanwhile) and
+    register it, or reopen the session if it does not match. Returns the
+    File, or None.
+    """
+    session = UploadSession.objects.filter(id=session_id, status='verifying').first()
+    if session is None:
+        return None
+    digest = object_storage.hash_object(session.storage_key)
+    with transaction.atomic():
+        # Unless it was aborted or expired meanwhile
+        session = UploadSession.objects.select_for_update().filter(
+            id=session_id, status='verifying').first()
+        if session is None:
+            return None
+        if digest != session.sha256:
+            reopen(session, "Uploaded content does not match its SHA-256")
+            return None
+        try:
+            check_folder(session)
+        except UploadError as e:
+            # Finalized again once the folder is restored, or aborted
+            session.status, session.error, session.claimed_at = 'open', str(e), None
+            session.save(update_fields=['status', 'error', 'claimed_at'])
+            return None
+        return adopt(session, digest)
+
+
+def verify_pending(limit=10):
+    """
+    Claim and verify one batch. Returns the number of sessions processed;
+    one that fails (e.g. the store is unreachable) is retried once its
+    claim times out.
+    """
+    ids = claim_verifications(limit)
+    for session_id in ids:
+        try:
+            verify(session_id)
+        except Exception:
+            logger.exception("Verifying upload session %s failed", session_id)
+    return len(ids)
+
+
+def register(session, blob, head):
+    """
+    Create the session's File for `blob`, classified by its first bytes
+    `head`, and commit its reservation.
+    """
+    user = session.owner
+    with transaction.atomic():
+        reservation = session_reservation(session) or reserve_upload(
+            user, session.size, f'upload_session:{session.id}')
+        mime_type, file_type = filetypes.classify(session.name, head)
+        file = File.objects.create(
+            name=session.name,
+            owner=user,
+            folder=session.folder,
+            size=session.size,
+            file_type=file_type,
+            mime_type=mime_type,
+            file=blob.file.name,
+            blob=blob,
+        )
+        if session.status == 'verifying':
+            # Kept for the client polling it, until it expires
+            session.status, session.file = 'complete', file
+            session.expires_at = timezone.now() + timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+            session.save(update_fields=['status', 'file', 'expires_at'])
+        else:
+            session.delete()
+        thumbnails.enqueue([file])
+        usage.apply_file_totals(user, {file_type: (1, file.size)})
+        journal.record(user.pk, "create", files=[file.pk])
+        reservation.commit()
+    return file
+
+
+def abort(session):
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().filter(id=session.id).first()
+        if session is None:
+            return
+        reservation = session_reservation(session)
+        if reservation is not None and session.status != 'complete':
+            reservation.release()
+        session.delete()
+    if session.status == 'complete':
+        return  # its object is the File's now
+    if session.storage_key:
+        if session.multipart_id:
+            object_storage.get_store().abort_multipart(
+                session.storage_key, session.multipart_id)
+        object_storage.storage().delete(session.storage_key)
+    path = partial_path(session)
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,168 @@
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from . import result_cache
+from .models import File, FileTypeUsage, Folder, StorageUsage
+
+
+# Storage usage counters
+#
+# StorageUsage / FileTypeUsage hold the live totals the dashboard and the
+# upload quota check read. Mutations change File/Folder rows first and then
+# apply the matching delta inside the same transaction, so a rolled back
+# mutation never leaves the counters out of step.
+
+
+def file_totals(files):
+    """
+    Aggregate a File queryset into {file_type: (count, bytes)}.
+    """
+    rows = (files.order_by().values('file_type')
+            .annotate(count=Count('id'), size=Sum('size')))
+    return {row['file_type']: (row['count'], row['size'] or 0) for row in rows}
+
+
+def merge_totals(*totals):
+    merged = {}
+    for part in totals:
+        for file_type, (count, size) in part.items():
+            old_count, old_size = merged.get(file_type, (0, 0))
+            merged[file_type] = (old_count + count, old_size + size)
+    return merged
+
+
+def get_usage(user):
+    """
+    Return the user's StorageUsage row, building it from File/Folder the
+    first time it is needed.
+    """
+    try:
+        return StorageUsage.objects.get(owner=user)
+    except StorageUsage.DoesNotExist:
+        return rebuild_usage(user)[0]
+
+
+def file_type_totals(user):
+    """
+    The live {file_type: (count, bytes)} from the counters.
+    """
+    return {
+        file_type: (count, size)
+        for file_type, count, size in FileTypeUsage.objects.filter(owner=user)
+        .values_list('file_type', 'files_count', 'bytes_used')
+    }
+
+
+# Async variants for the ASGI GraphQL view
+
+
+async def aget_usage(user):
+    usage = await StorageUsage.objects.filter(owner=user).afirst()
+    if usage is None:
+        usage = await sync_to_async(get_usage)(user)
+    return usage
+
+
+async def afile_type_totals(user):
+    return {
+        file_type: (count, size)
+        async for file_type, count, size in FileTypeUsage.objects.filter(owner=user)
+        .values_list('file_type', 'files_count', 'bytes_used')
+    }
+
+
+def apply_file_totals(user, totals, sign=1):
+    """
+    Add (sign=1) or remove (sign=-1) aggregated files from the counters.
+    Call after the File rows have been written.
+    """
+    if not totals:
+        return
+    count = sum(c for c, _ in totals.values())
+    size = sum(s for _, s in totals.values())
+    with transaction.atomic():
+        updated = StorageUsage.objects.filter(owner=user).update(
+            bytes_used=F('bytes_used') + sign * size,
+            files_count=F('files_count') + sign * count,
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            # No counters yet: a rebuild already reflects this change
+            rebuild_usage(user)
+            return
+        FileTypeUsage.objects.bulk_create(
+            [FileTypeUsage(owner=user, file_type=t) for t in totals],
+            ignore_conflicts=True,
+        )
+        for file_type, (type_count, type_size) in totals.items():
+            FileTypeUsage.objects.filter(owner=user, file_type=file_type).update(
+                files_count=F('files_count') + sign * type_count,
+                bytes_used=F('bytes_used') + sign * type_size,
+            )
+
+
+def apply_folder_count(user, delta):
+    """
+    Adjust the live folder count. Call after the Folder rows have been written.
+    """
+    if not delta:
+        return
+    with transaction.atomic():
+        updated = StorageUsage.objects.filter(owner=user).update(
+            folders_count=F('folders_count') + delta,
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            rebuild_usage(user)
+
+
+def rebuild_usage(user):
+    """
+    Recompute the counters from File/Folder.
+    Returns (usage, changed) where changed is True if the stored values drifted.
+    """
+    with transaction.atomic():
+        # Locked before counting, so no delta lands between the count and
+        # the write
+        usage, created = StorageUsage.objects.select_for_update().get_or_create(owner=user)
+        totals = file_totals(File.objects.filter(owner=user, is_deleted=False))
+        expected = {
+            'bytes_used': sum(s for _, s in totals.values()),
+            'files_count': sum(c for c, _ in totals.values()),
+            'folders_count': Folder.objects.filter(owner=user, is_deleted=False).count(),
+        }
+        changed = created or any(
+            getattr(usage, field) != value for field, value in expected.items())
+        if changed:
+            for field, value in expected.items():
+                setattr(usage, field, value)
+            usage.save()
+
+        stored = {
+            row.file_type: row
+            for row in FileTypeUsage.objects.filter(owner=user)
+        }
+        stale = [t for t in stored if t not in totals]
+        if stale:
+            changed = changed or any(
+                stored[t].files_count or stored[t].bytes_used for t in stale)
+            FileTypeUsage.objects.filter(
+                owner=user, file_type__in=stale).delete()
+        for file_type, (count, size) in totals.items():
+            row = stored.get(file_type)
+            if row is None:
+                changed = True
+                FileTypeUsage.objects.create(
+                    owner=user, file_type=file_type,
+                    files_count=count, bytes_used=size)
+            elif row.files_count != count or row.bytes_used != size:
+                changed = True
+                row.files_count = count
+                row.bytes_used = size
+                row.save(update_fields=['files_count', 'bytes_used'])
+        if changed:
+            result_cache.invalidate(user.pk)
+
+    return usage, changed
@@ -1,6 +1,285 @@
+import json
+import re
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods, require_POST
 from dj_rest_auth.registration.views import SocialLoginView
 from allauth.socialaccount.providers.google.views import GoogleOAuth2Adapter
 
+from . import archives, downloads, events, journal, object_storage, uploads
+from .models import CustomUser, File
+
 
 class GoogleLogin(SocialLoginView):
     adapter_class = GoogleOAuth2Adapter
+
+
+# Resumable chunked uploads, see accounts.uploads
+#
+#   POST   /uploads/                 {"name", "size", "folderId"} -> session
+#   GET    /uploads/<id>/            current offset, to resume
+#   PUT    /uploads/<id>/            one chunk, with Content-Range
+#   POST   /uploads/<id>/finalize/   register the File
+#   DELETE /uploads/<id>/            abort
+#
+# Direct uploads, see accounts.object_storage
+#
+#   POST   /uploads/                 {..., "sha256"} -> session with "upload"
+#   POST   /uploads/<id>/parts/      {"parts": [{"number", "sha256"}]} -> URLs
+#   PUT    /uploads/direct/?sig=...  the "local" backend's presigned URLs
+#   POST   /uploads/<id>/finalize/   202 for multipart uploads: GET the session
+#                                    until its "status" is "complete"
+
+
+def _session_json(session, status=200):
+    data = {
+        "id": str(session.id),
+        "name": session.name,
+        "size": session.size,
+        "offset": session.offset,
+        "expiresAt": session.expires_at.isoformat(),
+        "maxChunkSize": settings.UPLOAD_MAX_CHUNK_SIZE,
+        "status": session.status,
+    }
+    if session.error:
+        data["error"] = session.error
+    if session.status == "complete" and session.file is not None:
+        data["file"] = _file_json(session.file)
+    elif session.storage_key and session.status == "open":
+        # Presigned URLs expire, so every read of the session signs anew
+        data["upload"] = uploads.direct_upload(session)
+    return JsonResponse(data, status=status)
+
+
+def _file_json(file):
+    return {"id": str(file.id), "name": file.name, "size": file.size}
+
+
+def _upload_view(view):
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.user.is_anonymous:
+            return JsonResponse({"error": "Not authenticated"}, status=401)
+        try:
+            return view(request, *args, **kwargs)
+        except uploads.UploadError as e:
+            return JsonResponse({"error": str(e)}, status=e.status)
+    return wrapper
+
+
+def _parse_content_range(request, size):
+    """
+    Parse `Content-Range: bytes <start>-<end>/<total>` into (start, length).
+    The total, if given, must be the session's declared `size`.
+    """
+    match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+|\*)',
+                         request.headers.get('Content-Range', ''))
+    if not match:
+        raise uploads.UploadError("Content-Range header is required")
+    start, end = int(match.group(1)), int(match.group(2))
+    if end < start:
+        raise uploads.UploadError("Invalid Content-Range", status=416)
+    if match.group(3) != '*' and int(match.group(3)) != size:
+        raise uploads.UploadError(
+            "Content-Range total does not match the declared size", status=416)
+    length = end - start + 1
+    try:
+        sent = int(request.headers.get('Content-Length') or 0)
+    except ValueError:
+        raise uploads.UploadError("Invalid Content-Length")
+    if sent != length:
+        raise uploads.UploadError("Content-Length does not match Content-Range")
+    return start, length
+
+
+@_upload_view
+@require_POST
+def upload_session_create(request):
+    try:
+        data = json.loads(request.body or b'{}')
+        size = int(data.get("size"))
+    except (TypeError, ValueError):
+        raise uploads.UploadError("Invalid upload request")
+    session = uploads.create_session(
+        request.user, data.get("name"), size, data.get("folderId"), data.get("sha256"))
+    return _session_json(session, status=201)
+
+
+@_upload_view
+@require_http_methods(["GET", "HEAD", "PUT", "DELETE"])
+def upload_session_detail(request, session_id):
+    session = uploads.get_session(request.user, session_id)
+    if request.method == "PUT":
+        start, length = _parse_content_range(request, session.size)
+        # Read the body as a stream; request.body would buffer it in memory
+        session = uploads.write_chunk(session, start, length, request)
+    elif request.method == "DELETE":
+        uploads.abort(session)
+        return JsonResponse({"success": True})
+    return _session_json(session)
+
+
+@_upload_view
+@require_POST
+def upload_session_finalize(request, session_id):
+    session = uploads.get_session(request.user, session_id)
+    file = uploads.finalize(session)
+    if file is None:
+        # Verified in the background
+        return _session_json(uploads.get_session(request.user, session_id), status=202)
+    return JsonResponse({"success": True, "file": _file_json(file)}, status=201)
+
+
+@_upload_view
+@require_POST
+def upload_session_parts(request, session_id):
+    session = uploads.get_session(request.user, session_id)
+    try:
+        parts = [(int(part["number"]), part.get("sha256"))
+                 for part in json.loads(request.body or b'{}')["parts"]]
+    except (KeyError, TypeError, ValueError):
+        raise uploads.UploadError("Invalid parts request")
+    return JsonResponse({"parts": uploads.presign_parts(session, parts)})
+
+
+@csrf_exempt
+@require_http_methods(["PUT"])
+def direct_upload_put(request):
+    store = object_storage.get_store()
+    if not isinstance(store, object_storage.LocalObjectStore):
+        raise Http404()
+    try:
+        try:
+            length = int(request.headers.get("Content-Length") or 0)
+        except ValueError:
+            raise object_storage.ObjectStoreError("Invalid Content-Length", status=400)
+        store.receive_put(request.GET.get("sig", ""), request, length)
+    except object_storage.ObjectStoreError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+    return JsonResponse({"success": True})
+
+
+# Downloads, see accounts.downloads
+#
+#   GET/HEAD /files/<id>/download/[?download=1][&sig=...]
+
+
+@require_http_methods(["GET", "HEAD"])
+def file_download(request, file_id):
+    try:
+        # Binned files are restored before they are downloaded, as in archives
+        file = File.objects.select_related("blob").get(id=file_id, is_deleted=False)
+    except File.DoesNotExist:
+        raise Http404("File not found")
+    if not downloads.signature_allows(request, file.id):
+        if request.user.is_anonymous:
+            return JsonResponse({"error": "Not authenticated"}, status=401)
+        if file.owner_id != request.user.pk:
+            raise Http404("File not found")
+    return downloads.serve(request, file, as_attachment="download" in request.GET)
+
+
+# Folder and multi-selection downloads, see accounts.archives
+#
+#   GET /archives/download/?sig=...                     URL from downloadArchive
+#   GET /archives/download/?files=1,2&folders=3[&compress=1]   authenticated
+
+
+def _signing_user(user_id, version):
+    """
+    The active user who signed a URL, or None if their tokens were revoked
+    since (the signed token version is no longer theirs).
+    """
+    user = CustomUser.objects.filter(pk=user_id, is_active=True).first()
+    return user if user is not None and user.token_version == version else None
+
+
+def _id_list(value):
+    return [int(pk) for pk in value.split(",") if pk.strip().isdigit()]
+
+
+@require_http_methods(["GET"])
+def archive_download(request):
+    token = request.GET.get("sig")
+    if token:
+        signed = archives.unsign(token)
+        if signed is None:
+            return JsonResponse({"error": "Invalid or expired link"}, status=403)
+        user_id, version, file_ids, folder_ids, compress = signed
+        user = _signing_user(user_id, version)
+        if user is None:
+            return JsonResponse({"error": "Invalid or expired link"}, status=403)
+    elif request.user.is_anonymous:
+        return JsonResponse({"error": "Not authenticated"}, status=401)
+    else:
+        user = request.user
+        file_ids = _id_list(request.GET.get("files", ""))
+        folder_ids = _id_list(request.GET.get("folders", ""))
+        compress = request.GET.get("compress") in ("1", "true")
+    try:
+        selection = archives.select(user, file_ids, folder_ids, compress)
+    except archives.ArchiveError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+    return archives.serve(request, selection)
+
+
+# Change push, see accounts.events
+#
+#   GET /events/[?sig=...]   text/event-stream; URL from eventStreamUrl or an
+#                            Authorization header. Last-Event-ID (or
+#                            ?lastEventId=) catches up after a reconnect.
+
+
+def _stream_user_id(request):
+    return None if request.user.is_anonymous else request.user.pk
+
+
+def _signed_user_id(token):
+    """
+    The user id of a signed stream URL, or None if it is invalid, expired
+    or was signed before the user's tokens were revoked.
+    """
+    signed = events.unsign(token)
+    if signed is None:
+        return None
+    user = _signing_user(*signed)
+    return user.pk if user is not None else None
+
+
+@require_http_methods(["GET"])
+async def event_stream(request):
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({"error": "Event streams need the ASGI server"}, status=501)
+    token = request.GET.get("sig")
+    if token:
+        user_id = await sync_to_async(_signed_user_id)(token)
+        if user_id is None:
+            return JsonResponse({"error": "Invalid or expired link"}, status=403)
+    else:
+        user_id = await sync_to_async(_stream_user_id)(request)
+        if user_id is None:
+            return JsonResponse({"error": "Not authenticated"}, status=401)
+
+    broker = events.get_broker()
+    try:
+        subscription = await broker.subscribe(user_id)
+    except events.EventError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+    try:
+        # Subscribed first, so nothing committed from here on is missed
+        first = None
+        since = request.headers.get("Last-Event-ID") or request.GET.get("lastEventId")
+        if since:
+            cursor = await sync_to_async(journal.head)(user_id)
+            if since != cursor:
+                first = {**events.message_for(cursor, []), "more": True}
+    except BaseException:
+        broker.unsubscribe(subscription)
+        raise
+    return events.response(broker, subscription, first)
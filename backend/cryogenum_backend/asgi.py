@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cryogenum_backend.settings')
+# Use the async GraphQL view under ASGI (settings.GRAPHQL_ASYNC)
+os.environ.setdefault('GRAPHQL_ASYNC', 'True')
 
 application = get_asgi_application()
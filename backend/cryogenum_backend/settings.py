@@ -146,6 +146,135 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Hash multipart uploads while they stream in, see accounts.blobs
+FILE_UPLOAD_HANDLERS = [
+    "accounts.blobs.HashingMemoryFileUploadHandler",
+    "accounts.blobs.HashingTemporaryFileUploadHandler",
+]
+
+# ======================================
+# DOWNLOADS (accounts.downloads)
+# ======================================
+DOWNLOADS = {
+    # "", "x-accel-redirect" (nginx) or "x-sendfile" (Apache/lighttpd)
+    "SENDFILE": os.getenv("DOWNLOAD_SENDFILE", ""),
+    # nginx `internal` location aliased to MEDIA_ROOT
+    "ACCEL_PREFIX": os.getenv("DOWNLOAD_ACCEL_PREFIX", "/protected-media/"),
+    "SIGNED_URL_TTL": 60 * 60,
+}
+
+# ======================================
+# ARCHIVES (accounts.archives)
+# ======================================
+ARCHIVES = {
+    # Bytes of file content per folder or multi-selection download
+    "MAX_BYTES": {"free": 2 * 1024 ** 3, "pro": 20 * 1024 ** 3},
+    "DEFAULT_MAX_BYTES": 2 * 1024 ** 3,  # tiers not listed above
+    "MAX_FILES": 20_000,
+    "BLOCK_SIZE": 256 * 1024,  # bytes read from storage at a time
+}
+
+# ======================================
+# THUMBNAILS (accounts.thumbnails)
+# ======================================
+THUMBNAIL_SIZES = [128, 256, 512]  # longest edge, in pixels
+THUMBNAIL_MAX_ATTEMPTS = 3
+THUMBNAIL_CLAIM_TIMEOUT = 10 * 60  # seconds before a stuck job is retried
+
+# ======================================
+# BIN RETENTION (accounts.trash)
+# ======================================
+TRASH = {
+    # Days items stay in the bin before `manage.py purge_bin` deletes them
+    "RETENTION_DAYS": {"free": 30, "pro": 90},
+    "DEFAULT_RETENTION_DAYS": 30,  # tiers not listed above
+    "BATCH_SIZE": 500,  # rows per purge transaction
+    "WORKERS": 8,  # threads deleting storage objects
+}
+
+# ======================================
+# CHUNKED UPLOADS
+# ======================================
+UPLOAD_SESSION_DIR = os.getenv("UPLOAD_SESSION_DIR", str(BASE_DIR / "upload_sessions"))
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 60 * 60))  # seconds
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024  # 64 MB per PUT
+UPLOAD_BLOCK_SIZE = 256 * 1024  # bytes read from the request at a time
+
+# ======================================
+# CHANGE JOURNAL (accounts.journal)
+# ======================================
+JOURNAL = {
+    "DEFAULT_LIMIT": 200,  # entries per `changes` page
+    "MAX_LIMIT": 1000,
+    # Older entries are dropped by compact_changes; clients whose cursor
+    # is older than that list everything again
+    "RETENTION_DAYS": 30,
+    "BATCH_SIZE": 1000,
+}
+
+# ======================================
+# CHANGE PUSH (accounts.events)
+# ======================================
+EVENTS = {
+    # "local" (this process only) or "redis" (REDIS_URL, shared by all nodes)
+    "BACKEND": os.getenv("EVENTS_BACKEND", "local"),
+    "REDIS_URL": os.getenv("EVENTS_REDIS_URL", "redis://localhost:6379/0"),
+    "BUFFER_SIZE": 32,  # messages held per connection before coalescing
+    "MAX_CONNECTIONS": 10,  # open streams per user and process
+    "MAX_ITEMS": 50,  # changes listed per message
+    "HEARTBEAT": 15,  # seconds between keepalives on an idle stream
+    "MAX_AGE": 60 * 60,  # seconds before a stream ends and the client reconnects
+    "RETRY_MS": 3000,  # client reconnect delay
+    "SIGNED_URL_TTL": 60 * 60,  # seconds an eventStreamUrl stays valid
+}
+
+# ======================================
+# FILE TYPES (accounts.filetypes)
+# ======================================
+# Extra {MIME type or "type/*": category} rules, checked before the built-in
+# table, e.g. {"application/x-ipynb+json": "notebook"}
+FILE_TYPE_CATEGORIES = {}
+
+# ======================================
+# DIRECT UPLOADS (accounts.object_storage)
+# ======================================
+DIRECT_UPLOADS = {
+    # "local" (default storage, PUTs through Django; development) or "s3"
+    # (presigned URLs for S3 or an S3-compatible store such as MinIO)
+    "BACKEND": os.getenv("DIRECT_UPLOAD_BACKEND", "local"),
+    "URL_TTL": 15 * 60,  # seconds a presigned URL stays valid
+    # Larger uploads go in parts; S3 parts are 5 MB to 5 GB
+    "MULTIPART_THRESHOLD": 64 * 1024 * 1024,
+    "PART_SIZE": 64 * 1024 * 1024,
+    # Multipart uploads are hashed by `manage.py run_upload_worker`; seconds
+    # before a stuck verification is retried
+    "VERIFY_CLAIM_TIMEOUT": 60 * 60,
+    "S3": {
+        "BUCKET": os.getenv("S3_BUCKET", ""),
+        "ENDPOINT_URL": os.getenv("S3_ENDPOINT_URL", ""),  # e.g. MinIO
+        "REGION": os.getenv("S3_REGION", "us-east-1"),
+        "ACCESS_KEY_ID": os.getenv("S3_ACCESS_KEY_ID", ""),
+        "SECRET_ACCESS_KEY": os.getenv("S3_SECRET_ACCESS_KEY", ""),
+    },
+}
+
+if DIRECT_UPLOADS["BACKEND"] == "s3":
+    # Stored files live in the bucket the clients upload to
+    STORAGES = {
+        "default": {
+            "BACKEND": "storages.backends.s3.S3Storage",
+            "OPTIONS": {
+                "bucket_name": DIRECT_UPLOADS["S3"]["BUCKET"],
+                "endpoint_url": DIRECT_UPLOADS["S3"]["ENDPOINT_URL"] or None,
+                "region_name": DIRECT_UPLOADS["S3"]["REGION"],
+                "access_key": DIRECT_UPLOADS["S3"]["ACCESS_KEY_ID"] or None,
+                "secret_key": DIRECT_UPLOADS["S3"]["SECRET_ACCESS_KEY"] or None,
+                "file_overwrite": False,
+            },
+        },
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    }
+
 # ======================================
 # DEFAULT AUTO FIELD
 # ======================================
@@ -162,9 +291,11 @@ CSRF_TRUSTED_ORIGINS = [
 
 CORS_ALLOWED_ORIGINS = CSRF_TRUSTED_ORIGINS
 CORS_ALLOW_CREDENTIALS = True
-CORS_ALLOW_METHODS = ["GET", "POST", "OPTIONS"]
-CORS_ALLOW_HEADERS = ["Content-Type", "X-CSRFToken", "Cookie", "Authorization"]
-CORS_EXPOSE_HEADERS = ["Set-Cookie"]
+CORS_ALLOW_METHODS = ["GET", "HEAD", "POST", "PUT", "DELETE", "OPTIONS"]
+CORS_ALLOW_HEADERS = ["Content-Type", "Content-Range", "X-CSRFToken", "Cookie", "Authorization",
+                      "Range", "If-Range", "If-None-Match", "If-Modified-Since"]
+CORS_EXPOSE_HEADERS = ["Set-Cookie", "Content-Range", "Accept-Ranges", "Content-Length",
+                       "Content-Disposition", "ETag", "Last-Modified", "Server-Timing"]
 
 # ======================================
 # SESSION & COOKIE SETTINGS
@@ -176,12 +307,98 @@ CSRF_COOKIE_SECURE = not DEBUG
 SESSION_COOKIE_SAMESITE = "Lax" if DEBUG else "None"
 SECURE_SSL_REDIRECT = not DEBUG
 
+# ======================================
+# TOKEN AUTH (accounts.middleware)
+# ======================================
+# "db": load the user from the database on every request
+# "cached": per-process TTL/LRU user cache keyed by user id and token version
+# "stateless": "cached", plus read-only queries use a user built from the token
+#   claims, without loading it, once SHARED_CACHE holds its token version
+TOKEN_AUTH = {
+    "MODE": os.getenv("TOKEN_AUTH_MODE", "db"),
+    "CACHE_TTL": int(os.getenv("TOKEN_AUTH_CACHE_TTL", 60)),  # seconds
+    "CACHE_SIZE": 10000,
+    # Alias in CACHES shared by every process (e.g. Redis), so dropping a
+    # cached user reaches them all; None drops it in this process only
+    "SHARED_CACHE": os.getenv("TOKEN_AUTH_SHARED_CACHE") or None,
+}
+
 # ======================================
 # GRAPHQL SETTINGS
 # ======================================
 GRAPHENE = {
     "SCHEMA": "cryogenum_backend.schema.schema",
-    "MIDDLEWARE": [],  # No graphql_jwt, handled by TokenAuthenticationMiddleware
+    # No graphql_jwt, handled by TokenAuthenticationMiddleware
+    "MIDDLEWARE": ["accounts.profiling.ProfilingMiddleware"],
+}
+
+# Per-request resolver and SQL profiling (accounts.profiling)
+GRAPHQL_PROFILING = {
+    # On in production too, for Server-Timing and the sampled logs
+    "ENABLED": os.getenv("GRAPHQL_PROFILING", "True") == "True",
+    # Per-field timings and SQL in the response's extensions.profile
+    "EXTENSIONS": DEBUG,
+    "SERVER_TIMING": True,
+    # Share of requests logged to "accounts.profiling", plus all slow ones
+    "LOG_SAMPLE_RATE": float(os.getenv("GRAPHQL_PROFILING_SAMPLE_RATE", "0.01")),
+    "LOG_SLOW_MS": int(os.getenv("GRAPHQL_PROFILING_SLOW_MS", "1000")),
+    "TOP_FIELDS": 20,
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "accounts.profiling": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
+
+# Serve /graphql/ with the native async view (accounts.graphql_view), on
+# by default under ASGI (see asgi.py)
+GRAPHQL_ASYNC = os.getenv("GRAPHQL_ASYNC", "False") == "True"
+
+# Persisted queries and the parsed document cache (accounts.persisted)
+GRAPHQL_PERSISTED_QUERIES = {
+    "CACHE_SIZE": 500,
+    # JSON manifest {"<sha256 of query>": "<query>"} built with the frontend
+    "ALLOWLIST": os.getenv("GRAPHQL_ALLOWLIST", ""),
+    # Reject any operation not in the manifest
+    "ALLOWLIST_ONLY": os.getenv("GRAPHQL_ALLOWLIST_ONLY", "False") == "True",
+}
+
+# Opt-in cache of read query results (accounts.result_cache)
+RESULT_CACHE = {
+    "ENABLED": os.getenv("GRAPHQL_RESULT_CACHE", "False") == "True",
+    # "django" (caches[CACHE_ALIAS], which every process must share, e.g.
+    # Redis) or "locmem" (this process only)
+    "BACKEND": os.getenv("GRAPHQL_RESULT_CACHE_BACKEND", "django"),
+    "CACHE_ALIAS": os.getenv("GRAPHQL_RESULT_CACHE_ALIAS", "default"),
+    # Allow per-process caches: one process serves requests and runs the
+    # workers' jobs too
+    "SINGLE_PROCESS": os.getenv("GRAPHQL_RESULT_CACHE_SINGLE_PROCESS", "False") == "True",
+    "SIZE": 5000,  # entries, locmem only
+    "TTL": 300,
+    # Root query fields whose results may be cached
+    "FIELDS": ["dashboardStats", "userFolders", "folderInfo", "folderContents", "changes"],
+}
+
+# Query cost, depth and rate limits (accounts.limits)
+GRAPHQL_LIMITS = {
+    "MAX_DEPTH": int(os.getenv("GRAPHQL_MAX_DEPTH", "10")),
+    "MAX_COST": int(os.getenv("GRAPHQL_MAX_COST", "5000")),
+    # Token bucket per user (or IP): refill per second and capacity
+    "RATE": float(os.getenv("GRAPHQL_RATE", "100")),
+    "BURST": int(os.getenv("GRAPHQL_BURST", "10000")),
+    "CLIENTS": 10000,  # buckets kept per process
+    # Cost of a field, by "Type.field", instead of 1 per object
+    "FIELD_COSTS": {
+        "Query.dashboardStats": 10,
+        "Query.searchFiles": 10,
+        "Query.searchFolders": 10,
+        "Mutation.uploadFile": 50,
+        "Mutation.purgeItems": 50,
+    },
 }
 
 # ======================================
@@ -1,16 +1,32 @@
+from django.conf import settings
 from django.contrib import admin
 from django.urls import include, path
 from django.views.decorators.csrf import csrf_exempt
-# ✅ use upload-enabled view
-from graphene_file_upload.django import FileUploadGraphQLView
+# ✅ upload-enabled view with query cost and rate limits
+from accounts.graphql_view import AsyncGraphQLView, GraphQLView
 from cryogenum_backend.schema import schema
+from accounts import views
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path(
         "graphql/",
-        csrf_exempt(FileUploadGraphQLView.as_view(
+        csrf_exempt((AsyncGraphQLView if settings.GRAPHQL_ASYNC else GraphQLView).as_view(
             graphiql=True, schema=schema)),  # ✅ fixed
+        name="graphql",
     ),
     path("accounts/", include("allauth.urls")),
+    # Resumable chunked uploads
+    path("uploads/", views.upload_session_create),
+    path("uploads/<uuid:session_id>/", views.upload_session_detail),
+    path("uploads/<uuid:session_id>/finalize/", views.upload_session_finalize),
+    # Direct-to-storage uploads
+    path("uploads/<uuid:session_id>/parts/", views.upload_session_parts),
+    path("uploads/direct/", views.direct_upload_put, name="direct_upload_put"),
+    # Authenticated downloads with Range support
+    path("files/<int:file_id>/download/", views.file_download, name="file_download"),
+    # Folders and multi-selections as one streamed ZIP
+    path("archives/download/", views.archive_download, name="archive_download"),
+    # Server-Sent Events of file and folder changes (ASGI)
+    path("events/", views.event_stream, name="event_stream"),
 ]